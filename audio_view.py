@@ -0,0 +1,89 @@
+"""Zero-copy views of AudioSegment samples.
+
+Slicing an AudioSegment copies the sliced bytes into a new segment, and
+most slices made while rendering are copied again as soon as they are
+appended. An AudioView refers to a range of frames of its source segment
+instead. The render engines read the samples straight from the view, and
+it is only turned into an AudioSegment of its own when an effect needs
+one, eg. to reverse or pan it.
+"""
+from typing import Optional
+
+import numpy as np
+
+
+class AudioView:
+    """A read-only view of frames start:end of an AudioSegment. Attributes
+    and methods that the view does not have are looked up on the
+    materialized AudioSegment, so it can be used in place of one."""
+    __slots__ = ('source', 'start', 'end', '_audio')
+
+    def __init__(self, source, start: Optional[int] = None,
+                 end: Optional[int] = None):
+        """start and end are frame indices, bounded to the source as in
+        AudioSegment.get_sample_slice."""
+        frame_count = int(source.frame_count())
+        self.source = source
+        self.start = min(max(int(start or 0), 0), frame_count)
+        self.end = frame_count if end is None else min(max(int(end), 0), frame_count)
+        self.end = max(self.end, self.start)
+        self._audio = None
+
+    def __repr__(self) -> str:
+        return f"AudioView: frames {self.start}-{self.end} ({len(self)} ms)"
+
+    def __len__(self) -> int:
+        """The length in ms, as AudioSegment.__len__"""
+        return round(1000 * (float(self.end - self.start) / self.frame_rate))
+
+    def __getattr__(self, name: str):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.materialize(), name)
+
+    def __getitem__(self, millisecond):
+        return self.materialize()[millisecond]
+
+    @property
+    def frame_rate(self) -> int:
+        return self.source.frame_rate
+
+    @property
+    def channels(self) -> int:
+        return self.source.channels
+
+    @property
+    def sample_width(self) -> int:
+        return self.source.sample_width
+
+    @property
+    def frame_width(self) -> int:
+        return self.source.frame_width
+
+    def frame_count(self, ms: Optional[int | float] = None) -> float:
+        if ms is not None:
+            return ms * (self.frame_rate / 1000.0)
+        return float(self.end - self.start)
+
+    @property
+    def raw_data(self) -> memoryview:
+        """The bytes of the frames, as a read-only memoryview of the source"""
+        width = self.frame_width
+        return memoryview(self.source.raw_data)[self.start * width:self.end * width]
+
+    def to_array(self) -> np.ndarray:
+        """Get a read-only (frames, channels) array of the samples"""
+        return np.frombuffer(
+            self.raw_data, dtype=np.dtype(f'<i{self.sample_width}')
+        ).reshape(-1, self.channels)
+
+    def same_format(self, audio) -> bool:
+        return (self.channels, self.frame_rate, self.sample_width) == (
+            audio.channels, audio.frame_rate, audio.sample_width)
+
+    def materialize(self):
+        """Copy the frames into an AudioSegment of their own. The copy is
+        made once, and kept for later calls."""
+        if self._audio is None:
+            self._audio = self.source._spawn(bytes(self.raw_data))
+        return self._audio
@@ -3,11 +3,13 @@ One of these vastly improves performance (using memory instead of temp files on
 
 This patches the improvements in.
 """
+import array
 import os
 from typing import Self
 import sys
 import wave
 import subprocess
+import threading
 from io import BytesIO, BufferedReader
 from tempfile import NamedTemporaryFile, TemporaryFile
 
@@ -21,10 +23,19 @@ from pydub.exceptions import (
     InvalidTag,
     CouldntEncodeError,
     CouldntDecodeError,
+    TooManyMissingFrames,
 )
 
 from pydub import AudioSegment
-from pydub.audio_segment import fix_wav_headers
+import numpy as np
+
+from audio_view import AudioView
+from crossfade import join_crossfaded
+
+# The raw sample formats ffmpeg reads, by sample width
+RAW_SAMPLE_FORMATS = {1: 's8', 2: 's16le', 4: 's32le'}
+# Bytes written to or read from ffmpeg at a time when streaming
+STREAM_CHUNK_SIZE = 1 << 20
 
 def _fd_or_path_or_tempfile(fd, mode='w+b', tempfile=True):
     close_fd = False
@@ -51,11 +62,106 @@ def _fd_or_path_or_tempfile(fd, mode='w+b', tempfile=True):
     return fd, close_fd
 
 class PatchedAudioSegment(AudioSegment):
-    def append(self, seg, crossfade=100):
-        seg1, seg2 = AudioSegment._sync(self, seg)
+    # BUFFER-BACKED AUDIO
+    # The samples of a segment may be a read-only memoryview of a buffer
+    # instead of bytes, eg. of shared memory (see shared_audio.py) or of a
+    # memory-mapped file (see decode_cache.py). The methods below cover the
+    # places where pydub assumes bytes.
+    @classmethod
+    def from_buffer(cls, buffer, sample_width: int, frame_rate: int,
+                    channels: int) -> Self:
+        """Make a segment of the samples in a buffer, without copying them.
+        The segment reads the buffer through a read-only memoryview, which
+        keeps the buffer alive. The buffer must not be changed or closed
+        while the segment, or a view or array of its samples, is in use.
+        Slices of the segment get bytes of their own, as with pydub."""
+        return cls(memoryview(buffer).cast('B').toreadonly(),
+                   sample_width=sample_width, frame_rate=frame_rate,
+                   channels=channels)
+
+    def _spawn_buffer(self, buffer) -> Self:
+        """As _spawn, but the new segment is backed by the buffer, see
+        from_buffer"""
+        return self.from_buffer(buffer, self.sample_width, self.frame_rate,
+                                self.channels)
+
+    def __getitem__(self, millisecond):
+        if not isinstance(self._data, memoryview) or (
+                isinstance(millisecond, slice) and millisecond.step):
+            return super().__getitem__(millisecond)
+        # As pydub, except that the slice is copied into bytes, which can
+        # be padded with silence
+        if isinstance(millisecond, slice):
+            start = millisecond.start if millisecond.start is not None else 0
+            end = millisecond.stop if millisecond.stop is not None \
+                else len(self)
+
+            start = min(start, len(self))
+            end = min(end, len(self))
+        else:
+            start = millisecond
+            end = millisecond + 1
+
+        start = self._parse_position(start) * self.frame_width
+        end = self._parse_position(end) * self.frame_width
+        data = self._data[start:end].tobytes()
+
+        # ensure the output is as long as the requester is expecting
+        missing_frames = (end - start - len(data)) // self.frame_width
+        if missing_frames:
+            if missing_frames > self.frame_count(ms=2):
+                raise TooManyMissingFrames(
+                    "You should never be filling in "
+                    "   more than 2 ms with silence here, "
+                    "missing frames: %s" % missing_frames)
+            silence = audioop.mul(data[:self.frame_width],
+                                  self.sample_width, 0)
+            data += (silence * missing_frames)
+
+        return self._spawn(data)
+
+    def get_sample_slice(self, start_sample=None, end_sample=None):
+        sliced = super().get_sample_slice(start_sample, end_sample)
+        if isinstance(sliced._data, memoryview):
+            sliced._data = sliced._data.tobytes()
+        return sliced
+
+    def get_array_of_samples(self, array_type_override=None):
+        if not isinstance(self._data, memoryview):
+            return super().get_array_of_samples(array_type_override)
+        # array.array() would take a memoryview as an iterable of bytes
+        samples = array.array(array_type_override or self.array_type)
+        samples.frombytes(self._data)
+        return samples
+
+    def __mul__(self, arg):
+        if isinstance(arg, int) and isinstance(self._data, memoryview):
+            return self._spawn(data=self._data.tobytes() * arg)
+        return super().__mul__(arg)
+
+    def __getstate__(self) -> dict:
+        """Pickle buffer-backed segments with a copy of their samples"""
+        state = dict(vars(self))
+        if isinstance(state.get('_data'), memoryview):
+            state['_data'] = state['_data'].tobytes()
+        return state
+
+    def append(self, seg, crossfade=100, curve='stepped'):
+        """Append a segment, crossfading the given number of ms. With the
+        'linear' or 'equal_power' curve, the crossfade has a gain per frame
+        and is mixed with NumPy (see crossfade.py), instead of the fades of
+        pydub, which step the gain once per ms.
+        An AudioView in the same format is joined without copying it first."""
+        if (isinstance(seg, AudioView) and seg.same_format(self)
+                and (not crossfade or curve != 'stepped')):
+            seg1, seg2 = self, seg
+        else:
+            if isinstance(seg, AudioView):
+                seg = seg.materialize()
+            seg1, seg2 = AudioSegment._sync(self, seg)
 
         if not crossfade:
-            return seg1._spawn(seg1._data + seg2._data)
+            return seg1._spawn([seg1._data, seg2.raw_data])
         elif crossfade > len(self):
             raise ValueError("Crossfade is longer than the original AudioSegment ({}ms > {}ms)".format(
                 crossfade, len(self)
@@ -65,6 +171,14 @@ class PatchedAudioSegment(AudioSegment):
                 crossfade, len(seg)
             ))
 
+        if curve != 'stepped':
+            dtype = np.dtype(f'<i{seg1.sample_width}')
+            joined = join_crossfaded(
+                np.frombuffer(seg1._data, dtype=dtype).reshape(-1, seg1.channels),
+                np.frombuffer(seg2.raw_data, dtype=dtype).reshape(-1, seg2.channels),
+                int(crossfade * (seg1.frame_rate / 1000.0)), curve)
+            return seg1._spawn(joined.tobytes())
+
         xf = seg1[-crossfade:].fade(to_gain=-120, start=0, end=float('inf'))
         xf *= seg2[:crossfade].fade(from_gain=-120, start=0, end=float('inf'))
 
@@ -89,6 +203,10 @@ class PatchedAudioSegment(AudioSegment):
         """
         Export an AudioSegment to a file with given options
 
+        Unlike pydub, no temporary files are written: the raw samples are
+        streamed into ffmpeg's stdin, and ffmpeg writes directly to the
+        destination path, or to stdout for file objects.
+
         out_f (string):
             Path to destination audio file. Also accepts os.PathLike objects on
             python >= 3.6
@@ -127,49 +245,47 @@ class PatchedAudioSegment(AudioSegment):
                     'specify an ffmpeg raw format like format="s16le" instead '
                     'or call export(format="raw") with no codec or parameters')
 
-        out_f, _ = _fd_or_path_or_tempfile(out_f, 'wb+')
-        out_f.seek(0)
-
         if format == "raw":
+            out_f, _ = _fd_or_path_or_tempfile(out_f, 'wb+')
+            out_f.seek(0)
             out_f.write(self._data)
             out_f.seek(0)
             return out_f
 
         # wav with no ffmpeg parameters can just be written directly to out_f
-        easy_wav = format == "wav" and codec is None and parameters is None
-
-        if easy_wav:
-            data = out_f
-        else:
-            data = NamedTemporaryFile(mode="wb", delete=False)
-
-        pcm_for_wav = self._data
-        if self.sample_width == 1:
-            # convert to unsigned integers for wav
-            pcm_for_wav = audioop.bias(self._data, 1, 128)
-
-        wave_data = wave.open(data, 'wb')
-        wave_data.setnchannels(self.channels)
-        wave_data.setsampwidth(self.sample_width)
-        wave_data.setframerate(self.frame_rate)
-        # For some reason packing the wave header struct with
-        # a float in python 2 doesn't throw an exception
-        wave_data.setnframes(int(self.frame_count()))
-        wave_data.writeframesraw(pcm_for_wav)
-        wave_data.close()
-
-        # for easy wav files, we're done (wav data is written directly to out_f)
-        if easy_wav:
+        if format == "wav" and codec is None and parameters is None:
+            out_f, _ = _fd_or_path_or_tempfile(out_f, 'wb+')
+            out_f.seek(0)
+            pcm_for_wav = self._data
+            if self.sample_width == 1:
+                # convert to unsigned integers for wav
+                pcm_for_wav = audioop.bias(self._data, 1, 128)
+
+            wave_data = wave.open(out_f, 'wb')
+            wave_data.setnchannels(self.channels)
+            wave_data.setsampwidth(self.sample_width)
+            wave_data.setframerate(self.frame_rate)
+            # For some reason packing the wave header struct with
+            # a float in python 2 doesn't throw an exception
+            wave_data.setnframes(int(self.frame_count()))
+            wave_data.writeframesraw(pcm_for_wav)
+            wave_data.close()
             out_f.seek(0)
             return out_f
 
-        output = NamedTemporaryFile(mode="w+b", delete=False)
+        # ffmpeg writes directly to a destination path. Anything else gets
+        # the encoded audio from ffmpeg's stdout.
+        output_path = None
+        if isinstance(out_f, (basestring, os.PathLike)):
+            output_path = os.fspath(out_f)
+            # Fail early, like pydub, if the destination cannot be written
+            open(output_path, 'wb').close()
 
         # build converter command to export
         conversion_command = [
             self.converter,
             '-y',  # always overwrite existing files
-            "-f", "wav", "-i", data.name,  # input options (filename last)
+            *self._raw_input_options(), "-i", "pipe:0",  # input options (pipe last)
         ]
 
         if codec is None:
@@ -216,78 +332,258 @@ class PatchedAudioSegment(AudioSegment):
             conversion_command.extend(["-write_xing", "0"])
 
         conversion_command.extend([
-            "-f", format, output.name,  # output options (filename last)
+            "-f", format, output_path or "pipe:1",  # output options (filename last)
         ])
 
         log_conversion(conversion_command)
-        
-        # read stdin / write stdout
-        with open(os.devnull, 'rb') as devnull:
-            p = subprocess.Popen(conversion_command, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p_out, p_err = p.communicate()
 
-        log_subprocess_output(p_out)
-        log_subprocess_output(p_err)
-
-        try:
-            if p.returncode != 0:
-                raise CouldntEncodeError(
-                    "Encoding failed. ffmpeg/avlib returned error code: {0}\n\nCommand:{1}\n\nOutput from ffmpeg/avlib:\n\n{2}".format(
-                        p.returncode, conversion_command, p_err.decode(errors='ignore') ))
+        if output_path is None:
+            out_f, _ = _fd_or_path_or_tempfile(out_f, 'wb+')
+            out_f.seek(0)
+        returncode, p_err = self._stream_through_ffmpeg(
+            conversion_command, output=out_f if output_path is None else None)
 
-            output.seek(0)
-            out_f.write(output.read())
+        log_subprocess_output(p_err)
 
-        finally:
-            data.close()
-            output.close()
-            os.unlink(data.name)
-            os.unlink(output.name)
+        if returncode != 0:
+            raise CouldntEncodeError(
+                "Encoding failed. ffmpeg/avlib returned error code: {0}\n\nCommand:{1}\n\nOutput from ffmpeg/avlib:\n\n{2}".format(
+                    returncode, conversion_command, p_err.decode(errors='ignore') ))
 
+        if output_path is not None:
+            out_f = open(output_path, 'rb')
         out_f.seek(0)
         return out_f
 
+    def export_many(self, outputs: list[dict]) -> list[str]:
+        """
+        Export an AudioSegment to several files with one ffmpeg process.
+        The samples are sent to ffmpeg once, and ffmpeg encodes every
+        output from the same decoded input.
+
+        outputs (list of dicts)
+            One dict per destination file, with the keys out_f (path),
+            format, and optionally codec, bitrate, parameters and tags,
+            as in export().
+
+        Returns the paths of the written files.
+        """
+        if not outputs:
+            return []
+        conversion_command = [
+            self.converter,
+            '-y',  # always overwrite existing files
+            *self._raw_input_options(), "-i", "pipe:0",  # input options (pipe last)
+        ]
+        output_paths = []
+        for output in outputs:
+            output_format = output.get('format', 'mp3')
+            if output_format == 'raw':
+                raise AttributeError(
+                    'Can not export "raw" with export_many; specify an ffmpeg '
+                    'raw format like format="s16le" instead')
+            output_path = os.fspath(output.get('out_f'))
+            # Fail early, like pydub, if the destination cannot be written
+            open(output_path, 'wb').close()
+            output_paths.append(output_path)
+
+            # Each output gets its own options, and maps the one input
+            conversion_command.extend(["-map", "0:a"])
+            codec = output.get('codec') or self.DEFAULT_CODECS.get(output_format)
+            if codec is not None:
+                conversion_command.extend(["-acodec", codec])
+            if output.get('bitrate') is not None:
+                conversion_command.extend(["-b:a", output.get('bitrate')])
+            if output.get('parameters') is not None:
+                conversion_command.extend(output.get('parameters'))
+            tags = output.get('tags')
+            if tags is not None:
+                if not isinstance(tags, dict):
+                    raise InvalidTag("Tags must be a dictionary.")
+                for key, value in tags.items():
+                    conversion_command.extend(
+                        ['-metadata', '{0}={1}'.format(key, value)])
+            if sys.platform == 'darwin' and codec == 'mp3':
+                conversion_command.extend(["-write_xing", "0"])
+            conversion_command.extend(["-f", output_format, output_path])
+
+        log_conversion(conversion_command)
+        returncode, p_err = self._stream_through_ffmpeg(conversion_command)
+        log_subprocess_output(p_err)
 
+        if returncode != 0:
+            raise CouldntEncodeError(
+                "Encoding failed. ffmpeg/avlib returned error code: {0}\n\nCommand:{1}\n\nOutput from ffmpeg/avlib:\n\n{2}".format(
+                    returncode, conversion_command, p_err.decode(errors='ignore') ))
+        return output_paths
+
+    def _raw_input_options(self) -> list[str]:
+        """ffmpeg options to read the raw samples of this segment"""
+        return ["-f", RAW_SAMPLE_FORMATS[self.sample_width],
+                "-ar", str(self.frame_rate), "-ac", str(self.channels)]
+
+    @staticmethod
+    def _read_into(stream, output: bytearray,
+                   chunk_size: int = STREAM_CHUNK_SIZE) -> None:
+        """Read a stream to the end into a bytearray in place, growing it
+        when it is full and trimming it to what was read, and close it"""
+        filled = 0
+        while True:
+            if filled == len(output):
+                output.extend(bytes(max(len(output) // 4, chunk_size)))
+            with memoryview(output) as view:
+                read = stream.readinto(view[filled:filled + chunk_size])
+            if not read:
+                break
+            filled += read
+        del output[filled:]
+        stream.close()
+
+    def _stream_through_ffmpeg(self, command: list, output=None,
+                               chunk_size: int = STREAM_CHUNK_SIZE,
+                               pass_fds: tuple = ()) -> tuple[int, bytes]:
+        """Run an ffmpeg command that reads the raw samples from stdin.
+
+        The samples are written in chunks from a thread, straight from the
+        segment's data, while the encoded audio on stdout (if any) is copied
+        to output in chunks. A bytearray output is read into in place, and
+        grown as needed. The file descriptors in pass_fds are passed on to
+        ffmpeg, and closed here. Returns the return code and the stderr
+        output."""
+        try:
+            p = subprocess.Popen(
+                command, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE if output is not None else subprocess.DEVNULL,
+                stderr=subprocess.PIPE, pass_fds=pass_fds)
+        finally:
+            # ffmpeg has copies of its own, and the readers of the other
+            # ends only see the end of the output once all copies are closed
+            for fd in pass_fds:
+                os.close(fd)
+
+        def _feed():
+            data = memoryview(self._data)
+            try:
+                for offset in range(0, len(data), chunk_size):
+                    p.stdin.write(data[offset:offset + chunk_size])
+            except (BrokenPipeError, OSError):
+                # ffmpeg quit early. The return code will tell why.
+                pass
+            finally:
+                try:
+                    p.stdin.close()
+                except (BrokenPipeError, OSError):
+                    pass
+
+        p_err = []
+        feeder = threading.Thread(target=_feed, daemon=True)
+        err_reader = threading.Thread(
+            target=lambda: p_err.append(p.stderr.read()), daemon=True)
+        feeder.start()
+        err_reader.start()
+        if isinstance(output, bytearray):
+            # Read straight into the buffer, growing it when it is full
+            self._read_into(p.stdout, output, chunk_size)
+        elif output is not None:
+            while chunk := p.stdout.read(chunk_size):
+                output.write(chunk)
+            p.stdout.close()
+        feeder.join()
+        err_reader.join()
+        p.stderr.close()
+        return p.wait(), b''.join(p_err)
+
+    def process_many_with_ffmpeg(self, filter_chains: list[str]) -> list[Self]:
+        """
+        Process an AudioSegment with several ffmpeg filter chains in one
+        ffmpeg process. The samples are sent to ffmpeg once, split with
+        asplit, and each chain writes raw samples of the same format to a
+        pipe of its own. Each pipe is read into a buffer of its own, sized
+        after the input, which the new segment reads its samples from.
 
+        ffmpeg is given the pipes as extra file descriptors, which needs
+        POSIX. On Windows, each chain is run with process_with_ffmpeg.
 
+        filter_chains (list of str)
+            One filter chain per result, eg. "rubberband=tempo=0.9".
+            An empty chain passes the audio on unchanged.
 
+        Returns one segment per filter chain, in the same order.
+        """
+        if not filter_chains:
+            return []
+        if sys.platform == 'win32':
+            return [self.process_with_ffmpeg(["-af", chain or 'anull'])
+                    for chain in filter_chains]
+        labels = [f"s{index}" for index in range(len(filter_chains))]
+        graph = ["[0:a]asplit={0}{1}".format(
+            len(filter_chains), "".join(f"[{label}]" for label in labels))]
+        for index, (label, chain) in enumerate(zip(labels, filter_chains)):
+            graph.append(f"[{label}]{chain or 'anull'}[o{index}]")
 
-    def process_with_ffmpeg(self, parameters: list = None, **kwargs) -> Self:
-        pcm_for_wav = self._data
-        if self.sample_width == 1:
-            # convert to unsigned integers for wav
-            pcm_for_wav = audioop.bias(self._data, 1, 128)
-
-        data = BytesIO()
-        # data = NamedTemporaryFile(mode="w+b", delete=False)
-        wave_data = wave.open(data, 'wb')
-        wave_data.setnchannels(self.channels)
-        wave_data.setsampwidth(self.sample_width)
-        wave_data.setframerate(self.frame_rate)
-        # For some reason packing the wave header struct with
-        # a float in python 2 doesn't throw an exception
-        wave_data.setnframes(int(self.frame_count()))
-        wave_data.writeframesraw(pcm_for_wav)
-        wave_data.close()
-        data.seek(0)
-
-        stdin_parameter = subprocess.PIPE
-        stdin_data = data.read()
+        conversion_command = [
+            self.converter,
+            *self._raw_input_options(), "-i", "pipe:0",  # input options (pipe last)
+            "-filter_complex", ";".join(graph),
+        ]
+        pipes = [os.pipe() for _ in filter_chains]
+        for index, (_, write_fd) in enumerate(pipes):
+            conversion_command.extend(
+                ["-map", f"[o{index}]", *self._raw_input_options(),
+                 f"pipe:{write_fd}"])
+
+        # ffmpeg writes the outputs as it goes, so they are all read at once
+        outputs = [bytearray(len(self._data)) for _ in filter_chains]
+        readers = [
+            threading.Thread(
+                target=self._read_into,
+                args=(os.fdopen(read_fd, 'rb', buffering=0), output),
+                daemon=True)
+            for (read_fd, _), output in zip(pipes, outputs)]
+        for reader in readers:
+            reader.start()
+        log_conversion(conversion_command)
+        try:
+            returncode, p_err = self._stream_through_ffmpeg(
+                conversion_command,
+                pass_fds=tuple(write_fd for _, write_fd in pipes))
+        finally:
+            for reader in readers:
+                reader.join()
+        log_subprocess_output(p_err)
 
-        # build converter command to export
-        conversion_command = [self.converter, "-f", "wav"]
+        if returncode != 0:
+            raise CouldntDecodeError(
+                "Decoding failed. ffmpeg returned error code: {0}\n\n"
+                "Command:{1}\n\nOutput from ffmpeg/avlib:\n\n{2}".format(
+                    returncode, conversion_command, p_err.decode(errors='ignore') ))
 
-        read_ahead_limit = kwargs.get('read_ahead_limit', -1)  # Unlimited
-        conversion_command.extend([
-            "-read_ahead_limit", str(read_ahead_limit), "-i", "cache:pipe:0",
-        ])
+        processed = []
+        for output in outputs:
+            # Drop a partial frame, if any
+            del output[len(output) - len(output) % self.frame_width:]
+            processed.append(self._spawn_buffer(output))
+        return processed
+
+    def process_with_ffmpeg(self, parameters: list = None, **kwargs) -> Self:
+        """
+        Process an AudioSegment with ffmpeg, eg. with parameters
+        ["-af", "rubberband=tempo=0.9"]. The samples are streamed to ffmpeg
+        and back as raw samples of the same format, so the input is never
+        copied, and the output is read into one buffer, sized after the
+        input, which the new segment reads its samples from.
+        """
+        conversion_command = [
+            self.converter,
+            *self._raw_input_options(), "-i", "pipe:0",  # input options (pipe last)
+        ]
 
         if parameters is not None:
             # extend arguments with arbitrary set
             conversion_command.extend(parameters)
 
         conversion_command.extend([
-            "-f", "wav", "-" # Stream output
+            *self._raw_input_options(), "-"  # Stream output
         ])
 
         # Quotes within the command is handled poorly on Windows.
@@ -297,22 +593,17 @@ class PatchedAudioSegment(AudioSegment):
 
         log_conversion(conversion_command)
 
-        p = subprocess.Popen(conversion_command, stdin=stdin_parameter,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p_out, p_err = p.communicate(input=stdin_data)
-
-        try:
-            if p.returncode != 0 or len(p_out) == 0:
-                raise CouldntDecodeError(
-                    "Decoding failed. ffmpeg returned error code: {0}\n\n"
-                    "Command:{1}\n\nOutput from ffmpeg/avlib:\n\n{1}".format(
-                        p.returncode, conversion_command, p_err.decode(errors='ignore') ))
+        p_out = bytearray(len(self._data))
+        returncode, p_err = self._stream_through_ffmpeg(
+            conversion_command, output=p_out)
+        log_subprocess_output(p_err)
 
-            p_out = bytearray(p_out)
-            fix_wav_headers(p_out)
-            p_out = bytes(p_out)
-            obj = self.__class__(p_out)
+        if returncode != 0 or len(p_out) == 0:
+            raise CouldntDecodeError(
+                "Decoding failed. ffmpeg returned error code: {0}\n\n"
+                "Command:{1}\n\nOutput from ffmpeg/avlib:\n\n{2}".format(
+                    returncode, conversion_command, p_err.decode(errors='ignore') ))
 
-        finally:
-            data.close()
-        return obj
+        # Drop a partial frame, if any, and keep the buffer as the samples
+        del p_out[len(p_out) - len(p_out) % self.frame_width:]
+        return self._spawn_buffer(p_out)
@@ -0,0 +1,130 @@
+"""The bars of a song, as arrays.
+
+The bar sequence used to be a list of {'number', 'start', 'end'} dicts,
+which had to be scanned to find a bar. A BarTable keeps the start and end
+times in NumPy arrays, finds a bar by its number in constant time, and
+keeps the effects and sections of the few bars that have them in separate
+sparse stores. It can still be turned into the list of dicts, eg. to export
+the state of a song as JSON.
+"""
+from typing import Iterator, Optional
+
+import numpy as np
+
+
+class BarTable:
+    def __init__(self, numbers: np.ndarray, starts: np.ndarray,
+                 ends: np.ndarray, effects: Optional[dict[int, list]] = None,
+                 sections: Optional[dict[int, str]] = None):
+        self.numbers = np.asarray(numbers, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.float64)
+        self.ends = np.asarray(ends, dtype=np.float64)
+        # Bar number -> row, for lookups by number
+        self.rows = {number: row for row, number in enumerate(self.numbers.tolist())}
+        # Bar number -> list of effect items, only for bars with effects
+        self.effects: dict[int, list[dict]] = effects or {}
+        # Bar number -> section name, only for bars in a section
+        self.sections: dict[int, str] = sections or {}
+        # Keep the values as given, so ints stay ints in exported state
+        self._starts = list(starts)
+        self._ends = list(ends)
+
+    def __repr__(self) -> str:
+        return (f"BarTable: {len(self)} bars, "
+                f"{len(self.effects)} with effects")
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def __iter__(self) -> Iterator[dict]:
+        for number in self.numbers.tolist():
+            yield self.bar(number)
+
+    def __contains__(self, number: int) -> bool:
+        return number in self.rows
+
+    @classmethod
+    def build(cls, prefix_length_ms: int | float, bar_length_ms: int | float,
+              audio_length_ms: int | float,
+              suffix_length_ms: int | float = 0) -> tuple['BarTable', int | float]:
+        """Lay out bars of bar_length_ms from the end of the prefix, until
+        less than a bar or only the suffix is left. Returns the table and
+        the remaining length, which is the suffix.
+        The positions are accumulated one bar at a time, so they are the
+        same floats as adding up the bar lengths in a loop."""
+        remainder = audio_length_ms - prefix_length_ms
+        if bar_length_ms <= 0:
+            raise ValueError(f"Invalid bar length: {bar_length_ms}")
+        max_bars = max(int(remainder // bar_length_ms), 0) + 1
+        remainders = np.subtract.accumulate(
+            np.array([remainder] + [bar_length_ms] * max_bars, dtype=np.float64))
+        stop = remainders < bar_length_ms
+        if suffix_length_ms:
+            stop |= remainders <= suffix_length_ms
+        bar_count = int(np.argmax(stop))
+        positions = np.add.accumulate(
+            np.array([prefix_length_ms] + [bar_length_ms] * bar_count,
+                     dtype=np.float64))
+        remainder = remainders[bar_count]
+        starts, ends = positions[:-1].tolist(), positions[1:].tolist()
+        if starts:
+            starts[0] = prefix_length_ms
+        if isinstance(prefix_length_ms, int) and isinstance(bar_length_ms, int):
+            starts, ends = [int(x) for x in starts], [int(x) for x in ends]
+        if (isinstance(audio_length_ms, int) and isinstance(prefix_length_ms, int)
+                and (isinstance(bar_length_ms, int) or not bar_count)):
+            remainder = int(remainder)
+        else:
+            remainder = float(remainder)
+        return cls(np.arange(1, bar_count + 1), starts, ends), remainder
+
+    @classmethod
+    def from_list(cls, bars: list[dict]) -> 'BarTable':
+        """Make a table of a list of bar dicts, as made by to_list()"""
+        return cls(
+            [bar.get('number') for bar in bars],
+            [bar.get('start') for bar in bars],
+            [bar.get('end') for bar in bars],
+            effects={bar.get('number'): [dict(x) for x in bar.get('effects')]
+                     for bar in bars if bar.get('effects')},
+            sections={bar.get('number'): bar.get('section')
+                      for bar in bars if bar.get('section')})
+
+    def to_list(self) -> list[dict]:
+        """Get the bars as a list of dicts"""
+        return list(self)
+
+    @property
+    def last_number(self) -> int:
+        return int(self.numbers.max()) if len(self) else 0
+
+    def bar(self, number: int) -> dict:
+        """Get a bar dict by its number. Raises KeyError if there is none."""
+        row = self.rows[number]
+        bar = {
+            'number': number,
+            'start': self._starts[row],
+            'end': self._ends[row],
+        }
+        if number in self.effects:
+            bar['effects'] = self.effects[number]
+        if number in self.sections:
+            bar['section'] = self.sections[number]
+        return bar
+
+    def select(self, numbers: list[int]) -> list[dict]:
+        """Get the bar dicts of some bar numbers, in bar order"""
+        return [self.bar(number) for number in sorted(set(numbers))
+                if number in self.rows]
+
+    def add_effect(self, number: int, effect_item: dict) -> None:
+        """Add an effect item to a bar, unless it has it already"""
+        bar_effects = self.effects.setdefault(number, [])
+        if effect_item not in bar_effects:  # prevent duplicates
+            bar_effects.append(effect_item)
+
+    def bars_with_effects(self) -> Iterator[dict]:
+        """The bars that have effects, in bar order"""
+        for number in sorted(self.effects):
+            if self.effects[number] and number in self.rows:
+                yield self.bar(number)
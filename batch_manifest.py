@@ -0,0 +1,91 @@
+"""A manifest of the jobs of a batch run, kept on disk.
+
+A batch renders a set of presets for a set of songs in one run. The manifest
+lists every job, a preset of a song, and records the status of each job as
+it finishes, so a batch that was stopped or crashed can be run again and
+only does the jobs that have not been done. The manifest is written
+atomically after every update, so a crash can not leave it half written.
+"""
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+import json
+import logging
+import os
+
+logger = logging.getLogger("songtwister.batch_manifest")
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def job_id(song: str, preset: str, version_name: str = '',
+           crossfade: Optional[int | str] = None) -> str:
+    """Get the id of the job of rendering a preset of a song. Jobs with
+    another version name or crossfade are separate jobs."""
+    parts = [song, preset]
+    if version_name:
+        parts.append(f"version-{version_name}")
+    if crossfade is not None:
+        parts.append(f"fade-{crossfade}")
+    return '/'.join(str(part) for part in parts)
+
+
+class BatchManifest:
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.jobs: dict[str, dict] = self._read()
+
+    def __repr__(self) -> str:
+        counts = ', '.join(f"{count} {status}"
+                           for status, count in self.counts().items())
+        return f"BatchManifest: {self.path} ({counts or 'no jobs'})"
+
+    def _read(self) -> dict[str, dict]:
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as reader:
+                    return json.loads(reader.read()).get('jobs', {})
+            except (ValueError, OSError) as e:
+                logger.warning("Could not read batch manifest %s: %s",
+                               self.path, e)
+        return {}
+
+    def save(self) -> None:
+        """Write the manifest atomically, so a crash does not corrupt it"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(temp_file, 'w') as writer:
+            writer.write(json.dumps({'jobs': self.jobs}, indent=2))
+        os.replace(temp_file, self.path)
+
+    def add(self, job: str, **info) -> None:
+        """Add a pending job, unless it is in the manifest already"""
+        if job not in self.jobs:
+            self.jobs[job] = {'status': PENDING, **info}
+
+    def status(self, job: str) -> Optional[str]:
+        entry = self.jobs.get(job)
+        return entry.get('status') if entry else None
+
+    def pending(self, jobs: list[str]) -> list[str]:
+        """Get the jobs that have not been done, in order"""
+        return [job for job in jobs if self.status(job) != DONE]
+
+    def mark(self, job: str, status: str, **info) -> None:
+        """Record the status of a job, with the time, and save the manifest"""
+        entry = self.jobs.setdefault(job, {})
+        entry.pop('error', None)
+        entry.update(status=status,
+                     finished=datetime.now().isoformat(timespec='seconds'),
+                     **info)
+        self.save()
+
+    def counts(self) -> dict[str, int]:
+        """Get the number of jobs of each status"""
+        counts: dict[str, int] = {}
+        for entry in self.jobs.values():
+            status = entry.get('status', PENDING)
+            counts[status] = counts.get(status, 0) + 1
+        return counts
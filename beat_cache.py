@@ -0,0 +1,105 @@
+"""In-memory cache of rendered beats, shared by the presets of a run.
+
+When many presets are rendered from the same song, the same effects are
+often applied to the same beats, eg. reverse on beat 4 of 4 or speedup 2
+on every other beat. The cache keeps the rendered audio of each beat,
+keyed by the source audio, the span of the beat and its effect chain, so
+it is only rendered once. When the cache grows past its size limit, the
+least recently used beats are evicted.
+"""
+from collections import OrderedDict, namedtuple
+from typing import Callable, Hashable, Optional
+import logging
+import weakref
+
+from audio_view import AudioView
+
+logger = logging.getLogger("songtwister.beat_cache")
+
+BeatCacheStats = namedtuple("BeatCacheStats", ["hits", "misses", "evictions"])
+
+
+def hit_rate(stats: BeatCacheStats) -> float:
+    lookups = stats.hits + stats.misses
+    return stats.hits / lookups if lookups else 0.0
+
+
+def log_stats(stats: BeatCacheStats) -> None:
+    logger.info("Beat cache: %s hits, %s misses (%.0f%% hit rate), %s evicted",
+                stats.hits, stats.misses, hit_rate(stats) * 100,
+                stats.evictions)
+
+
+class BeatCache:
+    def __init__(self, max_size_mb: int | float = 256):
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.entries: OrderedDict[tuple, object] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The ids of the source audio. The entries of a source are dropped
+        # when it is garbage collected, before its id can be reused.
+        self._sources: set[int] = set()
+
+    def __repr__(self) -> str:
+        return (f"BeatCache: {len(self.entries)} beats, "
+                f"{self.size / 1024 / 1024:.1f} MB, {self.hits} hits, "
+                f"{self.misses} misses")
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> BeatCacheStats:
+        return BeatCacheStats(self.hits, self.misses, self.evictions)
+
+    def _source_key(self, source) -> int:
+        source_id = id(source)
+        if source_id not in self._sources:
+            self._sources.add(source_id)
+            weakref.finalize(source, self._drop_source, source_id)
+        return source_id
+
+    def _drop_source(self, source_id: int) -> None:
+        for key in [key for key in self.entries if key[0] == source_id]:
+            self._remove(key)
+        self._sources.discard(source_id)
+
+    def _remove(self, key: tuple) -> None:
+        audio = self.entries.pop(key)
+        self.size -= len(audio.raw_data)
+
+    def contains(self, source, key: Hashable) -> bool:
+        """Check if the rendered beat of a key for some source is stored"""
+        return (id(source), key) in self.entries
+
+    def get_or_render(self, source, key: Hashable,
+                      render: Callable[[], Optional[object]]) -> Optional[object]:
+        """Get the rendered beat of a key for some source audio, or render
+        and store it. Only AudioSegments are stored: None (a beat left out)
+        and views of the source are cheap to render again."""
+        full_key = (self._source_key(source), key)
+        audio = self.entries.get(full_key)
+        if audio is not None:
+            self.entries.move_to_end(full_key)
+            self.hits += 1
+            return audio
+        self.misses += 1
+        audio = render()
+        if audio is not None and not isinstance(audio, AudioView):
+            self._store(full_key, audio)
+        return audio
+
+    def _store(self, key: tuple, audio) -> None:
+        size = len(audio.raw_data)
+        if size > self.max_size:
+            return
+        self.entries[key] = audio
+        self.size += size
+        while self.size > self.max_size:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
@@ -0,0 +1,9 @@
+"""Benchmarks of the render pipeline, on synthetic songs.
+
+Run them from the root of the repository with `python -m benchmarks`. The
+songs are click tracks made in memory (see synthetic.py), so no audio files
+are needed. The cases (see cases.py) render every effect preset, scale the
+bar and beat logic and the rendering up to tens of thousands of bars and 64
+beats per bar, and time the audio primitives. The timings are written to a
+JSON file, which can be compared against a stored baseline (see results.py).
+"""
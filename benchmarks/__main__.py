@@ -0,0 +1,201 @@
+"""Run the benchmarks, and compare them with a baseline.
+
+    python -m benchmarks                      Run every suite
+    python -m benchmarks --suite scaling      Run one suite
+    python -m benchmarks -k 'presets/swing*'  Run the cases matching a pattern
+    python -m benchmarks --save-baseline      Run, and keep the results as
+                                              the baseline
+    python -m benchmarks --compare FILE       Compare earlier results with
+                                              the baseline, without running
+
+The exit code is 1 if any case is slower than the baseline by more than the
+threshold.
+"""
+from pathlib import Path
+import argparse
+import fnmatch
+import logging
+import shutil
+import sys
+import tempfile
+
+from benchmarks import cases
+from benchmarks.results import (REGRESSION, compare, format_comparisons,
+                                measure, read_results, write_results)
+from benchmarks.synthetic import synthetic_song
+import run
+
+logger = logging.getLogger("songtwister.benchmarks")
+
+BENCHMARKS_DIR = Path(__file__).parent
+QUICK_BARS = (1000, 5000)
+QUICK_SUBDIVISIONS = (4, 16, 64)
+QUICK_SONG_BARS = 32
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmarks of the render pipeline, on synthetic songs.")
+    parser.add_argument("--suite", action="append", choices=cases.SUITES,
+                        help="A suite to run. May be repeated. "
+                        "Default is every suite.")
+    parser.add_argument("-k", "--filter", metavar="PATTERN",
+                        help="Only run the cases whose names match the "
+                        "pattern, eg. 'scaling/apply_effects/*'.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times to run each case. "
+                        "The fastest run is its time. Default is 3.")
+    parser.add_argument("--quick", action="store_true",
+                        help=f"Run each case once, on a song of "
+                        f"{QUICK_SONG_BARS} bars, with fewer sizes in the "
+                        "scaling suite.")
+    parser.add_argument("--song-bars", type=int, default=96,
+                        help="Number of bars of the song of the presets, "
+                        "subdivisions and primitives. Default is 96.")
+    parser.add_argument("--bpm", type=float, default=120.0,
+                        help="Tempo of the synthetic songs. Default is 120.")
+    parser.add_argument("--frame-rate", type=int, default=44100,
+                        help="Frame rate of the song. Default is 44100.")
+    parser.add_argument("--channels", type=int, default=2,
+                        help="Number of channels of the song. Default is 2.")
+    parser.add_argument("--sample-width", type=int, default=2,
+                        choices=(1, 2, 4),
+                        help="Bytes per sample of the songs. Default is 2.")
+    parser.add_argument("--bars", type=int, nargs='+',
+                        help="Numbers of bars of the scaling suite. "
+                        "Default is "
+                        f"{' '.join(map(str, cases.SCALING_BARS))}.")
+    parser.add_argument("--subdivisions", type=int, nargs='+',
+                        help="Beats per bar of the scaling suite. Default is "
+                        f"{' '.join(map(str, cases.SCALING_SUBDIVISIONS))}.")
+    parser.add_argument("--scaling-frame-rate", type=int, default=8000,
+                        help="Frame rate of the long songs of the scaling "
+                        "suite. Default is 8000.")
+    parser.add_argument("--scaling-channels", type=int, default=1,
+                        help="Number of channels of the long songs of the "
+                        "scaling suite. Default is 1.")
+    parser.add_argument("--max-audio-mb", type=float, default=256,
+                        help="Skip rendering long songs with more audio than "
+                        "this. Default is 256.")
+    parser.add_argument("-o", "--output", type=Path,
+                        default=BENCHMARKS_DIR / 'results.json',
+                        help="The file to write the results to. "
+                        "Default is benchmarks/results.json.")
+    parser.add_argument("--baseline", type=Path,
+                        default=BENCHMARKS_DIR / 'baseline.json',
+                        help="The results to compare with, if the file "
+                        "exists. Default is benchmarks/baseline.json.")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Also write the results to the baseline file.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="How much slower a case may be than the baseline "
+                        "before it is a regression, as a fraction. "
+                        "Default is 0.1.")
+    parser.add_argument("--compare", metavar="RESULTS", type=Path,
+                        help="Compare a results file with the baseline, "
+                        "instead of running the benchmarks.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Show the logging of the rendering.")
+    return parser.parse_args()
+
+
+def make_cases(args: argparse.Namespace, work_dir: Path) -> list[cases.Case]:
+    """Get the cases of the selected suites"""
+    suites = args.suite or cases.SUITES
+    song_params = {
+        'bars': args.song_bars,
+        'frame_rate': args.frame_rate,
+        'channels': args.channels,
+    }
+    song = cases.lazy(lambda: synthetic_song(
+        args.song_bars, bpm=args.bpm, frame_rate=args.frame_rate,
+        channels=args.channels, sample_width=args.sample_width))
+    selected = []
+    if 'presets' in suites:
+        config = run.read_yaml('config.yml')
+        presets = run.read_yaml(config.get('locations').get('presets'))
+        selected.extend(cases.preset_cases(
+            presets, song, config.get('preferences').get('crossfade'),
+            song_params))
+    if 'scaling' in suites:
+        selected.extend(cases.scaling_cases(
+            song, song_params,
+            bar_counts=tuple(args.bars or (
+                QUICK_BARS if args.quick else cases.SCALING_BARS)),
+            subdivisions=tuple(args.subdivisions or (
+                QUICK_SUBDIVISIONS if args.quick
+                else cases.SCALING_SUBDIVISIONS)),
+            bpm=args.bpm, sample_width=args.sample_width,
+            scaling_frame_rate=args.scaling_frame_rate,
+            scaling_channels=args.scaling_channels,
+            max_audio_mb=args.max_audio_mb))
+    if 'primitives' in suites:
+        selected.extend(cases.primitive_cases(song, work_dir, song_params))
+    if args.filter:
+        selected = [case for case in selected
+                    if fnmatch.fnmatch(case.name, args.filter)]
+    return selected
+
+
+def report(results: dict[str, dict], baseline_path: Path,
+           threshold: float) -> int:
+    """Log the comparison with the baseline. Returns the exit code."""
+    if not baseline_path.exists():
+        logger.info("No baseline at %s to compare with", baseline_path)
+        return 0
+    comparisons = compare(results, read_results(baseline_path), threshold)
+    print(format_comparisons(comparisons))
+    regressions = [comparison for comparison in comparisons
+                   if comparison.status == REGRESSION]
+    if regressions:
+        logger.warning("%s of %s cases are more than %.0f%% slower than "
+                       "the baseline", len(regressions), len(comparisons),
+                       threshold * 100)
+        return 1
+    return 0
+
+
+def main() -> int:
+    args = get_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format='%(asctime)s %(levelname)s [%(name)s] - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S')
+    logger.setLevel(logging.INFO)
+
+    if args.compare:
+        return report(read_results(args.compare), args.baseline,
+                      args.threshold)
+
+    repeat = 1 if args.quick else max(args.repeat, 1)
+    if args.quick:
+        args.song_bars = QUICK_SONG_BARS
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='songtwister-benchmarks-') as work_dir:
+        selected = make_cases(args, Path(work_dir))
+        logger.info("Running %s cases", len(selected))
+        for number, case in enumerate(selected, 1):
+            result = measure(case, repeat)
+            results[case.name] = result
+            if 'seconds' in result:
+                outcome = f"{result['seconds']:.4f} s"
+            else:
+                outcome = result.get('skipped') or result.get('error')
+            logger.info("[%s/%s] %s: %s", number, len(selected), case.name,
+                        outcome)
+
+    settings = {name: (list(value) if isinstance(value, tuple) else value)
+                for name, value in vars(args).items()
+                if name not in ('output', 'baseline', 'compare')}
+    write_results(args.output, results, settings)
+    logger.info("Wrote the results to %s", args.output)
+    exit_code = report(results, args.baseline, args.threshold)
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        logger.info("Saved the results as the baseline %s", args.baseline)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
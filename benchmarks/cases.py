@@ -0,0 +1,242 @@
+"""The benchmark cases.
+
+Each case times one call, on a state made by its setup before every run,
+which is not timed. The cases are grouped in suites:
+
+- presets: apply_preset with every preset in the presets file, on a song of
+  song_bars bars, as run.py renders them before exporting.
+- scaling: build_bar_sequence, perform_selection and apply_effects on songs
+  of 1k to 50k bars, and apply_effects with 4 to 64 beats per bar. The long
+  songs are made at a low frame rate, and apply_effects is skipped on songs
+  with more audio than max_audio_mb.
+- primitives: PatchedAudioSegment.append with each crossfade curve, export
+  to several formats, and _calculate_peaks on audio it has not seen.
+"""
+from collections import namedtuple
+from functools import partial
+from pathlib import Path
+from typing import Callable, Optional
+import copy
+import random
+
+from crossfade import CURVES as CROSSFADE_CURVES
+from songtwister import SongTwister
+import run
+from benchmarks.synthetic import synthetic_song
+
+# One benchmark. run is timed, with the result of setup, if any. params
+# describe the size of the case. Cases with a skip reason are not run.
+Case = namedtuple("Case", ["name", "run", "setup", "params", "skip"],
+                  defaults=(None, None, None))
+
+SUITES = ('presets', 'scaling', 'primitives')
+SCALING_BARS = (1000, 5000, 10000, 50000)
+SCALING_SUBDIVISIONS = (4, 8, 16, 32, 64)
+SELECTIONS = {
+    'every-3-of-4': 'every 3 of 4',
+    'odd': 'odd',
+    'ranges': '1-100, 200-300, 1000-',
+    'random-100': 'random 100',
+}
+APPEND_SEGMENTS = 64  # The number of beats joined in the append cases
+APPEND_CROSSFADE_MS = 10
+EXPORT_FORMATS = ('wav', 'flac', 'mp3')
+PEAKS_RESOLUTIONS = (400, 4000)
+
+
+def scaling_effects(beats_per_bar: int) -> list[dict]:
+    """Effects that cut every bar into beats_per_bar beats"""
+    return [{
+        'effect': 'remove',
+        'bars': 'all',
+        'beats': 'every 4 of 4',
+        'beats_per_bar': beats_per_bar,
+    }, {
+        'effect': 'reverse',
+        'bars': 'odd',
+        'beats': 'every 3 of 4',
+        'beats_per_bar': beats_per_bar,
+    }]
+
+
+def lazy(make: Callable) -> Callable:
+    """Get a function that calls make the first time, and then returns the
+    same result"""
+    made = []
+
+    def get():
+        if not made:
+            made.append(make())
+        return made[0]
+    return get
+
+
+def _audio_mb(bars: int, bpm: float, beats_per_bar: int, frame_rate: int,
+              channels: int, sample_width: int) -> float:
+    seconds = bars * beats_per_bar * 60 / bpm
+    return seconds * frame_rate * channels * sample_width / 1024 / 1024
+
+
+# RUNS
+def _apply_preset(state: tuple) -> SongTwister:
+    song_object, _ = run.apply_preset(*state)
+    return song_object
+
+
+def _preset_state(song: Callable[[], SongTwister], preset: str,
+                  preset_data: dict, default_crossfade: int | str) -> tuple:
+    # The preset is changed by its edits, so each run gets a copy
+    return song(), preset, copy.deepcopy(preset_data), None, default_crossfade
+
+
+def _build_bar_sequence(song: SongTwister) -> None:
+    song.build_bar_sequence()
+
+
+def _perform_selection(criteria, state: tuple) -> list[int]:
+    items, rng = state
+    return SongTwister.perform_selection(items, criteria, rng)
+
+
+def _selection_state(bars: int) -> tuple:
+    return list(range(1, bars + 1)), random.Random(0)
+
+
+def _apply_effects(song: SongTwister) -> SongTwister:
+    return song.apply_effects()
+
+
+def _song_with_effects(song: SongTwister, effects: list[dict]) -> SongTwister:
+    song_object = song.spawn_new_instance()
+    song_object.add_effects(copy.deepcopy(effects))
+    return song_object
+
+
+def _append(state: tuple):
+    segments, curve = state
+    joined = segments[0]
+    for segment in segments[1:]:
+        joined = joined.append(segment, crossfade=APPEND_CROSSFADE_MS,
+                               curve=curve)
+    return joined
+
+
+def _export(state: tuple) -> None:
+    audio, path, output_format = state
+    audio.export(out_f=path, format=output_format).close()
+
+
+def _calculate_peaks(resolution: int, state: tuple) -> list[int]:
+    song, audio = state
+    return song._calculate_peaks(audio, resolution)
+
+
+def _fresh_audio(song: SongTwister) -> tuple:
+    # The peaks of an audio segment are kept, so each run gets a new one
+    return song, song.audio._spawn(song.audio.raw_data)
+
+
+# SUITES
+def preset_cases(presets: dict, song: Callable[[], SongTwister],
+                 default_crossfade: int | str,
+                 params: Optional[dict] = None) -> list[Case]:
+    """A case for each preset, applied to the song returned by song"""
+    cases = []
+    for preset in sorted(presets):
+        preset_data = presets[preset]
+        if not preset_data:
+            cases.append(Case(f"presets/{preset}", None, params=params,
+                              skip="the preset is empty"))
+            continue
+        cases.append(Case(
+            f"presets/{preset}", _apply_preset,
+            partial(_preset_state, song, preset, preset_data,
+                    default_crossfade), params))
+    return cases
+
+
+def scaling_cases(song: Callable[[], SongTwister],
+                  params: Optional[dict] = None,
+                  bar_counts: tuple[int, ...] = SCALING_BARS,
+                  subdivisions: tuple[int, ...] = SCALING_SUBDIVISIONS,
+                  bpm: float = 120.0, sample_width: int = 2,
+                  scaling_frame_rate: int = 8000, scaling_channels: int = 1,
+                  max_audio_mb: int | float = 256) -> list[Case]:
+    """Cases of songs with more and more bars, at scaling_frame_rate, and of
+    the song returned by song cut into more and more beats"""
+    cases = []
+    for bars in bar_counts:
+        case_params = {'bars': bars}
+        cases.append(Case(
+            f"scaling/build_bar_sequence/bars-{bars}", _build_bar_sequence,
+            partial(synthetic_song, bars, bpm=bpm, with_audio=False),
+            case_params))
+        for label, criteria in SELECTIONS.items():
+            cases.append(Case(
+                f"scaling/perform_selection/{label}/bars-{bars}",
+                partial(_perform_selection, criteria),
+                partial(_selection_state, bars), case_params))
+
+    bar_effects = scaling_effects(16)
+    for bars in bar_counts:
+        name = f"scaling/apply_effects/bars-{bars}"
+        case_params = {'bars': bars, 'beats_per_bar': 16,
+                       'frame_rate': scaling_frame_rate,
+                       'channels': scaling_channels}
+        audio_mb = _audio_mb(bars, bpm, 4, scaling_frame_rate,
+                             scaling_channels, sample_width)
+        if audio_mb > max_audio_mb:
+            cases.append(Case(name, None, params=case_params, skip=(
+                f"{audio_mb:.0f} MB of audio is more than {max_audio_mb} MB")))
+            continue
+        # The audio is made when the case is first set up, and kept
+        long_song = lazy(partial(
+            synthetic_song, bars, bpm=bpm, frame_rate=scaling_frame_rate,
+            channels=scaling_channels, sample_width=sample_width))
+        cases.append(Case(
+            name, _apply_effects,
+            lambda long_song=long_song: _song_with_effects(long_song(),
+                                                           bar_effects),
+            case_params))
+
+    for beats_per_bar in subdivisions:
+        effects = scaling_effects(beats_per_bar)
+        cases.append(Case(
+            f"scaling/apply_effects/subdivisions-{beats_per_bar}",
+            _apply_effects,
+            lambda effects=effects: _song_with_effects(song(), effects),
+            {**(params or {}), 'beats_per_bar': beats_per_bar}))
+    return cases
+
+
+def primitive_cases(song: Callable[[], SongTwister], work_dir: Path,
+                    params: Optional[dict] = None) -> list[Case]:
+    """Cases of the audio operations, on the audio of the song returned by
+    song. Exported files are written to work_dir."""
+    cases = []
+
+    def slice_beats():
+        audio, beat_ms = song().audio, song().beat_length_ms
+        return [audio[index * beat_ms:(index + 1) * beat_ms]
+                for index in range(APPEND_SEGMENTS)]
+
+    segments = lazy(slice_beats)
+    for curve in CROSSFADE_CURVES:
+        cases.append(Case(
+            f"primitives/append/{curve}", _append,
+            lambda curve=curve: (segments(), curve),
+            {'segments': APPEND_SEGMENTS, 'crossfade_ms': APPEND_CROSSFADE_MS}))
+    for output_format in EXPORT_FORMATS:
+        cases.append(Case(
+            f"primitives/export/{output_format}", _export,
+            lambda output_format=output_format: (
+                song().audio, work_dir / f"export.{output_format}",
+                output_format), params))
+    for resolution in PEAKS_RESOLUTIONS:
+        cases.append(Case(
+            f"primitives/calculate_peaks/resolution-{resolution}",
+            partial(_calculate_peaks, resolution),
+            lambda: _fresh_audio(song()),
+            {**(params or {}), 'resolution': resolution}))
+    return cases
+
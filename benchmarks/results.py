@@ -0,0 +1,142 @@
+"""Timing the benchmark cases, and comparing the results with a baseline.
+
+Each case is run repeat times, and the fastest run is its time, as the
+slower runs are mostly slowed down by other things happening on the
+machine. The results are written to a JSON file with the environment they
+were measured in. Compared with a baseline, a case is a regression if it
+takes more than threshold longer, and an improvement if it takes more than
+threshold less. Cases that take less than NOISE_FLOOR both times are too
+short to tell, and are not flagged.
+"""
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+import gc
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.cases import Case
+
+logger = logging.getLogger("songtwister.benchmarks")
+
+NOISE_FLOOR = 0.001  # Seconds
+
+REGRESSION = 'regression'
+IMPROVEMENT = 'improvement'
+UNCHANGED = 'unchanged'
+NEW = 'new'
+MISSING = 'missing'
+
+Comparison = namedtuple("Comparison",
+                        ["name", "baseline", "current", "ratio", "status"])
+
+
+def measure(case: Case, repeat: int = 3) -> dict:
+    """Time a case. Returns its result, with the fastest and the median
+    time in seconds, or the reason it was skipped or the error it raised."""
+    result = {'params': case.params or {}}
+    if case.skip:
+        result['skipped'] = case.skip
+        return result
+    times = []
+    try:
+        for _ in range(repeat):
+            state = case.setup() if case.setup else None
+            gc.collect()
+            start = time.perf_counter()
+            if case.setup:
+                case.run(state)
+            else:
+                case.run()
+            times.append(time.perf_counter() - start)
+            del state
+    except Exception as e:
+        logger.warning("%s failed: %r", case.name, e)
+        result['error'] = repr(e)
+        return result
+    result.update(seconds=min(times), median=statistics.median(times),
+                  runs=len(times))
+    return result
+
+
+def environment() -> dict:
+    """Describe what the results were measured on"""
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'argv': sys.argv[1:],
+    }
+
+
+def write_results(path: str | Path, results: dict[str, dict],
+                  settings: Optional[dict] = None) -> None:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as writer:
+        writer.write(json.dumps({
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'environment': environment(),
+            'settings': settings or {},
+            'results': results,
+        }, indent=2))
+
+
+def read_results(path: str | Path) -> dict[str, dict]:
+    with open(path, 'r') as reader:
+        return json.loads(reader.read()).get('results', {})
+
+
+def compare(current: dict[str, dict], baseline: dict[str, dict],
+            threshold: float = 0.1,
+            noise_floor: float = NOISE_FLOOR) -> list[Comparison]:
+    """Compare the timed cases of two results, in the order of current,
+    followed by the cases that are only in the baseline"""
+    comparisons = []
+    for name, result in current.items():
+        seconds = result.get('seconds')
+        if seconds is None:
+            continue
+        before = baseline.get(name, {}).get('seconds')
+        if before is None:
+            comparisons.append(Comparison(name, None, seconds, None, NEW))
+            continue
+        ratio = seconds / before if before else float('inf')
+        status = UNCHANGED
+        if before >= noise_floor or seconds >= noise_floor:
+            if ratio > 1 + threshold:
+                status = REGRESSION
+            elif ratio < 1 - threshold:
+                status = IMPROVEMENT
+        comparisons.append(Comparison(name, before, seconds, ratio, status))
+    for name, result in baseline.items():
+        if result.get('seconds') is not None and current.get(
+                name, {}).get('seconds') is None:
+            comparisons.append(Comparison(
+                name, result.get('seconds'), None, None, MISSING))
+    return comparisons
+
+
+def format_comparisons(comparisons: list[Comparison]) -> str:
+    """A table of the comparisons, one case per line"""
+    width = max((len(comparison.name) for comparison in comparisons),
+                default=4)
+    lines = [f"{'case':<{width}}  {'baseline':>10}  {'current':>10}  "
+             f"{'ratio':>7}  status"]
+    for name, before, seconds, ratio, status in comparisons:
+        lines.append(
+            f"{name:<{width}}  "
+            f"{'' if before is None else f'{before:.4f}':>10}  "
+            f"{'' if seconds is None else f'{seconds:.4f}':>10}  "
+            f"{'' if ratio is None else f'{ratio:.2f}x':>7}  {status}")
+    return '\n'.join(lines)
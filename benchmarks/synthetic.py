@@ -0,0 +1,85 @@
+"""Synthetic click-track songs.
+
+A click track has a short decaying tone at the start of every beat, higher on
+the first beat of each bar, over a quiet noise floor, so every beat and bar
+boundary is audible and no part of the audio is digital silence. The audio
+is made with NumPy in any length, frame rate, channel count and sample width,
+and the songs are made with it in memory, without a file.
+"""
+from typing import Optional
+
+import numpy as np
+
+from audiosegment_patch import PatchedAudioSegment as AudioSegment
+from render_engine import SAMPLE_DTYPES
+from songtwister import SongTwister
+
+CLICK_MS = 30  # The length of a click
+CLICK_HZ = 1000  # The tone of the clicks
+DOWNBEAT_HZ = 1500  # The tone of the click on the first beat of a bar
+CLICK_LEVEL = 0.5  # The peak of a click, as a fraction of full scale
+NOISE_LEVEL = 0.003  # The level of the noise floor
+
+
+def _click(frames: int, frame_rate: int, hz: float) -> np.ndarray:
+    """A tone that decays to almost nothing over frames frames"""
+    position = np.arange(frames)
+    return (np.sin(2 * np.pi * hz * position / frame_rate)
+            * np.exp(-6 * position / max(frames, 1)))
+
+
+def click_track(bars: int, bpm: float = 120.0, beats_per_bar: int = 4,
+                frame_rate: int = 44100, channels: int = 2,
+                sample_width: int = 2, prefix_ms: int | float = 0,
+                suffix_ms: int | float = 0, seed: int = 0) -> AudioSegment:
+    """Make a click track of a number of bars, after prefix_ms of noise and
+    followed by suffix_ms of noise. The channels get slightly different
+    levels, so they are not identical."""
+    beat_frames = 60 / bpm * frame_rate
+    prefix_frames = int(prefix_ms * frame_rate / 1000)
+    beats = bars * beats_per_bar
+    frames = (prefix_frames + int(round(beats * beat_frames))
+              + int(suffix_ms * frame_rate / 1000))
+    rng = np.random.default_rng(seed)
+    signal = rng.normal(0, NOISE_LEVEL, frames).astype(np.float32)
+
+    click_frames = min(int(CLICK_MS * frame_rate / 1000), int(beat_frames))
+    clicks = np.stack((_click(click_frames, frame_rate, DOWNBEAT_HZ),
+                       _click(click_frames, frame_rate, CLICK_HZ)))
+    starts = prefix_frames + np.rint(np.arange(beats) * beat_frames).astype(
+        np.int64)
+    kinds = (np.arange(beats) % beats_per_bar != 0).astype(np.int64)
+    positions = starts[:, None] + np.arange(click_frames)
+    signal[positions] += CLICK_LEVEL * clicks[kinds]
+
+    dtype = SAMPLE_DTYPES[sample_width]
+    info = np.iinfo(dtype)
+    gains = np.linspace(1.0, 0.8, channels, dtype=np.float32)
+    samples = np.clip(np.rint(signal[:, None] * gains * info.max),
+                      info.min, info.max).astype(dtype)
+    return AudioSegment(samples.tobytes(), sample_width=sample_width,
+                        frame_rate=frame_rate, channels=channels)
+
+
+def synthetic_song(bars: int = 96, bpm: float = 120.0, beats_per_bar: int = 4,
+                   frame_rate: int = 44100, channels: int = 2,
+                   sample_width: int = 2, prefix_ms: int | float = 0,
+                   with_audio: bool = True, seed: Optional[int] = 0,
+                   **kwargs) -> SongTwister:
+    """Make a song of a click track. Without audio, the song only has the
+    length of the track, which is enough to lay out and select bars.
+    Other keyword arguments are passed on to SongTwister."""
+    bar_ms = 60000 / bpm * beats_per_bar
+    audio = None
+    audio_length_ms = prefix_ms + bars * bar_ms
+    if with_audio:
+        audio = click_track(bars, bpm=bpm, beats_per_bar=beats_per_bar,
+                            frame_rate=frame_rate, channels=channels,
+                            sample_width=sample_width, prefix_ms=prefix_ms)
+        audio_length_ms = len(audio)
+    bitrate = f"{frame_rate * channels * sample_width * 8 // 1000}k"
+    return SongTwister(
+        filename=f"synthetic_{bars}-bars.wav", bpm=bpm,
+        beats_per_bar=beats_per_bar, audio=audio, load_audio=False,
+        audio_length_ms=audio_length_ms, prefix_length_ms=prefix_ms,
+        bitrate=bitrate, seed=seed, **kwargs)
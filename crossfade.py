@@ -0,0 +1,46 @@
+"""Sample-level crossfades, mixed with NumPy.
+
+AudioSegment.append crossfades with two fade() calls and an overlay, which
+step the gain once per ms on fades longer than 100 ms. The curves here
+compute a gain for every frame and mix the two overlapping ends in one pass.
+"""
+import numpy as np
+
+# 'stepped' is the linear fade of AudioSegment.append, stepped per ms
+CURVES = ('stepped', 'linear', 'equal_power')
+
+
+def crossfade_gains(frames: int, curve: str) -> tuple[np.ndarray, np.ndarray]:
+    """Get the gains of the fade out and the fade in of a crossfade over
+    a number of frames. The gains are sampled at the middle of each frame,
+    so the fade is symmetric."""
+    position = (np.arange(frames) + 0.5) / max(frames, 1)
+    if curve == 'linear':
+        return 1.0 - position, position
+    if curve == 'equal_power':
+        angle = position * (np.pi / 2)
+        return np.cos(angle), np.sin(angle)
+    raise ValueError(f"Unknown crossfade curve: {curve}")
+
+
+def mix_crossfade(fade_out: np.ndarray, fade_in: np.ndarray,
+                  curve: str) -> np.ndarray:
+    """Mix two (frames, channels) sample arrays of the same shape and
+    dtype, fading the first out and the second in."""
+    out_gain, in_gain = crossfade_gains(len(fade_out), curve)
+    mixed = (fade_out * out_gain[:, None]) + (fade_in * in_gain[:, None])
+    info = np.iinfo(fade_out.dtype)
+    return np.clip(np.rint(mixed), info.min, info.max).astype(fade_out.dtype)
+
+
+def join_crossfaded(first: np.ndarray, second: np.ndarray, frames: int,
+                    curve: str) -> np.ndarray:
+    """Join two sample arrays, overlapping the given number of frames
+    with a crossfade, into one new array."""
+    frames = min(frames, len(first), len(second))
+    keep = len(first) - frames
+    joined = np.empty((keep + len(second), first.shape[1]), dtype=first.dtype)
+    joined[:keep] = first[:keep]
+    joined[keep:len(first)] = mix_crossfade(first[keep:], second[:frames], curve)
+    joined[len(first):] = second[frames:]
+    return joined
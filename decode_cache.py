@@ -0,0 +1,230 @@
+"""On-disk cache of decoded audio.
+
+Decoding an mp3 with ffmpeg is the slowest part of loading a song, and the
+same songs are loaded again and again while tuning presets. The cache keeps
+the decoded PCM of each input file as a raw .pcm file next to a small .json
+file with the format, so it can be memory-mapped back without ffmpeg. The
+loaded audio reads its samples straight from the map, so they are only read
+from disk as they are used.
+
+Entries are keyed by the hash of the file content. The index also records
+the path, size and modification time of each input file, so an unchanged
+file does not have to be hashed again. When the cache grows past its size
+limit, the least recently used entries are evicted, except for the ones
+that are still mapped, as not every system can remove a mapped file.
+"""
+from collections import defaultdict
+from pathlib import Path
+from typing import Optional
+import hashlib
+import json
+import logging
+import mmap
+import os
+import time
+import weakref
+
+from audiosegment_patch import PatchedAudioSegment as AudioSegment
+
+logger = logging.getLogger("songtwister.decode_cache")
+
+INDEX_FILE = 'index.json'
+
+
+def hash_file(path: str | Path, chunk_size: int = 1 << 20) -> str:
+    """Get a hash of the content of a file"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as reader:
+        while chunk := reader.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DecodeCache:
+    def __init__(self, path: str | Path, max_size_mb: int | float = 2048):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.index = self._read_index()
+        # The maps of each entry handed out by map(), while they are in use
+        self._maps: defaultdict[str, weakref.WeakSet] = defaultdict(
+            weakref.WeakSet)
+
+    def __repr__(self) -> str:
+        return (f"DecodeCache: {self.path} ({len(self.index['entries'])} "
+                f"entries, {self.size() / 1024 / 1024:.0f} MB)")
+
+    # INDEX
+    def _read_index(self) -> dict:
+        index_file = self.path / INDEX_FILE
+        if index_file.exists():
+            try:
+                with open(index_file, 'r') as reader:
+                    return json.loads(reader.read())
+            except (ValueError, OSError) as e:
+                logger.warning("Could not read decode cache index: %s", e)
+        return {'files': {}, 'entries': {}}
+
+    def _write_index(self) -> None:
+        """Write the index atomically, so a crash does not corrupt it"""
+        temp_file = self.path / f"{INDEX_FILE}.{os.getpid()}.tmp"
+        with open(temp_file, 'w') as writer:
+            writer.write(json.dumps(self.index, indent=2))
+        os.replace(temp_file, self.path / INDEX_FILE)
+
+    def size(self) -> int:
+        """Total size in bytes of the cached PCM"""
+        return sum(entry.get('bytes', 0)
+                   for entry in self.index['entries'].values())
+
+    def key(self, filename: str | Path) -> str:
+        """Get the cache key of a file. The content is only hashed if the
+        path, size or modification time differs from the last time."""
+        path = Path(filename).resolve()
+        stat = path.stat()
+        known = self.index['files'].get(str(path))
+        if (known and known.get('size') == stat.st_size
+                and known.get('mtime') == stat.st_mtime_ns):
+            return known.get('hash')
+        content_hash = hash_file(path)
+        self.index['files'][str(path)] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': content_hash,
+        }
+        return content_hash
+
+    def _pcm_file(self, key: str) -> Path:
+        return self.path / f"{key}.pcm"
+
+    def _info_file(self, key: str) -> Path:
+        return self.path / f"{key}.json"
+
+    # LOOKUP
+    def lookup(self, filename: str | Path) -> Optional[dict]:
+        """Get the format info of a cached file, or None if not cached."""
+        key = self.key(filename)
+        if key not in self.index['entries']:
+            return None
+        if not self._pcm_file(key).exists() or not self._info_file(key).exists():
+            logger.warning("Decode cache entry %s is missing - dropping it", key)
+            self.index['entries'].pop(key)
+            self._write_index()
+            return None
+        with open(self._info_file(key), 'r') as reader:
+            info = json.loads(reader.read())
+        info['key'] = key
+        return info
+
+    def map(self, filename: str | Path) -> Optional[tuple[mmap.mmap, dict]]:
+        """Memory-map the cached PCM of a file. Returns the read-only map
+        and the format info, or None if the file is not cached."""
+        info = self.lookup(filename)
+        if info is None:
+            return None
+        key = info.get('key')
+        self.index['entries'][key]['last_used'] = time.time()
+        self._write_index()
+        with open(self._pcm_file(key), 'rb') as reader:
+            if not info.get('bytes'):
+                return mmap.mmap(-1, 1), info  # mmap cannot map empty files
+            pcm = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[key].add(pcm)
+        return pcm, info
+
+    def in_use(self, key: str) -> bool:
+        """Whether the PCM of an entry is still mapped by this cache"""
+        return any(not pcm.closed for pcm in self._maps.get(key, ()))
+
+    def load(self, filename: str | Path) -> Optional[AudioSegment]:
+        """Get the decoded audio of a file, or None if it is not cached.
+
+        The audio is not copied out of the cache: the segment reads the
+        samples straight from the memory-mapped PCM file. The map stays
+        open as long as the segment, or a view or array of its samples, is
+        in use, and is closed when they are garbage collected. The entry is
+        not evicted meanwhile. Replacing it only removes the file name, so
+        the mapped samples stay as they were."""
+        mapped = self.map(filename)
+        if mapped is None:
+            return None
+        pcm, info = mapped
+        logger.debug("Loaded %s from the decode cache", filename)
+        return AudioSegment.from_buffer(
+            memoryview(pcm)[:info.get('bytes')],
+            sample_width=info.get('sample_width'),
+            frame_rate=info.get('frame_rate'), channels=info.get('channels'))
+
+    # STORING
+    def store(self, filename: str | Path, audio: AudioSegment,
+              **extra_info) -> None:
+        """Write the decoded audio of a file to the cache. Extra info,
+        like the bitrate, is stored with the format info."""
+        key = self.key(filename)
+        data = audio.raw_data
+        if len(data) > self.max_size:
+            logger.info("%s is larger than the decode cache - not caching it",
+                        filename)
+            return
+        info = {
+            'source': str(Path(filename).resolve()),
+            'channels': audio.channels,
+            'sample_width': audio.sample_width,
+            'frame_rate': audio.frame_rate,
+            'frames': int(audio.frame_count()),
+            'bytes': len(data),
+            **extra_info,
+        }
+        # Write to temporary files first, so readers never see half an entry
+        temp_suffix = f".{os.getpid()}.tmp"
+        pcm_temp = self._pcm_file(key).with_suffix(f".pcm{temp_suffix}")
+        info_temp = self._info_file(key).with_suffix(f".json{temp_suffix}")
+        with open(pcm_temp, 'wb') as writer:
+            writer.write(data)
+        with open(info_temp, 'w') as writer:
+            writer.write(json.dumps(info, indent=2))
+        os.replace(pcm_temp, self._pcm_file(key))
+        os.replace(info_temp, self._info_file(key))
+        self.index['entries'][key] = {
+            'bytes': len(data),
+            'last_used': time.time(),
+        }
+        self.evict()
+        self._write_index()
+        logger.debug("Stored %s in the decode cache as %s", filename, key)
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache is
+        within its size limit. Entries that are in use are skipped, as are
+        the ones whose file can not be removed, eg. because another process
+        has mapped it on Windows."""
+        entries = self.index['entries']
+        total = self.size()
+        for key in sorted(entries, key=lambda x: entries[x].get('last_used', 0)):
+            if total <= self.max_size:
+                break
+            if self.in_use(key):
+                logger.debug("Not evicting %s from the decode cache, as it "
+                             "is in use", key)
+                continue
+            try:
+                self._pcm_file(key).unlink(missing_ok=True)
+            except OSError as e:
+                logger.debug("Could not evict %s from the decode cache: %s",
+                             key, e)
+                continue
+            logger.info("Evicting %s from the decode cache", key)
+            total -= entries.pop(key).get('bytes', 0)
+            self._info_file(key).unlink(missing_ok=True)
+        # Forget files whose decoded audio is no longer cached
+        self.index['files'] = {
+            path: known for path, known in self.index['files'].items()
+            if known.get('hash') in entries}
+
+    def clear(self) -> None:
+        """Remove every entry"""
+        for key in list(self.index['entries']):
+            for file in (self._pcm_file(key), self._info_file(key)):
+                file.unlink(missing_ok=True)
+        self.index = {'files': {}, 'entries': {}}
+        self._write_index()
@@ -0,0 +1,235 @@
+"""Content-addressed cache of rendered outputs.
+
+Rendering a preset gives the same files every time it is given the same
+audio, song definition, preset, crossfade and encoder settings. Each render
+is keyed by a hash of all of those, with the hash of the content of the
+input file and a RENDER_VERSION, so a changed input file, an edited preset
+or a new output format gives a new key, and nothing else does.
+
+The files of each render are hard-linked into the store under its key. When
+a render with the same key comes up again, its outputs are left alone if
+they are still the stored files, or linked back from the store if they are
+missing, and the song does not have to be decoded or rendered at all. Where
+hard links are not possible, the files are copied. When the store grows past
+its size limit, the least recently used renders are removed from it, which
+does not touch the outputs.
+"""
+from pathlib import Path
+from typing import Optional
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from decode_cache import hash_file
+
+logger = logging.getLogger("songtwister.output_cache")
+
+INDEX_FILE = 'index.json'
+# Bump when a change to the rendering or encoding changes the output files,
+# so renders of older versions are not reused
+RENDER_VERSION = 1
+# Fields of song definitions and presets that do not change the audio
+IGNORED_FIELDS = ('comment', 'description')
+
+
+def _normalize(definition: Optional[dict]) -> Optional[dict]:
+    """Leave out the fields that do not change the audio"""
+    if not isinstance(definition, dict):
+        return definition
+    return {name: value for name, value in definition.items()
+            if name not in IGNORED_FIELDS}
+
+
+def _link(source: Path, target: Path) -> None:
+    """Hard-link source to target, or copy it if linking is not possible.
+    The target is replaced atomically, if it exists."""
+    temp_file = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+    temp_file.unlink(missing_ok=True)
+    try:
+        os.link(source, temp_file)
+    except OSError:
+        shutil.copy2(source, temp_file)
+    os.replace(temp_file, target)
+
+
+class OutputCache:
+    def __init__(self, path: str | Path, max_size_mb: int | float = 4096):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.index = self._read_index()
+
+    def __repr__(self) -> str:
+        return (f"OutputCache: {self.path} ({len(self.index['entries'])} "
+                f"renders, {self.size() / 1024 / 1024:.0f} MB)")
+
+    # INDEX
+    def _read_index(self) -> dict:
+        index_file = self.path / INDEX_FILE
+        if index_file.exists():
+            try:
+                with open(index_file, 'r') as reader:
+                    return json.loads(reader.read())
+            except (ValueError, OSError) as e:
+                logger.warning("Could not read output cache index: %s", e)
+        return {'inputs': {}, 'entries': {}}
+
+    def _write_index(self) -> None:
+        """Write the index atomically, so a crash does not corrupt it"""
+        temp_file = self.path / f"{INDEX_FILE}.{os.getpid()}.tmp"
+        with open(temp_file, 'w') as writer:
+            writer.write(json.dumps(self.index, indent=2))
+        os.replace(temp_file, self.path / INDEX_FILE)
+
+    def size(self) -> int:
+        """Total size in bytes of the stored files"""
+        return sum(entry.get('bytes', 0)
+                   for entry in self.index['entries'].values())
+
+    # KEYS
+    def input_hash(self, filename: str | Path) -> str:
+        """Get the hash of the content of an input file. The content is only
+        hashed if the path, size or modification time differs from the
+        last time."""
+        path = Path(filename).resolve()
+        stat = path.stat()
+        known = self.index['inputs'].get(str(path))
+        if (known and known.get('size') == stat.st_size
+                and known.get('mtime') == stat.st_mtime_ns):
+            return known.get('hash')
+        content_hash = hash_file(path)
+        self.index['inputs'][str(path)] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': content_hash,
+        }
+        return content_hash
+
+    def key(self, input_file: str | Path, song_data: dict,
+            preset_data: Optional[dict], **settings) -> str:
+        """Get the key of a render of a preset of a song. settings are the
+        other values that change the output files, like the crossfade and
+        the output formats. The song definition should include the path of
+        the input file, as the outputs are named after it."""
+        fields = {
+            'version': RENDER_VERSION,
+            'input': self.input_hash(input_file),
+            'song': _normalize(song_data),
+            'preset': _normalize(preset_data),
+            'settings': settings,
+        }
+        content = json.dumps(fields, sort_keys=True, default=str)
+        return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+    def _store_dir(self, key: str) -> Path:
+        return self.path / key
+
+    # LOOKUP
+    def _is_stored(self, file: dict) -> bool:
+        stored = self.path / file.get('stored')
+        return stored.exists() and stored.stat().st_size == file.get('size')
+
+    @staticmethod
+    def _is_current(output: Path, stored: Path) -> bool:
+        """Whether the output is still the stored file, linked or copied"""
+        if not output.exists():
+            return False
+        if os.path.samefile(output, stored):
+            return True
+        output_stat, stored_stat = output.stat(), stored.stat()
+        return (output_stat.st_size == stored_stat.st_size
+                and output_stat.st_mtime_ns == stored_stat.st_mtime_ns)
+
+    def restore(self, key: str, overwrite: bool = False) -> Optional[dict]:
+        """Put the outputs of a render back in place. Outputs that are still
+        the stored files are left alone, and missing ones are linked from
+        the store. Returns the info stored with the render, or None if it
+        is not cached, or an output was changed and overwrite is not
+        enabled."""
+        entry = self.index['entries'].get(key)
+        if entry is None:
+            return None
+        files = entry.get('files', [])
+        if not all(self._is_stored(file) for file in files):
+            logger.warning("Output cache entry %s is missing files - "
+                           "dropping it", key)
+            self._remove(key)
+            self._write_index()
+            return None
+        restored = []
+        for file in files:
+            output, stored = Path(file.get('output')), self.path / file.get('stored')
+            if self._is_current(output, stored):
+                continue
+            if not output.parent.exists() or (output.exists() and not overwrite):
+                return None
+            restored.append((output, stored))
+        for output, stored in restored:
+            logger.info("Restoring %s from the output cache", output)
+            _link(stored, output)
+        entry['last_used'] = time.time()
+        self._write_index()
+        return entry.get('info', {})
+
+    # STORING
+    def store(self, key: str, files: list[str | Path], **info) -> None:
+        """Link the files of a render into the store. info, like the names
+        of the files, is returned by restore."""
+        files = [Path(file).resolve() for file in files]
+        total = sum(file.stat().st_size for file in files)
+        if total > self.max_size:
+            logger.info("The render %s is larger than the output cache - "
+                        "not caching it", key)
+            return
+        self._remove(key)
+        store_dir = self._store_dir(key)
+        store_dir.mkdir(parents=True, exist_ok=True)
+        stored_files = []
+        for number, file in enumerate(files):
+            stored = store_dir / f"{number}-{file.name}"
+            _link(file, stored)
+            stored_files.append({
+                'output': str(file),
+                'stored': str(stored.relative_to(self.path)),
+                'size': stored.stat().st_size,
+            })
+        self.index['entries'][key] = {
+            'files': stored_files,
+            'bytes': total,
+            'last_used': time.time(),
+            'info': info,
+        }
+        self.evict()
+        self._write_index()
+        logger.debug("Stored %s in the output cache as %s",
+                     ", ".join(str(file) for file in files), key)
+
+    def _remove(self, key: str) -> None:
+        self.index['entries'].pop(key, None)
+        shutil.rmtree(self._store_dir(key), ignore_errors=True)
+
+    def evict(self) -> None:
+        """Remove the least recently used renders until the cache is
+        within its size limit. The outputs are kept."""
+        entries = self.index['entries']
+        total = self.size()
+        for key in sorted(entries, key=lambda x: entries[x].get('last_used', 0)):
+            if total <= self.max_size:
+                break
+            logger.info("Evicting %s from the output cache", key)
+            total -= entries[key].get('bytes', 0)
+            self._remove(key)
+        # Forget input files that are gone
+        self.index['inputs'] = {
+            path: known for path, known in self.index['inputs'].items()
+            if Path(path).exists()}
+
+    def clear(self) -> None:
+        """Remove every render"""
+        for key in list(self.index['entries']):
+            self._remove(key)
+        self.index = {'inputs': {}, 'entries': {}}
+        self._write_index()
@@ -0,0 +1,68 @@
+"""Panning effects as per-channel gain envelopes, in NumPy.
+
+The pan effects used to pan whole copies of a beat with AudioSegment.pan,
+and join or crossfade them: pingpong appended a panned slice per segment,
+and across crossfaded two fully panned copies over the whole beat. Here each
+effect is a (frames, 2) envelope of left and right gains, the envelopes of
+a beat are multiplied together, and the beat is multiplied by the result
+once. Segment boundaries are exact frames instead of rounded ms.
+
+The gains follow the pan law of pydub: panned hard to one side, that side
+is 3 dB louder and the other side is silent.
+"""
+import numpy as np
+
+from crossfade import crossfade_gains
+from pydub.utils import db_to_float, ratio_to_db
+
+HARD_PAN_GAIN = db_to_float(ratio_to_db(2.0) / 2)  # +3 dB, as pydub
+PINGPONG_FADE_MS = 5  # The crossfade between the segments of a pingpong
+
+
+def pan_envelope(rightness: np.ndarray) -> np.ndarray:
+    """Get the (frames, 2) gains of a mix of the audio panned hard left
+    and hard right, with rightness 0 for all left and 1 for all right"""
+    return HARD_PAN_GAIN * np.stack((1.0 - rightness, rightness), axis=1)
+
+
+def hard_pan(frames: int, pan: int) -> np.ndarray:
+    """Pan all the frames hard left (-1) or hard right (1)"""
+    return pan_envelope(np.full(frames, 1.0 if pan > 0 else 0.0))
+
+
+def across(frames: int, to_left: bool = False) -> np.ndarray:
+    """Move the audio from one side to the other over all the frames.
+    By default it moves from the left to the right."""
+    fade_out, fade_in = crossfade_gains(frames, 'linear')
+    return pan_envelope(fade_out if to_left else fade_in)
+
+
+def pingpong(frames: int, count: int, fade_frames: int) -> np.ndarray:
+    """Split the frames into count segments, and pan them hard left and
+    right in turn, starting on the left. The pan moves over fade_frames
+    around each boundary."""
+    count = max(min(count, frames), 1)
+    boundaries = np.arange(count + 1) * frames // count
+    segments = np.searchsorted(boundaries, np.arange(frames), side='right') - 1
+    rightness = (segments % 2).astype(np.float64)
+    fade_frames = min(fade_frames, int(np.diff(boundaries).min()))
+    if count > 1 and fade_frames > 0:
+        # From left to right at odd boundaries, and back at even ones
+        _, fade_in = crossfade_gains(fade_frames, 'linear')
+        starts = boundaries[1:-1] - fade_frames // 2
+        to_right = (np.arange(1, count) % 2).astype(np.float64)
+        ramps = (1.0 - to_right)[:, None] + (
+            to_right * 2 - 1)[:, None] * fade_in
+        rightness[starts[:, None] + np.arange(fade_frames)] = ramps
+    return pan_envelope(rightness)
+
+
+def apply_envelope(samples: np.ndarray, envelope: np.ndarray) -> np.ndarray:
+    """Apply a (frames, 2) envelope to mono or stereo samples, with the
+    flooring and clipping of audioop.mul. The result is stereo."""
+    if samples.shape[1] > 2:
+        raise ValueError(
+            f"Can not pan audio with {samples.shape[1]} channels")
+    info = np.iinfo(samples.dtype)
+    panned = np.floor(np.clip(samples * envelope, info.min, info.max))
+    return panned.astype(samples.dtype)
@@ -0,0 +1,310 @@
+"""Waveform peaks of audio, computed with NumPy.
+
+The samples are split into chunks, and the RMS, minimum and maximum of every
+chunk are computed in one pass over the sample buffer. A PeakPyramid keeps
+the sums at a few fixed resolutions, so peaks at any lower resolution are
+aggregated from the pyramid instead of scanning the audio again.
+
+The minimum and maximum can also be written to a .peaks sidecar file at
+several zoom levels, so a frontend can read the waveform of any time range
+without decoding the audio.
+"""
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+from typing import Optional
+import logging
+import os
+import struct
+import weakref
+
+import numpy as np
+
+from audiosegment_patch import PatchedAudioSegment as AudioSegment
+from render_engine import audio_to_array
+
+logger = logging.getLogger("songtwister.peaks")
+
+# Resolutions of the pyramid, in number of chunks
+PYRAMID_LEVELS = (100, 1000, 10000)
+# Aggregate from a level with at least this many chunks per requested chunk
+MIN_CHUNKS_PER_PEAK = 8
+# Pyramids of the most recently used audio
+PYRAMID_CACHE_SIZE = 4
+
+# Frames per chunk of the zoom levels of peaks files
+PEAKS_FILE_ZOOM_LEVELS = (256, 1024, 4096, 16384)
+PEAKS_FILE_MAGIC = b'STPK'
+PEAKS_FILE_VERSION = 1
+# magic, version, sample width, channels, frame rate, frame count, levels
+PEAKS_FILE_HEADER = struct.Struct('<4sBBBxIQH')
+# frames per chunk, chunk count, offset of the (min, max) int8 pairs
+PEAKS_FILE_LEVEL = struct.Struct('<IQQ')
+
+Peaks = namedtuple("Peaks", ["rms", "minimum", "maximum"])
+# A time range read from a peaks file. minimum and maximum are int8,
+# scaled so that 127 is full scale.
+WaveformWindow = namedtuple("WaveformWindow", [
+    "start_ms", "end_ms", "frames_per_chunk", "minimum", "maximum"])
+
+
+def chunk_bounds(frame_count: int, frame_rate: int,
+                 resolution: int) -> np.ndarray:
+    """Get the frame positions of the edges of resolution chunks, rounded
+    as when slicing the AudioSegment by ms."""
+    length_ms = round(1000 * (float(frame_count) / frame_rate))
+    chunk_length = length_ms / resolution
+    edges_ms = np.minimum(np.arange(resolution + 1) * chunk_length, length_ms)
+    return (edges_ms * (frame_rate / 1000.0)).astype(np.int64)
+
+
+def _reduce(values: np.ndarray, bounds: np.ndarray, ufunc: np.ufunc,
+            empty: int | float) -> np.ndarray:
+    """Apply ufunc.reduceat to the chunks between bounds. Empty chunks,
+    which reduceat does not handle, get the empty value."""
+    values = values[:bounds[-1]]
+    if not len(values):
+        return np.full(len(bounds) - 1, empty, dtype=np.float64)
+    starts = np.minimum(bounds[:-1], len(values) - 1)
+    reduced = ufunc.reduceat(values, starts).astype(np.float64)
+    reduced[np.minimum(bounds[1:], len(values)) <= bounds[:-1]] = empty
+    return reduced
+
+
+def chunk_sums(samples: np.ndarray, bounds: np.ndarray
+               ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Get the sum of squares, sample count, minimum and maximum of the
+    samples (frames, channels) of every chunk between bounds. The count
+    includes the samples past the end, as AudioSegment slicing pads
+    them with silence."""
+    channels = samples.shape[1]
+    # Reduce the interleaved samples, which is much faster than
+    # reducing over the channels first
+    flat = samples.reshape(-1)
+    sample_bounds = bounds * channels
+    # The squares of 32 bit samples could overflow int64 when summed
+    square_type = np.float64 if flat.dtype == np.int32 else np.int64
+    sums = _reduce(np.square(flat, dtype=square_type), sample_bounds, np.add, 0)
+    counts = np.diff(sample_bounds).astype(np.float64)
+    minimum = _reduce(flat, sample_bounds, np.minimum, 0)
+    maximum = _reduce(flat, sample_bounds, np.maximum, 0)
+    return sums, counts, minimum, maximum
+
+
+def _to_peaks(sums: np.ndarray, counts: np.ndarray, minimum: np.ndarray,
+              maximum: np.ndarray) -> Peaks:
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rms = np.floor(np.sqrt(np.where(counts > 0, sums / counts, 0)))
+    return Peaks(rms, minimum, maximum)
+
+
+def calculate_peaks(audio: AudioSegment, resolution: int) -> Peaks:
+    """Scan the audio for the peaks of resolution chunks. The rms equals
+    the .rms of every chunk sliced from the AudioSegment."""
+    samples = audio_to_array(audio)
+    bounds = chunk_bounds(len(samples), audio.frame_rate, resolution)
+    return _to_peaks(*chunk_sums(samples, bounds))
+
+
+def scale_peaks(rms: np.ndarray, ceiling: int = 100) -> list[int]:
+    """Scale the rms levels to ints, where the loudest chunk is ceiling"""
+    max_rms = rms.max() if len(rms) else 0
+    if not max_rms:
+        return [0] * len(rms)
+    return np.floor((rms / max_rms) * ceiling).astype(int).tolist()
+
+
+class PeakPyramid:
+    """Chunk sums of a buffer at the PYRAMID_LEVELS resolutions. Peaks at
+    other resolutions are aggregated from the finest level needed."""
+    def __init__(self, audio: AudioSegment,
+                 levels: tuple[int, ...] = PYRAMID_LEVELS):
+        samples = audio_to_array(audio)
+        self.frame_count = len(samples)
+        self.frame_rate = audio.frame_rate
+        self.channels = audio.channels
+        self.sample_width = audio.sample_width
+        self.levels: dict[int, tuple] = {}
+        levels = sorted(set(min(level, max(self.frame_count, 1))
+                            for level in levels))
+        finest = levels[-1]
+        bounds = np.linspace(0, self.frame_count, finest + 1).astype(np.int64)
+        self.levels[finest] = (bounds, *chunk_sums(samples, bounds))
+        for level in levels[:-1]:
+            self.levels[level] = self._aggregate(
+                finest, np.linspace(0, self.frame_count, level + 1).astype(np.int64))
+
+    def __repr__(self) -> str:
+        return f"PeakPyramid: {self.frame_count} frames at levels {list(self.levels)}"
+
+    def _aggregate(self, level: int, bounds: np.ndarray) -> tuple:
+        """Combine the chunks of a level into chunks between bounds, which
+        are moved to the nearest chunk edge of the level."""
+        level_bounds, sums, counts, minimum, maximum = self.levels[level]
+        edges = np.searchsorted(level_bounds, bounds)
+        edges = np.clip(edges, 0, level)
+        # Use the closer of the neighbouring edges
+        lower = np.maximum(edges - 1, 0)
+        closer = np.abs(level_bounds[lower] - bounds) < np.abs(level_bounds[edges] - bounds)
+        edges = np.where(closer, lower, edges)
+        return (level_bounds[edges],
+                _reduce(sums, edges, np.add, 0),
+                _reduce(counts, edges, np.add, 0),
+                _reduce(minimum, edges, np.minimum, 0),
+                _reduce(maximum, edges, np.maximum, 0))
+
+    def level_for(self, resolution: int) -> Optional[int]:
+        """The coarsest level with enough chunks for the resolution"""
+        for level in sorted(self.levels):
+            if level >= resolution * MIN_CHUNKS_PER_PEAK:
+                return level
+        return None
+
+    def peaks(self, resolution: int) -> Optional[Peaks]:
+        """Get the peaks of resolution chunks, or None if the pyramid is
+        too coarse for the resolution."""
+        level = self.level_for(resolution)
+        if level is None:
+            return None
+        bounds = chunk_bounds(self.frame_count, self.frame_rate, resolution)
+        return _to_peaks(*self._aggregate(level, bounds)[1:])
+
+
+# The pyramids of the most recently used audio, by the id of the audio. An
+# entry is dropped when its audio is garbage collected, before the id can be
+# reused, so the cache never keeps audio alive.
+_pyramids: OrderedDict[int, PeakPyramid] = OrderedDict()
+
+
+def _drop_pyramid(audio_id: int) -> None:
+    _pyramids.pop(audio_id, None)
+
+
+def get_pyramid(audio: AudioSegment) -> PeakPyramid:
+    """Get the pyramid of the audio, building it the first time"""
+    audio_id = id(audio)
+    pyramid = _pyramids.get(audio_id)
+    if pyramid is not None:
+        _pyramids.move_to_end(audio_id)
+        return pyramid
+    pyramid = PeakPyramid(audio)
+    _pyramids[audio_id] = pyramid
+    weakref.finalize(audio, _drop_pyramid, audio_id)
+    while len(_pyramids) > PYRAMID_CACHE_SIZE:
+        _pyramids.popitem(last=False)
+    return pyramid
+
+
+def get_peaks(audio: AudioSegment, resolution: int) -> Peaks:
+    """Get the peaks of the audio from its pyramid, which is built the
+    first time the audio is used, or by scanning the audio if the
+    resolution is too fine for the pyramid."""
+    peaks = get_pyramid(audio).peaks(resolution)
+    if peaks is None:
+        logger.debug("Scanning the audio for %s peaks", resolution)
+        return calculate_peaks(audio, resolution)
+    return peaks
+
+
+# PEAKS FILES
+def peaks_file_path(path: str | Path) -> Path:
+    """Get the path of the peaks file written next to an audio file"""
+    path = Path(path)
+    return path.with_name(f"{path.name}.peaks")
+
+
+def write_peaks_file(audio: AudioSegment, path: str | Path,
+                     zoom_levels: tuple[int, ...] = PEAKS_FILE_ZOOM_LEVELS) -> Path:
+    """Write the minimum and maximum of the audio at each zoom level (in
+    frames per chunk) to a binary peaks file. Each level is computed from
+    the finest one, so the audio is only scanned once."""
+    samples = audio_to_array(audio)
+    frame_count = len(samples)
+    zoom_levels = sorted(zoom_levels)
+    finest = zoom_levels[0]
+    if any(zoom % finest for zoom in zoom_levels):
+        raise ValueError("Zoom levels must be multiples of the finest level")
+    bounds = np.append(np.arange(0, frame_count, finest), frame_count)
+    _, _, minimum, maximum = chunk_sums(samples, bounds)
+    full_scale = 2 ** (8 * audio.sample_width - 1)
+
+    levels = []
+    for zoom in zoom_levels:
+        step = zoom // finest
+        edges = np.append(np.arange(0, len(minimum), step), len(minimum))
+        level_min = _reduce(minimum, edges, np.minimum, 0)
+        level_max = _reduce(maximum, edges, np.maximum, 0)
+        pairs = np.empty((len(level_min), 2), dtype=np.int8)
+        pairs[:, 0] = np.clip(np.floor(level_min * 128 / full_scale), -128, 127)
+        pairs[:, 1] = np.clip(np.ceil(level_max * 128 / full_scale), -128, 127)
+        levels.append((zoom, pairs))
+
+    offset = PEAKS_FILE_HEADER.size + PEAKS_FILE_LEVEL.size * len(levels)
+    path = Path(path)
+    # Replace the file instead of writing through it, as it may be
+    # hard-linked from the output cache
+    temp_file = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(temp_file, 'wb') as writer:
+        writer.write(PEAKS_FILE_HEADER.pack(
+            PEAKS_FILE_MAGIC, PEAKS_FILE_VERSION, audio.sample_width,
+            audio.channels, audio.frame_rate, frame_count, len(levels)))
+        for zoom, pairs in levels:
+            writer.write(PEAKS_FILE_LEVEL.pack(zoom, len(pairs), offset))
+            offset += pairs.nbytes
+        for _, pairs in levels:
+            writer.write(pairs.tobytes())
+    os.replace(temp_file, path)
+    logger.debug("Wrote peaks file %s", path)
+    return path
+
+
+def read_peaks_header(path: str | Path) -> dict:
+    """Read the format and the zoom levels of a peaks file"""
+    with open(path, 'rb') as reader:
+        return _read_header(reader)
+
+
+def _read_header(reader) -> dict:
+    (magic, version, sample_width, channels, frame_rate, frame_count,
+     level_count) = PEAKS_FILE_HEADER.unpack(reader.read(PEAKS_FILE_HEADER.size))
+    if magic != PEAKS_FILE_MAGIC:
+        raise ValueError("Not a peaks file")
+    if version != PEAKS_FILE_VERSION:
+        raise ValueError(f"Unsupported peaks file version: {version}")
+    levels = [PEAKS_FILE_LEVEL.unpack(reader.read(PEAKS_FILE_LEVEL.size))
+              for _ in range(level_count)]
+    return {
+        'sample_width': sample_width,
+        'channels': channels,
+        'frame_rate': frame_rate,
+        'frame_count': frame_count,
+        'levels': [{'frames_per_chunk': zoom, 'chunks': chunks, 'offset': offset}
+                   for zoom, chunks, offset in levels],
+    }
+
+
+def read_peaks_window(path: str | Path, start_ms: int | float,
+                      end_ms: int | float, max_points: int = 1000) -> WaveformWindow:
+    """Read the waveform of a time range from a peaks file. The finest zoom
+    level with at most max_points chunks in the range is used, or the
+    coarsest level if they all have more. Only the header and the chunks
+    in the range are read from disk."""
+    with open(path, 'rb') as reader:
+        header = _read_header(reader)
+        frame_rate = header.get('frame_rate')
+        start = max(int(start_ms * frame_rate / 1000), 0)
+        end = min(int(end_ms * frame_rate / 1000), header.get('frame_count'))
+        end = max(end, start)
+        levels = header.get('levels')
+        level = next((level for level in levels
+                      if (end - start) / level.get('frames_per_chunk') <= max_points),
+                     levels[-1])
+        zoom = level.get('frames_per_chunk')
+        first = min(start // zoom, level.get('chunks'))
+        last = min(-(-end // zoom), level.get('chunks'))
+        reader.seek(level.get('offset') + first * 2)
+        pairs = np.frombuffer(
+            reader.read((last - first) * 2), dtype=np.int8).reshape(-1, 2)
+    return WaveformWindow(
+        first * zoom * 1000 / frame_rate,
+        min(last * zoom, header.get('frame_count')) * 1000 / frame_rate,
+        zoom, pairs[:, 0], pairs[:, 1])
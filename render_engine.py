@@ -0,0 +1,692 @@
+"""NumPy render engine for SongTwister.apply_effects.
+
+The pydub engine joins the song by appending AudioSegments twice per cut,
+and every append copies all of the audio joined so far. This engine first
+lays out every append as frame counts, sizes the output once, and then
+writes the spans into a single preallocated sample buffer.
+
+The layout reproduces the millisecond rounding of AudioSegment slicing and
+the gain stepping of AudioSegment.fade(), so the result is identical to the
+pydub engine, sample for sample.
+
+A render can be kept as a RenderState, with the layout of its appends and
+the frames that each of them replaced. When the cuts of one bar change, only
+the appends from that bar on are laid out again, up to where the layout of
+the rest is the old one, shifted, and the output buffer is patched in place,
+or copied when an earlier output still reads from it.
+"""
+from collections import namedtuple
+from typing import Callable, Iterable, Iterator, Optional
+import logging
+import sys
+import weakref
+
+import numpy as np
+
+from audiosegment_patch import PatchedAudioSegment as AudioSegment
+from crossfade import mix_crossfade
+from pydub.utils import db_to_float
+
+logger = logging.getLogger("songtwister.render_engine")
+
+ENGINES = ('numpy', 'pydub')
+SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+SILENT_GAIN = db_to_float(-120)  # The gain pydub fades to and from
+
+# One cut from SongTwister._iter_cuts: the untreated audio since the last cut
+# (in ms, including the crossfade margins) and the treated beat, if any.
+Cut = namedtuple("Cut", ["since_start", "since_end", "before_fade",
+                         "beat", "beat_fade"])
+# One AudioSegment.append, expressed as frame counts.
+Append = namedtuple("Append", ["samples", "crossfade", "keep", "xf_end",
+                               "fade_in", "tail_end", "length"])
+
+
+class EngineFallback(Exception):
+    """Raised when a cut cannot be rendered exactly by the numpy engine."""
+
+
+def audio_to_array(audio: AudioSegment) -> np.ndarray:
+    """Get a read-only (frames, channels) view of the samples of a segment."""
+    return np.frombuffer(
+        audio.raw_data, dtype=SAMPLE_DTYPES[audio.sample_width]
+    ).reshape(-1, audio.channels)
+
+
+def array_to_audio(samples: np.ndarray, template: AudioSegment) -> AudioSegment:
+    """Make an AudioSegment of the samples, with the format of template."""
+    return template._spawn(np.ascontiguousarray(
+        samples, dtype=SAMPLE_DTYPES[template.sample_width]).tobytes())
+
+
+def _ms_to_frames(ms: int | float, frame_rate: int) -> int:
+    """Frame position of a ms position, as AudioSegment._parse_position"""
+    return int(ms * (frame_rate / 1000.0))
+
+
+def _frames_to_ms(frames: int, frame_rate: int) -> int:
+    """Length in ms of a number of frames, as AudioSegment.__len__"""
+    return round(1000 * (float(frames) / frame_rate))
+
+
+def _ms_to_samples(ms: int | float, source: AudioSegment) -> int:
+    """Sample position of a ms position, as SongTwister._ms_to_samples"""
+    return int((ms / 1000) * source.frame_rate)
+
+
+def _limits(sample_width: int) -> tuple[int, int]:
+    info = np.iinfo(SAMPLE_DTYPES[sample_width])
+    return int(info.min), int(info.max)
+
+
+def fade_gains(frames: int, frame_rate: int,
+               fade_in: bool = False) -> tuple[np.ndarray, np.ndarray]:
+    """Get the frame indices and gains that AudioSegment.fade() applies
+    when fading a whole segment in or out.
+
+    Fades longer than 100 ms use one gain step per ms, shorter ones one
+    per frame. Frames past the end of the segment are dropped, except in
+    the last ms step, which pydub pads with silence. Padded frames have
+    the index -1."""
+    duration = _frames_to_ms(frames, frame_rate)
+    from_power = SILENT_GAIN if fade_in else 1.0
+    gain_delta = (1.0 if fade_in else SILENT_GAIN) - from_power
+    if duration > 100:
+        scale_step = gain_delta / duration
+        steps = np.arange(duration)
+        starts = (steps * (frame_rate / 1000.0)).astype(np.int64)
+        ends = ((steps + 1) * (frame_rate / 1000.0)).astype(np.int64)
+        # A step starting past the end is empty, the rest are padded
+        used = starts < frames
+        steps, starts, ends = steps[used], starts[used], ends[used]
+        counts = ends - starts
+        indices = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        indices += np.arange(int(counts.sum()))
+        indices[indices >= frames] = -1
+        gains = np.repeat(from_power + (scale_step * steps), counts)
+        return indices, gains
+    fade_frames = duration * (frame_rate / 1000.0)
+    if not fade_frames:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    scale_step = gain_delta / fade_frames
+    indices = np.arange(min(int(fade_frames), frames))
+    return indices, from_power + (scale_step * indices)
+
+
+def apply_fade(samples: np.ndarray, indices: np.ndarray, gains: np.ndarray,
+               sample_width: int) -> np.ndarray:
+    """Apply fade gains with the flooring and clipping of audioop.mul."""
+    low, high = _limits(sample_width)
+    picked = samples[np.maximum(indices, 0)].astype(np.float64)
+    picked[indices < 0] = 0
+    return np.floor(np.clip(picked * gains[:, None], low, high))
+
+
+def _padded(samples: np.ndarray, start: int, end: int) -> np.ndarray:
+    """Take frames start:end, padded with silence as AudioSegment slicing"""
+    chunk = samples[start:end]
+    missing = (end - start) - len(chunk)
+    if missing > 0 and len(chunk):
+        chunk = np.concatenate(
+            (chunk, np.zeros((missing, samples.shape[1]), samples.dtype)))
+    return chunk
+
+
+# The columns of Joiner.layout(): the positions of an append, the joined
+# length after it, and the size of what it appends. The positions are in
+# frames, SEG_MS in ms, and CAPPED is 1 if the crossfade was shortened to
+# the length of the appended segment.
+KEEP, XF_END, FADE_IN, TAIL_END, LENGTH, AFTER, FRAMES, SEG_MS, CAPPED = range(9)
+LAYOUT_COLUMNS = 9
+# The columns of Joiner.crossfades(), in ms
+REQUESTED, CROSSFADE = range(2)
+
+
+class Joiner:
+    """Lay out a series of AudioSegment.append calls on a segment of length
+    frames, initially empty, and then render them into one preallocated
+    buffer. The crossfades use the curve of crossfade.CURVES."""
+    def __init__(self, source: AudioSegment, curve: str = 'stepped',
+                 length: int = 0):
+        self.source = source
+        self.samples = audio_to_array(source)
+        self.curve = curve
+        self.frame_rate = source.frame_rate
+        self.channels = source.channels
+        self.sample_width = source.sample_width
+        self.appends: list[Append] = []
+        self.rows: list[tuple] = []  # See layout()
+        self.fades: list[tuple] = []  # See crossfades()
+        self.length = length  # in frames
+        self.peak_length = length
+
+    def __len__(self) -> int:
+        """The length in ms of the audio joined so far"""
+        return _frames_to_ms(self.length, self.frame_rate)
+
+    def layout(self) -> np.ndarray:
+        """Get the layout of the appends, with the columns KEEP to CAPPED"""
+        return np.array(self.rows, dtype=np.int64).reshape(-1, LAYOUT_COLUMNS)
+
+    def crossfades(self) -> np.ndarray:
+        """Get the crossfade that was asked for and the crossfade that was
+        made by each append"""
+        return np.array(self.fades, dtype=np.float64).reshape(-1, 2)
+
+    def prepare(self, audio: AudioSegment) -> np.ndarray:
+        """Convert an AudioSegment to samples in the format of the source,
+        as AudioSegment._sync would."""
+        params = (audio.channels, audio.frame_rate, audio.sample_width)
+        if params == (self.channels, self.frame_rate, self.sample_width):
+            return audio_to_array(audio)
+        if (audio.channels > self.channels
+                or audio.frame_rate > self.frame_rate
+                or audio.sample_width > self.sample_width):
+            raise EngineFallback(
+                f"A beat has a different format than the song: {params}")
+        return audio_to_array(AudioSegment._sync(self.source[:0], audio)[1])
+
+    def add_cut(self, cut: Cut, crossfade_after: bool = True) -> None:
+        """Lay out the appends of a cut of SongTwister._iter_cuts, as the
+        pydub engine in SongTwister.apply_effects joins them"""
+        frame_count = len(self.samples)
+        start = min(max(_ms_to_samples(max(cut.since_start, 0), self.source),
+                        0), frame_count)
+        end = min(_ms_to_samples(cut.since_end, self.source), frame_count)
+        self.join(self.samples[start:max(start, end)], cut.before_fade)
+        if cut.beat is None:
+            return
+        self.join(self.prepare(cut.beat),
+                  cut.beat_fade if crossfade_after else 0,
+                  seg_length=len(cut.beat), capped=True)
+
+    def join(self, samples: np.ndarray, crossfade: int | float,
+             seg_length: Optional[int] = None, capped: bool = False) -> None:
+        """Add an append of samples, with a crossfade of up to crossfade ms.
+        It is shortened to the length joined so far and, if capped, to
+        seg_length."""
+        fade = min(crossfade, len(self))
+        if capped:
+            fade = min(fade, seg_length)
+        self.append(samples, fade, seg_length, requested=crossfade,
+                    capped=capped)
+
+    def append(self, samples: np.ndarray, crossfade: int | float = 0,
+               seg_length: Optional[int] = None,
+               requested: Optional[int | float] = None,
+               capped: bool = False) -> None:
+        """Add an append of samples to the layout. seg_length is the length
+        in ms of the segment before it was converted to the source format."""
+        frames = len(samples)
+        if seg_length is None:
+            seg_length = _frames_to_ms(frames, self.frame_rate)
+        if requested is None:
+            requested = crossfade
+        self.fades.append((requested, crossfade))
+        if not crossfade:
+            self._appended(Append(
+                samples, 0, self.length, self.length, 0, frames, frames),
+                seg_length, capped)
+            return
+        if crossfade > len(self):
+            raise ValueError("Crossfade is longer than the original "
+                             f"AudioSegment ({crossfade}ms > {len(self)}ms)")
+        if crossfade > seg_length:
+            raise ValueError("Crossfade is longer than the appended "
+                             f"AudioSegment ({crossfade}ms > {seg_length}ms)")
+        if self.curve != 'stepped':
+            # A crossfade with a gain per frame, as join_crossfaded
+            fade_in = min(_ms_to_frames(crossfade, self.frame_rate),
+                          self.length, frames)
+            self._appended(Append(
+                samples, crossfade, self.length - fade_in, self.length,
+                fade_in, frames, frames), seg_length, capped)
+            return
+        joined_length = len(self)
+        keep = _ms_to_frames(joined_length - crossfade, self.frame_rate)
+        xf_end = _ms_to_frames(joined_length, self.frame_rate)
+        fade_in = _ms_to_frames(crossfade, self.frame_rate)
+        tail_end = _ms_to_frames(
+            _frames_to_ms(frames, self.frame_rate), self.frame_rate)
+        xf_length = len(fade_gains(xf_end - keep, self.frame_rate)[0])
+        tail_length = max(tail_end - fade_in, 0) if fade_in < frames else 0
+        self._appended(Append(
+            samples, crossfade, keep, xf_end, fade_in, tail_end,
+            xf_length + tail_length), seg_length, capped)
+
+    def _appended(self, item: Append, seg_length: int, capped: bool) -> None:
+        self.appends.append(item)
+        self.length = item.keep + item.length
+        self.peak_length = max(self.peak_length, self.length)
+        self.rows.append((item.keep, item.xf_end, item.fade_in, item.tail_end,
+                          item.length, self.length, len(item.samples),
+                          seg_length, int(capped)))
+
+    def render(self, undo: Optional[list] = None) -> AudioSegment:
+        """Write every append into one buffer and return the joined audio.
+        If an undo list is passed, the frames that each append overwrites
+        are added to it, see write()."""
+        if not self.appends:
+            return AudioSegment.empty()
+        buffer = np.zeros((self.peak_length, self.channels),
+                          dtype=SAMPLE_DTYPES[self.sample_width])
+        length = self.render_into(buffer, undo=undo)
+        return array_to_audio(buffer[:length], self.source)
+
+    def render_into(self, buffer: np.ndarray,
+                    undo: Optional[list] = None) -> int:
+        """Write every append into a buffer of at least peak_length frames,
+        and return the joined length"""
+        length = 0
+        for item in self.appends:
+            length = self.write(buffer, item, length, undo=undo)
+        return length
+
+    def write(self, buffer: np.ndarray, item: Append, length: int,
+              offset: int = 0, undo: Optional[list] = None) -> int:
+        """Write an append into a buffer holding the joined frames from
+        offset up to length, and return the new length. If an undo list
+        is passed, the joined frames that the append replaces, from its
+        crossfade on, are added to it."""
+        low, high = _limits(self.sample_width)
+        if undo is not None:
+            undo.append(buffer[item.keep - offset:length - offset].copy())
+        if not item.crossfade:
+            buffer[length - offset:length - offset + item.length] = item.samples
+            return length + item.length
+        keep, xf_end = item.keep - offset, item.xf_end - offset
+        if self.curve != 'stepped':
+            buffer[keep:xf_end] = mix_crossfade(
+                buffer[keep:xf_end], item.samples[:item.fade_in], self.curve)
+            buffer[xf_end:keep + item.length] = item.samples[item.fade_in:]
+            return item.keep + item.length
+        fade_out = fade_gains(xf_end - keep, self.frame_rate)
+        faded_out = apply_fade(
+            _padded(buffer[:length - offset], keep, xf_end),
+            *fade_out, self.sample_width)
+        fade_in = fade_gains(item.fade_in, self.frame_rate, fade_in=True)
+        faded_in = apply_fade(
+            _padded(item.samples, 0, item.fade_in),
+            *fade_in, self.sample_width)
+        # AudioSegment.overlay loops the overlaid segment
+        if len(faded_in) and len(faded_in) < len(faded_out):
+            faded_in = np.resize(faded_in, faded_out.shape)
+        mixed = faded_out
+        mixed[:len(faded_in)] += faded_in[:len(faded_out)]
+        position = keep
+        buffer[position:position + len(mixed)] = np.clip(mixed, low, high)
+        position += len(mixed)
+        tail = _padded(item.samples, item.fade_in, item.tail_end)
+        buffer[position:position + len(tail)] = tail
+        return position + len(tail) + offset
+
+
+def lay_out_cuts(cuts: Iterable[Cut], source: AudioSegment,
+                 crossfade_after: bool = True,
+                 curve: str = 'stepped') -> tuple[Joiner, list[int]]:
+    """Lay out the appends that join the cuts of SongTwister._iter_cuts.
+    Returns the joiner and the index of the first append of each cut,
+    followed by the number of appends.
+
+    This follows the same steps as the pydub engine in
+    SongTwister.apply_effects, with the Joiner standing in for the
+    joined AudioSegment."""
+    joined = Joiner(source, curve=curve)
+    first_appends = []
+    for cut in cuts:
+        first_appends.append(len(joined.appends))
+        joined.add_cut(cut, crossfade_after)
+    first_appends.append(len(joined.appends))
+    return joined, first_appends
+
+
+def render_cuts(cuts: Iterable[Cut], source: AudioSegment,
+                crossfade_after: bool = True,
+                curve: str = 'stepped') -> AudioSegment:
+    """Join the cuts of SongTwister._iter_cuts into one AudioSegment."""
+    joined, _ = lay_out_cuts(cuts, source, crossfade_after, curve)
+    logger.debug("Rendering %s appends into %s frames",
+                 len(joined.appends), joined.peak_length)
+    return joined.render()
+
+
+def lay_out_again(layout: np.ndarray, crossfades: np.ndarray,
+                  before: np.ndarray, frame_rate: int,
+                  curve: str = 'stepped') -> tuple[np.ndarray, np.ndarray,
+                                                   np.ndarray]:
+    """Lay out appends of a layout again, all at once, as Joiner.join would
+    with before frames joined before each of them. Returns the layout, the
+    crossfades, and whether each append could be made at all."""
+    frames, seg_ms = layout[:, FRAMES], layout[:, SEG_MS]
+    # The same float operations as Joiner.append, so the results are equal
+    rate = frame_rate / 1000.0
+    joined_ms = np.round(1000 * (before / frame_rate))
+    crossfade = np.minimum(crossfades[:, REQUESTED], joined_ms)
+    crossfade = np.where(layout[:, CAPPED] == 1,
+                         np.minimum(crossfade, seg_ms), crossfade)
+    possible = crossfade <= seg_ms
+    relaid = layout.copy()
+    if curve != 'stepped':
+        fade_in = np.minimum(np.minimum(
+            np.floor(crossfade * rate).astype(np.int64), before), frames)
+        keep, xf_end, tail_end, length = before - fade_in, before, frames, frames
+    else:
+        keep = np.floor((joined_ms - crossfade) * rate).astype(np.int64)
+        xf_end = np.floor(joined_ms * rate).astype(np.int64)
+        fade_in = np.floor(crossfade * rate).astype(np.int64)
+        tail_end = np.floor(
+            np.round(1000 * (frames / frame_rate)) * rate).astype(np.int64)
+        widths, inverse = np.unique(xf_end - keep, return_inverse=True)
+        xf_length = np.array(
+            [len(fade_gains(int(width), frame_rate)[0]) for width in widths],
+            dtype=np.int64)[inverse]
+        tail_length = np.where(
+            fade_in < frames, np.maximum(tail_end - fade_in, 0), 0)
+        length = xf_length + tail_length
+    plain = crossfade == 0
+    relaid[:, KEEP] = np.where(plain, before, keep)
+    relaid[:, XF_END] = np.where(plain, before, xf_end)
+    relaid[:, FADE_IN] = np.where(plain, 0, fade_in)
+    relaid[:, TAIL_END] = np.where(plain, frames, tail_end)
+    relaid[:, LENGTH] = np.where(plain, frames, length)
+    relaid[:, AFTER] = relaid[:, KEEP] + relaid[:, LENGTH]
+    return relaid, crossfade, possible
+
+
+def unchanged_cuts(old_keys: list[tuple], keys: list[tuple]
+                   ) -> tuple[int, int]:
+    """Count the cuts that are the same at the start, and at the end, of
+    two lists of cut keys (see RenderPlan.cut_keys()). The counts do not
+    overlap."""
+    common = min(len(keys), len(old_keys))
+    prefix = next(
+        (index for index in range(common) if keys[index] != old_keys[index]),
+        common)
+    suffix = 0
+    while (suffix < common - prefix
+           and keys[-1 - suffix] == old_keys[-1 - suffix]):
+        suffix += 1
+    return prefix, suffix
+
+
+# Splicing stops looking for the point where the rest of the last render
+# can be reused after trying this many different shifts of the layout
+MAX_SHIFTS = 8
+# Room to grow, as a fraction of the output, when a buffer is allocated
+GROWTH = 0.25
+
+
+def _with_room(buffer: np.ndarray, frames: int) -> np.ndarray:
+    """Get the buffer, or a larger copy of it if it has fewer frames"""
+    if frames <= len(buffer):
+        return buffer
+    grown = np.zeros((int(frames * (1 + GROWTH)), buffer.shape[1]),
+                     dtype=buffer.dtype)
+    grown[:len(buffer)] = buffer
+    return grown
+
+
+class RenderState:
+    """The last render of the numpy engine, kept so that the changed cuts
+    of a later render can be spliced into it, see render_incremental().
+
+    keys identify the cuts, see RenderPlan.cut_keys(), and first_appends
+    has the index of the first append of each cut, followed by the number
+    of appends. For each append, layout and crossfades have its layout (see
+    Joiner.layout()), and undo the joined frames that it replaced. beats
+    holds the rendered beats, for the caller to reuse. The joined frames
+    are the first length frames of buffer, which has room to grow."""
+    def __init__(self, source: AudioSegment, curve: str, crossfade_after: bool,
+                 keys: list[tuple], beats: dict, first_appends: np.ndarray,
+                 layout: np.ndarray, crossfades: np.ndarray,
+                 undo: list[np.ndarray], buffer: np.ndarray, length: int):
+        self.source = source
+        self.curve = curve
+        self.crossfade_after = crossfade_after
+        self.keys = keys
+        self.beats = beats
+        self.first_appends = first_appends
+        self.layout = layout
+        self.crossfades = crossfades
+        self.undo = undo
+        self.buffer = buffer
+        self.length = length
+        # The output handed out last, if it is still in use
+        self._output: Optional[weakref.ref] = None
+
+    def __repr__(self) -> str:
+        return (f"RenderState: {len(self.keys)} cuts, {self.length} frames "
+                f"of output")
+
+    def matches(self, source: AudioSegment, curve: str,
+                crossfade_after: bool) -> bool:
+        """Whether a render of the same source with the same settings
+        can be spliced into this one"""
+        return (self.source is source and self.curve == curve
+                and self.crossfade_after == crossfade_after)
+
+    @property
+    def output(self) -> AudioSegment:
+        """The joined audio. It reads the samples straight from the buffer,
+        which is left as it is by later renders while the output, or an
+        array of its samples, is in use."""
+        output = self._output() if self._output is not None else None
+        if output is None:
+            if self.length:
+                output = AudioSegment.from_buffer(
+                    self.buffer[:self.length], self.source.sample_width,
+                    self.source.frame_rate, self.source.channels)
+            else:
+                output = self.source._spawn(b'')
+            self._output = weakref.ref(output)
+        return output
+
+    def in_use(self) -> bool:
+        """Whether anything else holds on to the buffer, such as an output
+        handed out before, or a view or array of its samples"""
+        # One reference is held by this state, one by getrefcount itself
+        return sys.getrefcount(self.buffer) > 2
+
+    def patch(self, lowest: int, middle: np.ndarray, tail_start: int,
+              length: int, in_place: bool = True) -> None:
+        """Write the joined frames from lowest on: middle, followed by the
+        old frames from tail_start to the end, moved, up to the new length.
+        The buffer is patched in place, unless it is too short or in_place
+        is False. Then the frames are written into a new buffer, and the
+        old one is left as it was."""
+        self._output = None
+        tail_end = self.length
+        middle_end = lowest + len(middle)
+        buffer = self.buffer
+        if length > len(buffer) or not in_place:
+            buffer = np.zeros((int(length * (1 + GROWTH)), buffer.shape[1]),
+                              dtype=buffer.dtype)
+            buffer[:lowest] = self.buffer[:lowest]
+        # NumPy copies overlapping ranges correctly
+        buffer[middle_end:length] = self.buffer[tail_start:tail_end]
+        buffer[lowest:middle_end] = middle
+        self.buffer = buffer
+        self.length = length
+
+
+def render_incremental(cuts: Callable[[int], Iterator[Cut]], keys: list[tuple],
+                       beats: dict, source: AudioSegment,
+                       previous: Optional[RenderState] = None,
+                       crossfade_after: bool = True, curve: str = 'stepped',
+                       unchanged: Optional[tuple[int, int]] = None
+                       ) -> RenderState:
+    """Join the cuts of SongTwister._iter_cuts, reusing a previous render.
+    cuts is called with the index of a cut, and returns the cuts from that
+    one on. unchanged has the number of cuts at the start and at the end
+    that are the same as in the previous render, see unchanged_cuts().
+
+    Only the appends from the first changed cut on are laid out and
+    rendered, starting from the joined frames before them, which are
+    restored from the previous render with its undo list. Once the appends
+    after the last changed cut are laid out as in the previous render,
+    only shifted, the rest of the previous render is moved instead of
+    rendered again. The output buffer of the previous render is patched in
+    place, unless an output of it is still in use, and the previous state
+    is returned as the new one. The result is the same as
+    render_cuts(), sample for sample."""
+    if previous is not None and previous.matches(source, curve,
+                                                 crossfade_after):
+        if unchanged is None:
+            unchanged = unchanged_cuts(previous.keys, keys)
+        if _splice(previous, cuts, keys, *unchanged):
+            previous.beats = beats
+            return previous
+    joined, first_appends = lay_out_cuts(cuts(0), source, crossfade_after,
+                                         curve)
+    logger.debug("Rendering %s appends into %s frames",
+                 len(joined.appends), joined.peak_length)
+    buffer = np.zeros((joined.peak_length, joined.channels),
+                      dtype=SAMPLE_DTYPES[joined.sample_width])
+    undo = []
+    length = joined.render_into(buffer, undo=undo)
+    return RenderState(source, curve, crossfade_after, keys, beats,
+                       np.array(first_appends, dtype=np.int64),
+                       joined.layout(), joined.crossfades(), undo, buffer,
+                       length)
+
+
+def _splice(state: RenderState, cuts: Callable[[int], Iterator[Cut]],
+            keys: list[tuple], prefix: int, suffix: int) -> bool:
+    """Lay out and render the appends of the cuts that differ from the
+    render of state, and patch them into it. Returns False, leaving the
+    state as it was, if the render can not be spliced."""
+    old, old_first = state.layout, state.first_appends
+    old_cuts = len(state.keys)
+    if prefix == old_cuts == len(keys):
+        return True
+    # The outputs handed out before do not change, as AudioSegments do not
+    in_place = not state.in_use()
+    start = int(old_first[prefix])
+    length_before = int(old[start - 1, AFTER]) if start else 0
+    joined = Joiner(state.source, state.curve, length=length_before)
+    new_first = []
+    remaining = cuts(prefix)
+    for _ in range(len(keys) - suffix - prefix):
+        new_first.append(start + len(joined.appends))
+        joined.add_cut(next(remaining), state.crossfade_after)
+
+    # Restore the joined frames before the first changed append, from the
+    # lowest position that it or any later append writes to
+    old_keeps = old[start:, KEEP]
+    lowest = min(int(old_keeps.min(initial=length_before)),
+                 min((item.keep for item in joined.appends),
+                     default=length_before))
+    old_output = state.buffer[:state.length]
+    restored = old_output[lowest:length_before]
+    reaching = np.flatnonzero(old_keeps < length_before)
+    last_reaching = start + int(reaching[-1]) if len(reaching) else start - 1
+    for index in range(last_reaching, start - 1, -1):
+        restored = np.concatenate(
+            (restored[:old[index, KEEP] - lowest], state.undo[index]))
+    buffer = np.zeros((max(joined.peak_length, length_before) - lowest,
+                       joined.channels),
+                      dtype=SAMPLE_DTYPES[joined.sample_width])
+    buffer[:length_before - lowest] = restored
+    length = length_before
+    undo = []
+    for item in joined.appends:
+        length = joined.write(buffer, item, length, offset=lowest, undo=undo)
+
+    # The cuts at the end that are the same as in the last render. From
+    # the first of their appends that is laid out as before, only shifted,
+    # that no later append reaches back before, and that replaces the same
+    # joined frames, the rest of the last render is reused.
+    old_suffix = old_cuts - suffix
+    suffix_start = int(old_first[old_suffix])
+    resynced = None
+    if suffix:
+        suffix_layout = old[suffix_start:]
+        suffix_before = np.concatenate((
+            [int(old[suffix_start - 1, AFTER]) if suffix_start else 0],
+            suffix_layout[:-1, AFTER]))
+        suffix_keeps = suffix_layout[:, KEEP]
+        not_reached = np.minimum.accumulate(
+            suffix_keeps[::-1])[::-1] == suffix_keeps
+        shifted_from: dict[int, np.ndarray] = {}
+    for old_cut in range(old_suffix, old_cuts):
+        index = int(old_first[old_cut])
+        shift = length - int(suffix_before[index - suffix_start])
+        if shift not in shifted_from and len(shifted_from) < MAX_SHIFTS:
+            shifted_from[shift] = _shifted_from(
+                state, suffix_start, suffix_before, shift)
+        same = shifted_from.get(shift)
+        if (same is not None and same[index - suffix_start]
+                and not_reached[index - suffix_start]):
+            keep = int(old[index, KEEP]) + shift
+            if keep >= lowest and np.array_equal(
+                    buffer[keep - lowest:length - lowest], state.undo[index]):
+                resynced = (old_cut, index, keep, shift)
+                break
+        new_first.append(start + len(joined.appends))
+        first = len(joined.appends)
+        joined.add_cut(next(remaining), state.crossfade_after)
+        for item in joined.appends[first:]:
+            if item.keep < lowest:
+                return False
+            buffer = _with_room(buffer, item.keep + item.length - lowest)
+            length = joined.write(buffer, item, length, offset=lowest,
+                                  undo=undo)
+
+    layout, crossfades = joined.layout(), joined.crossfades()
+    appends = start + len(joined.appends)
+    if resynced is None:
+        logger.debug("Rendered appends %s to %s", start, appends)
+        new_first.append(appends)
+        state.first_appends = np.concatenate(
+            (old_first[:prefix], np.array(new_first, dtype=np.int64)))
+        state.layout = np.concatenate((old[:start], layout))
+        state.crossfades = np.concatenate(
+            (state.crossfades[:start], crossfades))
+        state.undo = state.undo[:start] + undo
+        state.patch(lowest, buffer[:length - lowest], state.length, length,
+                    in_place)
+    else:
+        old_cut, index, keep, shift = resynced
+        logger.debug("Rendered appends %s to %s of %s", start, appends,
+                     appends + len(old) - index)
+        moved = old[index:].copy()
+        moved[:, [KEEP, XF_END, AFTER]] += shift
+        state.first_appends = np.concatenate((
+            old_first[:prefix], np.array(new_first, dtype=np.int64),
+            old_first[old_cut:] + (appends - index)))
+        state.layout = np.concatenate((old[:start], layout, moved))
+        state.crossfades = np.concatenate((
+            state.crossfades[:start], crossfades, state.crossfades[index:]))
+        state.undo = state.undo[:start] + undo + state.undo[index:]
+        state.patch(lowest, buffer[:keep - lowest], int(old[index, KEEP]),
+                    state.length + shift, in_place)
+    state.keys = keys
+    return True
+
+
+def _shifted_from(state: RenderState, suffix_start: int,
+                  suffix_before: np.ndarray, shift: int) -> np.ndarray:
+    """Check, for each append from suffix_start on, whether it and every
+    later append are laid out as in the render of state, shifted by shift
+    frames, if the joined length before it is shifted as much"""
+    layout = state.layout[suffix_start:]
+    crossfades = state.crossfades[suffix_start:]
+    relaid, crossfade, possible = lay_out_again(
+        layout, crossfades, suffix_before + shift, state.source.frame_rate,
+        state.curve)
+    expected = layout.copy()
+    expected[:, [KEEP, XF_END, AFTER]] += shift
+    same = (possible & (crossfade == crossfades[:, CROSSFADE])
+            & (relaid == expected).all(axis=1))
+    return np.logical_and.accumulate(same[::-1])[::-1]
+
+
+class RenderSlot:
+    """Holds the last render of a song, see RenderState. The instances
+    spawned from a song with the same audio share its slot, so that each
+    render can be spliced into the one before it."""
+    __slots__ = ('state', 'owner')
+
+    def __init__(self):
+        self.state: Optional[RenderState] = None
+        self.owner: Optional[weakref.ref] = None  # The song that rendered it
@@ -0,0 +1,232 @@
+"""Compiled render plans for SongTwister.apply_effects.
+
+A render plan is a flat edit decision list: one row per operation in a
+NumPy structured array, compiled from the bar sequence without touching
+the audio. Any render engine can run it, and it can be saved and loaded
+as a small .npz file, eg. to cache it per preset or send it to a worker.
+"""
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+import json
+
+import numpy as np
+
+from render_engine import Cut
+
+PLAN_VERSION = 1
+
+# Copy the untreated audio since the last cut
+OP_COPY = 0
+# Render a beat with its effects
+OP_BEAT = 1
+# Insert silence with the duration of a beat
+OP_SILENCE = 2
+OP_NAMES = {OP_COPY: 'copy', OP_BEAT: 'beat', OP_SILENCE: 'silence'}
+
+PLAN_DTYPE = np.dtype([
+    ('op', 'u1'),
+    ('bar', 'i4'),
+    ('beat', 'i4'),
+    ('resolution', 'i4'),
+    ('start_ms', 'f8'),  # Source span in ms
+    ('end_ms', 'f8'),
+    ('src_start', 'i8'),  # Source span in samples
+    ('src_end', 'i8'),
+    ('fade_ms', 'f8'),  # Crossfade when joining the op to the output
+    ('xf_in', 'i8'),  # The same crossfade in samples
+    ('xf_out', 'i8'),  # Samples of fade margin included at the end
+    ('effect', 'i4'),  # Index in the effect table, -1 if none
+    ('out_offset', 'i8'),  # Nominal position in the output, in samples
+])
+
+
+def _ms_to_samples(ms: int | float, frame_rate: int) -> int:
+    return int((ms / 1000) * frame_rate)
+
+
+def _from_float(value: float) -> int | float:
+    """Give back the ints that were stored as floats"""
+    return int(value) if float(value).is_integer() else float(value)
+
+
+class RenderPlan:
+    def __init__(self, ops: np.ndarray, effects: list[str],
+                 frame_rate: int, crossfade_after: bool = True,
+                 version: int = PLAN_VERSION):
+        """ops is a structured array of PLAN_DTYPE. Effect chains are
+        kept in the effects table, with the effects separated by newlines,
+        and referred to by index from the ops."""
+        if version != PLAN_VERSION:
+            raise ValueError(f"Unsupported render plan version: {version}")
+        self.ops = ops
+        self.effects = effects
+        self.frame_rate = frame_rate
+        self.crossfade_after = crossfade_after
+
+    def __repr__(self) -> str:
+        return (f"RenderPlan: {len(self.ops)} ops, "
+                f"{len(self.effects)} effect chains at {self.frame_rate} Hz")
+
+    def __len__(self) -> int:
+        return len(self.ops)
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, RenderPlan)
+                and np.array_equal(self.ops, other.ops)
+                and self.effects == other.effects
+                and self.frame_rate == other.frame_rate
+                and self.crossfade_after == other.crossfade_after)
+
+    @classmethod
+    def build(cls, steps: list[tuple], frame_rate: int,
+              crossfade_after: bool = True) -> 'RenderPlan':
+        """Build a plan from a list of (op, bar, beat, resolution,
+        start_ms, end_ms, fade_ms, fade_out_ms, effects) tuples.
+        The nominal output offsets assume that every op outputs as many
+        samples as its source span."""
+        ops = np.zeros(len(steps), dtype=PLAN_DTYPE)
+        effect_index: dict[str, int] = {}
+        offset = 0
+        for index, step in enumerate(steps):
+            (op, bar, beat, resolution, start_ms, end_ms,
+             fade_ms, fade_out_ms, effects) = step
+            row = ops[index]
+            row['op'] = op
+            row['bar'] = bar
+            row['beat'] = beat
+            row['resolution'] = resolution
+            row['start_ms'] = start_ms
+            row['end_ms'] = end_ms
+            row['src_start'] = _ms_to_samples(max(start_ms, 0), frame_rate)
+            row['src_end'] = max(
+                _ms_to_samples(end_ms, frame_rate), row['src_start'])
+            row['fade_ms'] = fade_ms
+            row['xf_in'] = _ms_to_samples(fade_ms, frame_rate)
+            row['xf_out'] = _ms_to_samples(fade_out_ms, frame_rate)
+            if effects:
+                effect_chain = '\n'.join(effects)
+                row['effect'] = effect_index.setdefault(
+                    effect_chain, len(effect_index))
+            else:
+                row['effect'] = -1
+            offset = max(offset - row['xf_in'], 0)
+            row['out_offset'] = offset
+            offset += row['src_end'] - row['src_start']
+        return cls(ops, list(effect_index), frame_rate, crossfade_after)
+
+    def effect_chain(self, index: int) -> list[str]:
+        """Get the list of effects of an effect table index"""
+        if index < 0:
+            return []
+        return self.effects[index].split('\n')
+
+    def describe(self) -> list[dict]:
+        """Get the ops as a list of dicts, for logging and inspection"""
+        return [{
+            'op': OP_NAMES[int(row['op'])],
+            **{name: row[name].item() for name in PLAN_DTYPE.names
+               if name not in ('op', 'effect')},
+            'effects': self.effect_chain(int(row['effect'])),
+        } for row in self.ops]
+
+    def _beat(self, row) -> tuple[int, dict]:
+        """Get the bar number and the beat dict of a beat op"""
+        return int(row['bar']), {
+            'number': int(row['beat']),
+            'start': _from_float(row['start_ms']),
+            'end': _from_float(row['end_ms']),
+            'resolution': int(row['resolution']),
+            'effects': self.effect_chain(int(row['effect'])),
+        }
+
+    def beats(self, start: int = 0, stop: Optional[int] = None
+              ) -> Iterator[tuple[int, dict]]:
+        """Get the bar number and the beat dict of each beat that cuts()
+        renders, in order, for the cuts from start up to stop"""
+        ops = self.ops[self._op_index(start):self._op_index(stop)]
+        for row in ops[ops['op'] != OP_COPY]:
+            yield self._beat(row)
+
+    def _op_index(self, cut: Optional[int]) -> Optional[int]:
+        """Get the index of the op that starts a cut of cuts()"""
+        if cut is None:
+            return None
+        copies = np.flatnonzero(self.ops['op'] == OP_COPY)
+        return int(copies[cut]) if cut < len(copies) else len(self.ops)
+
+    def cuts(self, render_beat: Callable[[int, dict], Optional[object]],
+             start: int = 0) -> Iterator[Cut]:
+        """Turn the ops into the cuts that the render engines join, from
+        the cut start on. render_beat is called with the bar number and a
+        beat dict for each beat, and returns the treated audio, or None to
+        leave it out."""
+        ops = self.ops
+        index = self._op_index(start)
+        while index < len(ops):
+            row = ops[index]
+            if row['op'] != OP_COPY:
+                raise ValueError(f"Render plan op {index} is not a copy op")
+            beat_audio, beat_fade = None, 0
+            following = ops[index + 1] if index + 1 < len(ops) else None
+            if following is not None and following['op'] != OP_COPY:
+                beat_fade = _from_float(following['fade_ms'])
+                beat_audio = render_beat(*self._beat(following))
+                index += 1
+            yield Cut(_from_float(row['start_ms']), _from_float(row['end_ms']),
+                      _from_float(row['fade_ms']), beat_audio, beat_fade)
+            index += 1
+
+    def cut_keys(self) -> list[tuple]:
+        """Get a key for each cut of cuts(). Cuts with the same key join
+        the same audio, the same way. The output offsets are left out, as
+        they shift when an earlier cut changes length."""
+        fields = [name for name in PLAN_DTYPE.names
+                  if name not in ('effect', 'out_offset')]
+        rows = self.ops[fields].tolist()
+        ops = self.ops['op'].tolist()
+        chains = [self.effects[index] if index >= 0 else None
+                  for index in self.ops['effect'].tolist()]
+        keys = []
+        index = 0
+        while index < len(rows):
+            key = (rows[index], chains[index])
+            if index + 1 < len(rows) and ops[index + 1] != OP_COPY:
+                index += 1
+                key += (rows[index], chains[index])
+            keys.append(key)
+            index += 1
+        return keys
+
+    # SERIALIZATION
+    def _metadata(self) -> str:
+        return json.dumps({
+            'version': PLAN_VERSION,
+            'frame_rate': self.frame_rate,
+            'crossfade_after': self.crossfade_after,
+            'effects': self.effects,
+        })
+
+    def save(self, file: str | Path | BytesIO) -> None:
+        """Write the plan to a compressed .npz file"""
+        np.savez_compressed(
+            file, ops=self.ops, metadata=np.array(self._metadata()))
+
+    @classmethod
+    def load(cls, file: str | Path | BytesIO) -> 'RenderPlan':
+        """Read a plan written by save()"""
+        with np.load(file, allow_pickle=False) as data:
+            metadata = json.loads(str(data['metadata']))
+            ops = data['ops']
+        if ops.dtype != PLAN_DTYPE:
+            raise ValueError("Render plan has an unknown layout")
+        return cls(ops=ops, **metadata)
+
+    def to_bytes(self) -> bytes:
+        buffer = BytesIO()
+        self.save(buffer)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'RenderPlan':
+        return cls.load(BytesIO(data))
@@ -0,0 +1,133 @@
+"""Polyphase resampling of sample arrays, in NumPy.
+
+AudioSegment.set_frame_rate resamples with audioop.ratecv, one sample at a
+time, and audioop is deprecated. Here a change of rate by a ratio of up/down
+is done with a windowed-sinc filter, split into up phases: every output
+frame falls between two input frames at one of up positions, and is the dot
+product of the input around it with the taps of that phase. The filter banks
+are cached per ratio and quality. The output comes in blocks of up frames,
+which repeat every down input frames, so the whole bank is laid out as one
+matrix, and all the blocks are computed with one matrix product.
+"""
+from fractions import Fraction
+import functools
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("songtwister.resample")
+
+# Quality: (zero crossings on each side of the filter, Kaiser window beta).
+# More zero crossings give a sharper cutoff and cost more per frame.
+QUALITIES = {
+    'fast': (4, 4.0),
+    'medium': (12, 7.0),
+    'best': (32, 9.0),
+}
+DEFAULT_QUALITY = 'medium'
+MAX_PHASES = 1000  # Ratios are rounded to at most this many phases
+FILTER_CACHE_SIZE = 64
+
+
+def ratio(factor: float | Fraction) -> tuple[int, int]:
+    """Get the up and down of the fraction closest to a factor of output
+    frames per input frame, with at most MAX_PHASES phases"""
+    fraction = Fraction(factor).limit_denominator(MAX_PHASES)
+    if fraction.numerator > MAX_PHASES:
+        # Mostly downsampling: limit the up instead
+        inverse = (1 / Fraction(factor)).limit_denominator(MAX_PHASES)
+        fraction = 1 / inverse
+    return fraction.numerator, fraction.denominator
+
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def filter_bank(up: int, down: int,
+                quality: str = DEFAULT_QUALITY) -> np.ndarray:
+    """Get the (up, taps) filter bank of a ratio. Phase p holds the taps of
+    the input frames -half + 1..half around an output frame p/up frames
+    after the input frame at tap half - 1. Each phase adds up to 1."""
+    zero_crossings, beta = QUALITIES[quality]
+    # When downsampling, cut off below the new Nyquist frequency
+    cutoff = min(1.0, up / down)
+    half = int(np.ceil(zero_crossings / cutoff))
+    offsets = (np.arange(up) / up)[:, None] - np.arange(-half + 1, half + 1)
+    window = np.i0(beta * np.sqrt(np.clip(1 - (offsets / half) ** 2, 0, 1)))
+    taps = cutoff * np.sinc(cutoff * offsets) * window / np.i0(beta)
+    taps /= taps.sum(axis=1, keepdims=True)
+    taps = taps.astype(np.float32)
+    taps.setflags(write=False)
+    return taps
+
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def block_filter(up: int, down: int,
+                 quality: str = DEFAULT_QUALITY) -> np.ndarray:
+    """Get the filter bank of a ratio as a (window, up) matrix, which turns
+    a window of input frames into a block of up output frames. Block q
+    starts at input frame q * down - half + 1, and the blocks repeat every
+    down input frames and up output frames."""
+    taps = filter_bank(up, down, quality)
+    befores = np.arange(up) * down // up
+    phases = np.arange(up) * down % up
+    matrix = np.zeros((befores[-1] + taps.shape[1], up), dtype=np.float32)
+    for output, (before, phase) in enumerate(zip(befores, phases)):
+        matrix[before:before + taps.shape[1], output] = taps[phase]
+    matrix.setflags(write=False)
+    return matrix
+
+
+def _to_dtype(samples: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """Round float samples to an integer sample type"""
+    info = np.iinfo(dtype)
+    return np.clip(np.rint(samples), info.min, info.max).astype(dtype)
+
+
+def output_frames(frames: int, up: int, down: int) -> int:
+    """The number of frames of frames input frames resampled by up/down"""
+    return -(-frames * up // down)
+
+
+def resample_batch(beats: list[np.ndarray], up: int, down: int,
+                   quality: str = DEFAULT_QUALITY) -> list[np.ndarray]:
+    """Resample each (frames, channels) sample array of beats by up/down.
+    The beats are laid out in padded rows and resampled together, a block
+    of up output frames per matrix product."""
+    if not beats:
+        return []
+    if up == down:
+        return [beat.copy() for beat in beats]
+    half = filter_bank(up, down, quality).shape[1] // 2
+    matrix = block_filter(up, down, quality)
+    lengths = [len(beat) for beat in beats]
+    outs = [output_frames(length, up, down) for length in lengths]
+    blocks = -(-max(outs) // up)
+    channels = beats[0].shape[1]
+    # Pad with silence, so the first and the last block may reach past
+    # the ends of the beats
+    length = max(max(blocks - 1, 0) * down + len(matrix) + 1,
+                 max(lengths) + 2 * half)
+    rows = np.zeros((len(beats), length, channels), dtype=np.float32)
+    for row, beat in enumerate(beats):
+        rows[row, half:half + len(beat)] = beat
+    windows = np.lib.stride_tricks.sliding_window_view(
+        rows[:, 1:], len(matrix), axis=1)[:, :blocks * down:down]
+    # (beats, blocks, channels, window) @ (window, up)
+    resampled = np.matmul(windows, matrix)
+    resampled = resampled.transpose(0, 1, 3, 2).reshape(
+        len(beats), -1, channels)
+    return [_to_dtype(resampled[row, :out], beat.dtype)
+            for row, (beat, out) in enumerate(zip(beats, outs))]
+
+
+def resample(samples: np.ndarray, up: int, down: int,
+             quality: str = DEFAULT_QUALITY) -> np.ndarray:
+    """Resample a (frames, channels) sample array by up/down"""
+    return resample_batch([samples], up, down, quality)[0]
+
+
+def change_speed(samples: np.ndarray, speed: float, frame_rate: int,
+                 quality: str = DEFAULT_QUALITY) -> np.ndarray:
+    """Play a sample array at a speed, like playing it at a frame rate of
+    int(frame_rate * speed), which changes the pitch along with it"""
+    up, down = ratio(Fraction(frame_rate, int(frame_rate * speed)))
+    return resample(samples, up, down, quality)
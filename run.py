@@ -1,40 +1,67 @@
 import sys
+import copy
 import json
 import argparse
+import fnmatch
 from pathlib import Path
 from typing import Optional
 from collections import ChainMap
+from concurrent.futures import ProcessPoolExecutor
 import logging
 from datetime import datetime, date
 import os
 
 import yaml
 from jinja2 import Environment, FileSystemLoader
+from pydub.exceptions import CouldntDecodeError
 
-from songtwister import SongTwister
+from songtwister import SongTwister, ExportResult, OutputTarget
+from decode_cache import DecodeCache
+from output_cache import OutputCache
+from peaks import peaks_file_path
+from beat_cache import BeatCache, BeatCacheStats, log_stats
+import batch_manifest
+from batch_manifest import BatchManifest
+import shared_audio
 
 SCRIPT_DIR = Path(os.path.dirname(os.path.realpath(__file__)))
+# The files looked at when detecting the bpm of a directory
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.flac', '.ogg', '.oga', '.opus', '.m4a',
+                    '.aac', '.aif', '.aiff')
 
 logger = logging.getLogger('loading_logger')
 
 
 def guess_prefix_length(song_object: SongTwister, export_prefix=False,
+                        export_bars=False,
                         test_bars=[1, 9, 12, 17, 33, 65]) -> None:
     logger.info("Trying to determine the prefix of song '%s'", song_object)
-    autoprefix = song_object.detect_prefix()
+    fit = song_object.fit_beat_grid()
+    if fit is not None:
+        notes = [
+            f"Fitted prefix: {fit.prefix_length_ms}",
+            f"Fitted bpm: {fit.bpm}",
+            f"Grid score: {fit.score}",
+        ]
+        # Export the test bars with the fitted grid
+        song_object.set_new_tempo(fit.bpm)
+        song_object.set_prefix_and_suffix(prefix_length_ms=fit.prefix_length_ms)
+    else:
+        notes = [
+            f"Autodetected prefix: {song_object.detect_prefix()}"
+        ]
     if export_prefix:
         song_object.save_audio(song_object.get_prefix(), 'offset')
     sections = []
-    notes = [
-        f"Autodetected prefix: {autoprefix}"
-    ]
     for note in notes:
         logger.info(note)
+    if not export_bars:
+        return
     for bar_number in test_bars:
         result = song_object.save_bar(bar_number)
         if not result:
             return
-        filename, peaks = result
+        filename, peaks = result.filename, result.peaks
         if isinstance(filename, str):
             file = filename.split('/')[-1]
         elif isinstance(filename, Path):
@@ -50,9 +77,46 @@ def guess_prefix_length(song_object: SongTwister, export_prefix=False,
         title=song_object.title, notes=notes)
 
 
+def log_bpm_candidates(song_object: SongTwister) -> None:
+    logger.info("Tempo candidates of '%s': %s", song_object.title, ", ".join(
+        f"{candidate.bpm} bpm ({candidate.confidence})"
+        for candidate in song_object.bpm_candidates) or "none")
+
+
+def detect_bpm(paths: list[Path], data_path: Optional[Path] = None) -> dict:
+    """Detect the tempo of audio files, and log the candidates. Returns a
+    song definition for each file, with the most likely bpm, keyed by the
+    title of the song. Filenames in data_path are made relative to it."""
+    definitions = {}
+    for path in paths:
+        try:
+            song_object = SongTwister(filename=path)
+        except (CouldntDecodeError, ValueError) as e:
+            logger.error("Could not detect the bpm of %s: %s", path, e)
+            continue
+        log_bpm_candidates(song_object)
+        filename = path
+        if data_path is not None and path.resolve().is_relative_to(
+                data_path.resolve()):
+            filename = path.resolve().relative_to(data_path.resolve())
+        definitions[song_object.title] = {
+            'filename': str(filename),
+            'bpm': song_object.bpm,
+            'prefix_length_ms': 0,
+        }
+    return definitions
+
+
+def list_audio_files(path: Path) -> list[Path]:
+    """Get the audio files in a directory, or the path if it is a file"""
+    if path.is_dir():
+        return sorted(file for file in path.iterdir()
+                      if file.suffix.lower() in AUDIO_EXTENSIONS)
+    return [path]
+
+
 def make_html(output_file, song, sections, template_file=None, title=None,
               notes=None) -> None:
-    environment = Environment(loader=FileSystemLoader("."))
     if not template_file:
         template_file = './resources/waveform_template.html.j2'
     if not isinstance(template_file, Path):
@@ -60,7 +124,9 @@ def make_html(output_file, song, sections, template_file=None, title=None,
     if not template_file.exists():
         logger.error("Could not export HTML - template file not found at %s",
                      template_file)
-    template = environment.get_template()
+        return
+    environment = Environment(loader=FileSystemLoader(template_file.parent))
+    template = environment.get_template(template_file.name)
 
     content = template.render(
         song=song,
@@ -69,9 +135,13 @@ def make_html(output_file, song, sections, template_file=None, title=None,
         sections=sections or [],
     )
 
-    with open(output_file, mode="w", encoding="utf-8") as writer:
+    # Replace the file instead of writing through it, as it may be
+    # hard-linked from the output cache
+    temp_file = Path(f"{output_file}.{os.getpid()}.tmp")
+    with open(temp_file, mode="w", encoding="utf-8") as writer:
         writer.write(content)
-        logger.info(f"Wrote {output_file}")
+    os.replace(temp_file, output_file)
+    logger.info(f"Wrote {output_file}")
 
 
 def read_yaml(path: str | Path) -> dict:
@@ -112,12 +182,18 @@ def write_json(file: str, content: dict | list) -> None:
         return writer.write(json.dumps(content, indent=2))
 
 
+def song_html_file(stem_filepath: str, preset: str,
+                   version_name: Optional[str] = None) -> str:
+    """Get the path of the HTML page of a preset of a song"""
+    version = f"{version_name}_" if version_name else ""
+    return f"{stem_filepath}_{version}{preset}.html"
+
+
 def save_song_html(song_object: SongTwister, peaks, filename: str,
                    preset: str, version_name: Optional[str] = None) -> None:
-    version = f"{version_name}_" if version_name else ""
-    html_file = f"{song_object.stem_filepath}_{version}{preset}.html"
+    html_file = song_html_file(song_object.stem_filepath, preset, version_name)
     sections = [{
-        'file': filename.split('/')[-1],
+        'file': Path(filename).name,
         'waveform': peaks
     }]
     make_html(
@@ -159,12 +235,200 @@ def select_presets(preset_list: list[str], selection: str) -> list[str]:
     return list(set(presets_to_apply))
 
 
+def select_songs(song_list: list[str], selectors: list[str]) -> list[str]:
+    """Get the songs matching any of the selectors, in order. A selector
+    is 'all', a song name, a glob pattern of song names, or the path of a
+    file with a selector on each line. Selectors may be separated by
+    commas, as with presets."""
+    songs = []
+    for selector in [part.strip() for selectors_item in selectors
+                     for part in selectors_item.split(',') if part.strip()]:
+        if Path(selector).is_file():
+            with open(selector, 'r') as reader:
+                lines = [line.strip() for line in reader]
+            songs.extend(select_songs(song_list, [
+                line for line in lines if line and not line.startswith('#')]))
+            continue
+        matches = (list(song_list) if selector == 'all'
+                   else fnmatch.filter(song_list, selector))
+        if not matches:
+            logger.info("Could not find song '%s' - skipping", selector)
+        songs.extend(matches)
+    return list(dict.fromkeys(songs))
+
+
+def choose_presets(preset_name: Optional[str], make_all: bool,
+                   preferences_config: dict, all_presets: dict) -> list[str]:
+    """Get the presets selected on the command line, or the main set
+    defined in config"""
+    # Apply a specific preset or the main set defined in config
+    if make_all or not preset_name:
+        presets_to_apply: list[str] = preferences_config.get('main_preset_set')
+        logger.info("Rendering the main preset set.")
+    # elif preset_name == '*':
+    #     presets_to_apply = list(all_presets.keys())
+    #     logger.info("Rendering every preset.")
+    # else:
+    #     presets_to_apply = [preset_name]
+    else:
+        presets_to_apply: list[str] = select_presets(
+            preset_list=list(all_presets.keys()), selection=preset_name)
+    return presets_to_apply
+
+
+def prepare_song_data(song_name: str, song_data: dict, config: dict,
+                      seed: Optional[int] = None) -> dict:
+    """Get a copy of a song definition, with the preferences in config
+    that the song does not set, and the full path of its audio file.
+    seed is the seed given on the command line, if any.
+    Raises ValueError if the song has no filename, and FileNotFoundError
+    if the file does not exist."""
+    song_data = copy.deepcopy(song_data)
+    locations_config: dict = config.get('locations')
+    preferences_config = config.get('preferences')
+    html_config = config.get('html_visualization')
+
+    # Set how the effects are rendered, unless the song sets it
+    render_engine = preferences_config.get('render_engine')
+    if render_engine and 'render_engine' not in song_data:
+        song_data['render_engine'] = render_engine
+
+    # Set the shape of the crossfades, unless the song sets it
+    crossfade_curve = preferences_config.get('crossfade_curve')
+    if crossfade_curve and 'crossfade_curve' not in song_data:
+        song_data['crossfade_curve'] = crossfade_curve
+
+    # Set the quality of the resampling of speed and pitch effects,
+    # unless the song sets it
+    resample_quality = preferences_config.get('resample_quality')
+    if resample_quality and 'resample_quality' not in song_data:
+        song_data['resample_quality'] = resample_quality
+
+    # Seed the random selections, unless the song sets a seed
+    if seed is None:
+        preferred_seed = preferences_config.get('seed')
+        if preferred_seed is not None and 'seed' not in song_data:
+            song_data['seed'] = preferred_seed
+    else:
+        song_data['seed'] = seed
+
+    # Set how detailed the peak data of the generated audio will be
+    waveform_resolution = html_config.get('waveform_resolution')
+    if waveform_resolution and 'waveform_resolution' not in song_data:
+        song_data['waveform_resolution'] = waveform_resolution
+
+    try:
+        input_file = Path(song_data.get('filename'))
+    except TypeError as e:
+        raise ValueError(e) from e
+    if not input_file.is_absolute():
+        input_file = SCRIPT_DIR / locations_config.get(
+            'default_data_path') / input_file
+    if not input_file.exists():
+        raise FileNotFoundError(f"Could not find input file at {input_file}")
+    song_data['filename'] = input_file
+    return song_data
+
+
+def make_preset_jobs(presets: list[str], all_presets: dict,
+                     job_options: dict) -> list[dict]:
+    """Get the arguments of render_preset for each preset. Each job gets
+    its own copy of the preset, as rendering may change it."""
+    return [{
+        'preset': preset,
+        'preset_data': copy.deepcopy(all_presets.get(preset)),
+        **job_options,
+    } for preset in presets]
+
+
+def selects_at_random(data) -> bool:
+    """Whether a song definition or preset selects bars or beats at random,
+    eg. with 'random 4' or 'replace random random'"""
+    if isinstance(data, dict):
+        return any(selects_at_random(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return any(selects_at_random(value) for value in data)
+    return (isinstance(data, str)
+            and 'random' in data.replace(',', ' ').split())
+
+
+def restore_cached_outputs(output_cache: OutputCache, song_data: dict,
+                           preset_jobs: list[dict], rerender: bool = False
+                           ) -> tuple[list[Optional[str]],
+                                      list[Optional[ExportResult]]]:
+    """Get the output cache key of each preset job, and put the outputs of
+    the jobs that are cached back in place. Returns the keys, and the
+    result of each job, or None for the jobs that must be rendered.
+    With rerender, every job is rendered. Without a seed, the jobs that
+    select at random are not cached, and get None as their key, as they
+    make new selections every time."""
+    unseeded = song_data.get('seed') is None
+    song_is_random = unseeded and selects_at_random(song_data)
+    keys = [None if song_is_random or (
+        unseeded and selects_at_random(preset_job.get('preset_data')))
+        else output_cache.key(
+            song_data.get('filename'), song_data=song_data,
+            **{name: value for name, value in preset_job.items()
+               if name != 'overwrite'})
+        for preset_job in preset_jobs]
+    results: list[Optional[ExportResult]] = [None] * len(preset_jobs)
+    if rerender:
+        return keys, results
+    for index, (key, preset_job) in enumerate(zip(keys, preset_jobs)):
+        if key is None:
+            logger.debug("The preset %s selects at random without a seed, "
+                         "so it is rendered again", preset_job.get('preset'))
+            continue
+        info = output_cache.restore(key, overwrite=preset_job.get('overwrite'))
+        if info is None:
+            continue
+        results[index] = ExportResult(
+            Path(info.get('filename')), info.get('peaks'),
+            tuple(Path(filename) for filename in info.get('filenames', [])))
+        logger.info("The preset %s is up to date: %s", preset_job.get('preset'),
+                    ', '.join(info.get('filenames', [])))
+    return keys, results
+
+
+def store_outputs(output_cache: OutputCache, key: Optional[str],
+                  song: SongTwister, preset_job: dict,
+                  result: Optional[ExportResult]) -> None:
+    """Store the files written by a preset job in the output cache, unless
+    it has no key"""
+    if result is None or key is None:
+        return
+    files = list(result.filenames)
+    if preset_job.get('peaks_file'):
+        files.extend(peaks_file_path(filename) for filename in result.filenames)
+    if preset_job.get('create_html_file'):
+        files.append(song_html_file(song.stem_filepath, preset_job.get('preset'),
+                                    preset_job.get('version_name')))
+    try:
+        output_cache.store(
+            key, files, filename=str(result.filename), peaks=result.peaks,
+            filenames=[str(filename) for filename in result.filenames])
+    except OSError as e:
+        logger.warning("Could not store the outputs of the preset %s in the "
+                       "output cache: %s", preset_job.get('preset'), e)
+
+
 def get_args(overwrite_default: bool = False, make_html_default: bool = False,
-             verbose_default: bool = False) -> argparse.Namespace:
+             verbose_default: bool = False,
+             jobs_default: int = 1) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument("-s", "--song", required=True, type=str,
+    parser.add_argument("-s", "--song", required=False, type=str,
                         help="The name of the song definition, "
                         "set in the songs file")
+    parser.add_argument("-b", "--batch", action="append", metavar="SONGS",
+                        help="Render the presets for several songs in one "
+                        "run: 'all', a song name, a pattern like 'live_*', "
+                        "or a file with one of those on each line. May be "
+                        "repeated. The status of each job is kept in a "
+                        "manifest, and jobs that are done are skipped when "
+                        "the batch is run again.")
+    parser.add_argument("--manifest", required=False, type=str,
+                        help="The manifest file of a batch. Default is set "
+                        "in the config file.")
     parser.add_argument("-p", "--preset", required=False, type=str,
                         help="The preset to use. Presets may be defined "
                         "in the presets file and called here by name. "
@@ -184,8 +448,17 @@ def get_args(overwrite_default: bool = False, make_html_default: bool = False,
                         action="store_true",
                         default=False,
                         help="Guess the number of milliseconds of prefix "
-                        "in the song before the beat starts, and generate "
-                        "files with single bars to evaluate the guessed value.")
+                        "in the song before the beat starts, and a more "
+                        "exact bpm, by fitting a beat grid to the audio. "
+                        "With --make-html, files with single bars are "
+                        "generated to evaluate the guessed values.")
+    parser.add_argument("--detect-bpm", nargs="?", const=True, default=None,
+                        metavar="PATH",
+                        help="Detect the tempo of the song, and log the most "
+                        "likely bpm values instead of rendering. If an audio "
+                        "file or a directory of audio files is given, no "
+                        "song is needed, and a song definition with the "
+                        "detected bpm is printed for each file.")
     parser.add_argument("-l", "--make-html",
                         action="store_true",
                         default=make_html_default,
@@ -200,11 +473,41 @@ def get_args(overwrite_default: bool = False, make_html_default: bool = False,
                         action="store_true",
                         default=overwrite_default,
                         help="Overwrite existing files with same name.")
+    parser.add_argument("-r", "--rerender", action="store_true",
+                        help="Render the presets even if their outputs are "
+                        "in the output cache and up to date.")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=jobs_default,
+                        help="Number of presets to render in parallel, "
+                        "each in its own process.")
+    parser.add_argument("-o", "--output", action="append",
+                        dest="outputs", metavar="FORMAT[:BITRATE[:CODEC]]",
+                        help="A format to write each preset in, eg. mp3:320k. "
+                        "May be repeated to write several files with one "
+                        "encoder run. Default is the format of the song.")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed the random selections of bars and beats, "
+                        "to make the same random choices on every run.")
     parser.add_argument("-v", "--verbose",
                         action="store_true",
                         default=verbose_default,
                         help="Output detailed logging.")
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not (args.song or args.batch or isinstance(args.detect_bpm, str)):
+        parser.error("one of the arguments -s/--song -b/--batch is required")
+    return args
+
+
+def parse_output_target(target: str | dict) -> OutputTarget:
+    """Get an output target from a FORMAT[:BITRATE[:CODEC]] string,
+    or from a dict with those keys"""
+    if isinstance(target, dict):
+        return OutputTarget(**target)
+    output_format, bitrate, codec = (target.split(':') + [None, None])[:3]
+    if not output_format:
+        raise ValueError(f"Invalid output target: {target}")
+    return OutputTarget(format=output_format, codec=codec or None,
+                        bitrate=bitrate or None)
 
 
 def set_up_logging(logging_config: dict, logging_level: int) -> logging.Logger:
@@ -226,6 +529,272 @@ def set_up_logging(logging_config: dict, logging_level: int) -> logging.Logger:
     return logging.getLogger("run")
 
 
+def apply_preset(song: SongTwister, preset: str, preset_data: dict,
+                 crossfade: Optional[int | str], default_crossfade: int | str
+                 ) -> tuple[SongTwister, int | str]:
+    """Apply a preset to a copy of the song. Returns the new song, and the
+    crossfade that was used."""
+    song_object = song.spawn_new_instance()
+    preset_crossfade = crossfade
+    # If a specifc crossfade has not been passed, we look in the preset
+    if preset_crossfade is None:
+        preset_crossfade = preset_data.get('crossfade')
+
+    # If the preset does not have a crossfade defined, we use the default
+    if preset_crossfade is None:
+        preset_crossfade = default_crossfade
+    song_object.set_crossfade(preset_crossfade)
+    # The preset may set the shape of the crossfades
+    if preset_data.get('crossfade_curve'):
+        song_object.crossfade_curve = preset_data.get('crossfade_curve')
+    if preset_data.get('resample_quality'):
+        song_object.resample_quality = preset_data.get('resample_quality')
+
+    if 'edit' in preset_data:
+        song_object = song_object.edit(preset_data.get('edit'))
+
+    logger.info(
+        "Processing '%s' using the preset %s and a crossfade of %s",
+        song_object.filename, preset, preset_crossfade)
+
+
+    # The song config may limit the preset to certain bars
+    # (see README for details on selecting)
+    # if 'bars' in song_data:
+    #     for preset_effect in preset_effects:
+    #         preset_effect['bars'] = song_data.get('bars')
+
+    effect_chain: list[list[dict]] = list(preset_data.get('effect_chain') or [])
+    preset_effects = preset_data.get('effects')
+    if preset_effects:
+        effect_chain.append(preset_effects)
+
+    for effects in effect_chain:
+        song_object.add_effects(effects)
+        song_object = song_object.apply_effects()
+    return song_object, preset_crossfade
+
+
+def render_preset(song: SongTwister, preset: str, preset_data: Optional[dict],
+                  crossfade: Optional[int | str], default_crossfade: int | str,
+                  version_name: str = '', overwrite: bool = False,
+                  create_html_file: bool = False,
+                  outputs: Optional[list[OutputTarget]] = None,
+                  peaks_file: bool = False) -> Optional[ExportResult]:
+    """Apply a preset to a copy of the song and save the result.
+    Errors are logged, and None is returned if the preset was skipped."""
+    if not preset_data:
+        logger.error("Failed to find preset '%s'", preset)
+        return
+    song_object, preset_crossfade = apply_preset(
+        song, preset, preset_data, crossfade, default_crossfade)
+
+    fade_label = preset_crossfade.replace('/', '-') if isinstance(preset_crossfade, str) else str(preset_crossfade)
+    export_version_name = "_".join((
+        version_name, preset, f"fade-{fade_label}")).removeprefix('_')
+    # TODO: Get the output path first and check that it is can be
+    # written to, before generating the audio.
+    try:
+        exported = song_object.save_audio(
+            audio=song_object.audio,
+            version_name=export_version_name,
+            overwrite=overwrite,
+            outputs=outputs,
+            peaks_file=peaks_file
+        )
+    except (FileExistsError, FileNotFoundError, PermissionError,
+            ValueError) as e:
+        logger.error("Skipping preset due to this error: %s", e)
+        return
+    if create_html_file:
+        save_song_html(
+            song_object=song_object,
+            peaks=exported.peaks,
+            filename=exported.filename,
+            preset=preset,
+            version_name=version_name
+        )
+    return exported
+
+
+# Set up in each worker process by _init_preset_worker
+_worker_song: Optional[SongTwister] = None
+
+
+def _init_preset_worker(song_state: dict, audio_info: dict,
+                        logging_config: dict, logging_level: int,
+                        beat_cache_size_mb: Optional[int | float]) -> None:
+    global logger, _worker_song
+    logger = set_up_logging(logging_config, logging_level)
+    # Each worker caches the beats of the presets it renders
+    SongTwister.beat_cache = (BeatCache(max_size_mb=beat_cache_size_mb)
+                              if beat_cache_size_mb else None)
+    _worker_song = SongTwister(**song_state,
+                               audio=shared_audio.attach_audio(audio_info))
+
+
+def _render_preset_job(preset_job: dict
+                       ) -> tuple[Optional[ExportResult], Optional[BeatCacheStats]]:
+    """Render a preset in a worker. Returns the result, and the beat cache
+    lookups made for it, if the worker has a beat cache."""
+    beat_cache = SongTwister.beat_cache
+    before = beat_cache.stats() if beat_cache is not None else None
+    result = None
+    try:
+        result = render_preset(_worker_song, **preset_job)
+    except Exception as e:
+        # Report unexpected errors here, as they would otherwise only
+        # show up when the result is collected
+        logger.exception("Failed to render preset '%s': %s",
+                         preset_job.get('preset'), e)
+    if beat_cache is None:
+        return result, None
+    return result, BeatCacheStats(
+        *(after - earlier for after, earlier in zip(beat_cache.stats(), before)))
+
+
+def render_presets_in_parallel(song: SongTwister, preset_jobs: list[dict],
+                               jobs: int, logging_config: dict,
+                               logging_level: int,
+                               beat_cache_size_mb: Optional[int | float] = None
+                               ) -> list[Optional[ExportResult]]:
+    """Render presets in a pool of worker processes. The audio of the
+    song is placed in shared memory once, and each worker attaches to it,
+    instead of decoding the file again or receiving the audio pickled.
+    If beat_cache_size_mb is set, each worker has a beat cache of that size,
+    and the lookups of all the workers are logged when they are done."""
+    if not song.audio:
+        song.load_audio()
+    block, audio_info = shared_audio.share_audio(song.audio)
+    logger.info("Rendering %s presets in %s processes",
+                len(preset_jobs), min(jobs, len(preset_jobs)))
+    try:
+        with ProcessPoolExecutor(
+                max_workers=min(jobs, len(preset_jobs)),
+                initializer=_init_preset_worker,
+                initargs=(song.export_state(), audio_info,
+                          logging_config, logging_level,
+                          beat_cache_size_mb)) as executor:
+            results = list(executor.map(_render_preset_job, preset_jobs))
+    finally:
+        shared_audio.release_audio(block)
+    job_stats = [stats for _, stats in results if stats]
+    if job_stats:
+        log_stats(BeatCacheStats(*map(sum, zip(*job_stats))))
+    return [result for result, _ in results]
+
+
+def run_batch(manifest: BatchManifest, song_names: list[str],
+              all_songs: dict, presets: list[str], all_presets: dict,
+              job_options: dict, config: dict, seed: Optional[int] = None,
+              jobs: int = 1, logging_config: Optional[dict] = None,
+              logging_level: int = logging.INFO,
+              beat_cache_size_mb: Optional[int | float] = None,
+              output_cache: Optional[OutputCache] = None,
+              rerender: bool = False) -> None:
+    """Render each preset of each song, and record the status of every job
+    in the manifest as it finishes. Jobs the manifest has as done are
+    skipped, so a batch can be run again to pick up where it stopped.
+    Each song is loaded once for all of its jobs, and not at all if the
+    output cache has all of them."""
+    batch_jobs: dict[str, dict[str, str]] = {}
+    for song_name in song_names:
+        for preset in presets:
+            job = batch_manifest.job_id(
+                song_name, preset, job_options.get('version_name'),
+                job_options.get('crossfade'))
+            manifest.add(job, song=song_name, preset=preset)
+            batch_jobs.setdefault(song_name, {})[job] = preset
+    manifest.save()
+    total = sum(len(song_jobs) for song_jobs in batch_jobs.values())
+    pending_jobs = {song_name: manifest.pending(list(song_jobs))
+                    for song_name, song_jobs in batch_jobs.items()}
+    logger.info("Batch of %s jobs for %s songs, %s done before. Manifest: %s",
+                total, len(song_names),
+                total - sum(map(len, pending_jobs.values())), manifest.path)
+
+    for song_name, song_jobs in pending_jobs.items():
+        if not song_jobs:
+            continue
+        preset_jobs = make_preset_jobs(
+            [batch_jobs[song_name][job] for job in song_jobs], all_presets,
+            job_options)
+        try:
+            song_data = prepare_song_data(
+                song_name, all_songs.get(song_name), config, seed=seed)
+            keys: list[Optional[str]] = []
+            if output_cache is not None:
+                keys, cached = restore_cached_outputs(
+                    output_cache, song_data, preset_jobs, rerender=rerender)
+                for job, result in zip(song_jobs, cached):
+                    if result is not None:
+                        _mark_job(manifest, job, result)
+                song_jobs, preset_jobs, keys = _uncached(
+                    cached, song_jobs, preset_jobs, keys)
+                if not song_jobs:
+                    continue
+            song = SongTwister(**song_data)
+            if 'edit' in song_data:
+                song = song.edit(song_data.get('edit'))
+        except (ValueError, FileNotFoundError) as e:
+            logger.error("Failed to load song '%s': %s", song_name, e)
+            for job in song_jobs:
+                manifest.mark(job, batch_manifest.FAILED, error=str(e))
+            continue
+        except Exception as e:
+            logger.exception("Failed to load song '%s': %s", song_name, e)
+            for job in song_jobs:
+                manifest.mark(job, batch_manifest.FAILED, error=str(e))
+            continue
+
+        logger.info("Rendering %s presets of '%s'", len(song_jobs), song_name)
+        if jobs > 1 and len(preset_jobs) > 1:
+            results = render_presets_in_parallel(
+                song, preset_jobs, jobs=jobs, logging_config=logging_config,
+                logging_level=logging_level,
+                beat_cache_size_mb=beat_cache_size_mb)
+            for index, (job, result) in enumerate(zip(song_jobs, results)):
+                if output_cache is not None:
+                    store_outputs(output_cache, keys[index], song,
+                                  preset_jobs[index], result)
+                _mark_job(manifest, job, result)
+        else:
+            for index, (job, preset_job) in enumerate(zip(song_jobs, preset_jobs)):
+                try:
+                    result = render_preset(song, **preset_job)
+                except Exception as e:
+                    logger.exception("Failed to render preset '%s': %s",
+                                     preset_job.get('preset'), e)
+                    manifest.mark(job, batch_manifest.FAILED, error=repr(e))
+                    continue
+                if output_cache is not None:
+                    store_outputs(output_cache, keys[index], song, preset_job,
+                                  result)
+                _mark_job(manifest, job, result)
+
+    if SongTwister.beat_cache is not None and jobs == 1:
+        log_stats(SongTwister.beat_cache.stats())
+    logger.info("Batch finished: %s", manifest)
+
+
+def _uncached(results: list[Optional[ExportResult]], *job_lists: list
+              ) -> tuple[list, ...]:
+    """Keep the items of each list of jobs whose result is None"""
+    return tuple([item for item, result in zip(items, results) if result is None]
+                 for items in job_lists)
+
+
+def _mark_job(manifest: BatchManifest, job: str,
+              result: Optional[ExportResult]) -> None:
+    """Record the result of render_preset in the manifest"""
+    if result is None:
+        manifest.mark(job, batch_manifest.FAILED,
+                      error="Skipped, see the log for details")
+    else:
+        manifest.mark(job, batch_manifest.DONE,
+                      outputs=[str(filename) for filename in result.filenames])
+
+
 def main() -> None:
     global logger
     try:
@@ -252,7 +821,8 @@ def main() -> None:
 
     args = get_args(overwrite_default=overwrite_default,
                     make_html_default=make_html_default,
-                    verbose_default=verbose_default)
+                    verbose_default=verbose_default,
+                    jobs_default=preferences_config.get('jobs') or 1)
 
     song_name: str = args.song
     preset_name = args.preset
@@ -262,126 +832,150 @@ def main() -> None:
     version_name: str = args.version_name or ''
     create_html_file: bool = args.make_html
     overwrite: bool = args.overwrite
+    jobs: int = max(args.jobs, 1)
+    outputs = [parse_output_target(target) for target in
+               args.outputs or preferences_config.get('outputs') or []]
 
     logging_level = logging.DEBUG if args.verbose else logging_level
     logger = set_up_logging(logging_config, logging_level)
 
+    # Keep the decoded audio on disk, so the songs are only decoded once
+    decode_cache_config = config.get('decode_cache') or {}
+    if decode_cache_config.get('enabled'):
+        cache_path = Path(decode_cache_config.get('path', './cache/decoded/'))
+        if not cache_path.is_absolute():
+            cache_path = SCRIPT_DIR / cache_path
+        SongTwister.decode_cache = DecodeCache(
+            path=cache_path,
+            max_size_mb=decode_cache_config.get('max_size_mb', 2048))
+
+    # Keep the rendered outputs, to skip the renders that have not changed
+    output_cache_config = config.get('output_cache') or {}
+    output_cache = None
+    if output_cache_config.get('enabled'):
+        cache_path = Path(output_cache_config.get('path', './cache/outputs/'))
+        if not cache_path.is_absolute():
+            cache_path = SCRIPT_DIR / cache_path
+        output_cache = OutputCache(
+            path=cache_path,
+            max_size_mb=output_cache_config.get('max_size_mb', 4096))
+
+    # Keep the rendered beats in memory, to reuse them across presets
+    beat_cache_config = config.get('beat_cache') or {}
+    beat_cache_size_mb = None
+    if beat_cache_config.get('enabled'):
+        beat_cache_size_mb = beat_cache_config.get('max_size_mb', 256)
+        SongTwister.beat_cache = BeatCache(max_size_mb=beat_cache_size_mb)
+
+    if isinstance(args.detect_bpm, str):
+        definitions = detect_bpm(
+            list_audio_files(Path(args.detect_bpm)),
+            data_path=SCRIPT_DIR / locations_config.get('default_data_path'))
+        print(yaml.safe_dump(definitions, sort_keys=False), end='')
+        return  # In this case, we quit here
+
     all_songs: dict = read_yaml(locations_config.get('song_definitions'))
+
+    # Set crossfade if it has been supplied as an arg
+    crossfade = args.crossfade
+    if crossfade and crossfade.isnumeric():
+        crossfade = int(crossfade)
+    job_options = {
+        'crossfade': crossfade,
+        'default_crossfade': preferences_config.get('crossfade'),
+        'version_name': version_name,
+        'overwrite': overwrite,
+        'create_html_file': create_html_file,
+        'outputs': outputs,
+        'peaks_file': html_config.get('peaks_file', False),
+    }
+
+    if args.batch:
+        manifest_path = args.manifest
+        if not manifest_path:
+            manifest_path = Path((config.get('batch') or {}).get(
+                'manifest', './batch_manifest.json'))
+            if not manifest_path.is_absolute():
+                manifest_path = SCRIPT_DIR / manifest_path
+        run_batch(
+            manifest=BatchManifest(manifest_path),
+            song_names=select_songs(list(all_songs), args.batch),
+            all_songs=all_songs,
+            presets=choose_presets(preset_name, make_all, preferences_config,
+                                   all_presets),
+            all_presets=all_presets, job_options=job_options, config=config,
+            seed=args.seed, jobs=jobs, logging_config=logging_config,
+            logging_level=logging_level,
+            beat_cache_size_mb=beat_cache_size_mb,
+            output_cache=output_cache, rerender=args.rerender)
+        return  # In this case, we quit here
+
     song_data = all_songs.get(song_name)
     if not song_data:
         raise ValueError(f'ERROR: Song not found: {song_name}')
 
-    # Set how detailed the peak data of the generated audio will be
-    waveform_resolution = html_config.get('waveform_resolution')
-    if waveform_resolution and 'waveform_resolution' not in song_data:
-        song_data['waveform_resolution'] = waveform_resolution
-
     try:
-        input_file = Path(song_data.get('filename'))
-    except TypeError as e:
+        song_data = prepare_song_data(song_name, song_data, config,
+                                      seed=args.seed)
+    except ValueError as e:
         logger.error("Could not find input file. Did you write a 'filename' "
                      "in the song definition for '%s'? %s", song_name, e)
         sys.exit(1)
-    if not input_file.is_absolute():
-        input_file = SCRIPT_DIR / locations_config.get(
-            'default_data_path') / input_file
-    if not input_file.exists():
-        logger.error("Could not find input file at %s. Please check the "
-                     "song definition for '%s'", input_file, song_name)
+    except FileNotFoundError as e:
+        logger.error("%s. Please check the song definition for '%s'",
+                     e, song_name)
         sys.exit(2)
-    song_data['filename'] = input_file
 
-    if perform_prefix_guess:
+    if args.detect_bpm:
         song = SongTwister(**song_data)
-        guess_prefix_length(song)
+        if not song.bpm_candidates:
+            song.detect_bpm()
+        log_bpm_candidates(song)
+        if song_data.get('bpm'):
+            logger.info("The bpm in the song definition is %s",
+                        song_data.get('bpm'))
         return  # In this case, we quit here
 
-    # Apply a specific preset or the main set defined in config
-    if make_all or not preset_name:
-        presets_to_apply: list[str] = preferences_config.get('main_preset_set')
-        logger.info("Rendering the main preset set.")
-    # elif preset_name == '*':
-    #     presets_to_apply = list(all_presets.keys())
-    #     logger.info("Rendering every preset.")
-    # else:
-    #     presets_to_apply = [preset_name]
-    else:
-        presets_to_apply: list[str] = select_presets(
-            preset_list=list(all_presets.keys()), selection=preset_name)
+    if perform_prefix_guess:
+        song = SongTwister(**song_data)
+        guess_prefix_length(song, export_bars=create_html_file)
+        return  # In this case, we quit here
 
-    # Set crossfade if it has been supplied as an arg
-    crossfade = args.crossfade
-    if crossfade and crossfade.isnumeric():
-        crossfade = int(crossfade)
+    presets_to_apply = choose_presets(preset_name, make_all,
+                                      preferences_config, all_presets)
+    logger.info("Presets that will be applied: %s",
+                ', '.join(presets_to_apply))
+    preset_jobs = make_preset_jobs(presets_to_apply, all_presets, job_options)
+
+    # Skip the presets whose outputs are cached, before loading the song
+    keys: list[Optional[str]] = []
+    if output_cache is not None:
+        keys, cached = restore_cached_outputs(
+            output_cache, song_data, preset_jobs, rerender=args.rerender)
+        preset_jobs, keys = _uncached(cached, preset_jobs, keys)
+        if not preset_jobs:
+            logger.info("All presets are up to date")
+            return
 
     song = SongTwister(**song_data)
     if 'edit' in song_data:
         song = song.edit(song_data.get('edit'))
 
-    logger.info("Presets that will be applied: %s",
-                ', '.join(presets_to_apply))
-    for preset in presets_to_apply:
-        song_object = song.spawn_new_instance()
-        preset_data = all_presets.get(preset)
-        if not preset_data:
-            logger.error("Failed to find preset '%s'", preset)
-            continue
-
-        preset_crossfade = crossfade
-        # If a specifc crossfade has not been passed, we look in the preset
-        if preset_crossfade is None:
-            preset_crossfade = preset_data.get('crossfade')
-
-        # If the preset does not have a crossfade defined, we use the default
-        if preset_crossfade is None:
-            preset_crossfade = preferences_config.get('crossfade')
-        song_object.set_crossfade(preset_crossfade)
-
-        if 'edit' in preset_data:
-            song_object = song_object.edit(preset_data.get('edit'))
-
-        logger.info(
-            "Processing '%s' using the preset %s and a crossfade of %s",
-            song_object.filename, preset, preset_crossfade)
-
-
-        # The song config may limit the preset to certain bars
-        # (see README for details on selecting)
-        # if 'bars' in song_data:
-        #     for preset_effect in preset_effects:
-        #         preset_effect['bars'] = song_data.get('bars')
-
-        effect_chain: list[list[dict]] = preset_data.get('effect_chain') or []
-        preset_effects = preset_data.get('effects')
-        if preset_effects:
-            effect_chain.append(preset_effects)
-
-        for effects in effect_chain:
-            song_object.add_effects(effects)
-            song_object = song_object.apply_effects()
-
-        fade_label = preset_crossfade.replace('/', '-') if isinstance(preset_crossfade, str) else str(preset_crossfade)
-        export_version_name = "_".join((
-            version_name, preset, f"fade-{fade_label}")).removeprefix('_')
-        # TODO: Get the output path first and check that it is can be
-        # written to, before generating the audio.
-        try:
-            exported = song_object.save_audio(
-                audio=song_object.audio,
-                version_name=export_version_name,
-                overwrite=overwrite
-            )
-        except (FileExistsError, FileNotFoundError, PermissionError) as e:
-            logger.error("Skipping preset due to this error: %s", e)
-            continue
-        if create_html_file:
-            save_song_html(
-                song_object=song_object,
-                peaks=exported.peaks,
-                filename=exported.filename,
-                preset=preset_name,
-                version_name=version_name
-            )
+    if jobs > 1 and len(preset_jobs) > 1:
+        results = render_presets_in_parallel(
+            song, preset_jobs, jobs=jobs, logging_config=logging_config,
+            logging_level=logging_level, beat_cache_size_mb=beat_cache_size_mb)
+        if output_cache is not None:
+            for key, preset_job, result in zip(keys, preset_jobs, results):
+                store_outputs(output_cache, key, song, preset_job, result)
+    else:
+        for index, preset_job in enumerate(preset_jobs):
+            result = render_preset(song, **preset_job)
+            if output_cache is not None:
+                store_outputs(output_cache, keys[index], song, preset_job,
+                              result)
+        if SongTwister.beat_cache is not None:
+            log_stats(SongTwister.beat_cache.stats())
 
 
 if __name__ == '__main__':
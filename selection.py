@@ -0,0 +1,279 @@
+"""Compiled selections of bars and beats.
+
+A selection criterium, like 'every 4 of 4', '1-8, 17-32' or 'even', is
+parsed once into a Selector, and the compiled selectors are cached. A
+selector makes a boolean mask over an array of item numbers, so making
+a selection costs the same whatever the number of items or selected items.
+See SongTwister.perform_selection for the valid criteria.
+"""
+import functools
+import logging
+import random
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger("songtwister.selection")
+
+SELECTOR_CACHE_SIZE = 256
+
+
+class Selector:
+    """Selects nothing. The base of the other selectors."""
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}"
+
+    def mask(self, items: np.ndarray,
+             rng: Optional[random.Random] = None) -> np.ndarray:
+        """Get a boolean mask of the selected items"""
+        return np.zeros(len(items), dtype=bool)
+
+    def indices(self, items: np.ndarray,
+                rng: Optional[random.Random] = None) -> np.ndarray:
+        """Get the positions of the selected items"""
+        return np.flatnonzero(self.mask(items, rng))
+
+    def select(self, items, rng: Optional[random.Random] = None) -> list[int]:
+        """Get the selected items of a list or array of ints"""
+        items = np.asarray(items, dtype=np.int64)
+        return items[self.mask(items, rng)].tolist()
+
+
+class AllSelector(Selector):
+    def mask(self, items, rng=None):
+        return np.ones(len(items), dtype=bool)
+
+
+class ParitySelector(Selector):
+    """Selects the even or the odd items"""
+    def __init__(self, remainder: int):
+        self.remainder = remainder
+
+    def mask(self, items, rng=None):
+        return items % 2 == self.remainder
+
+
+class PositionSelector(Selector):
+    """Selects the item at a position, eg. 0 for the first or -1 for the last"""
+    def __init__(self, position: int):
+        self.position = position
+
+    def mask(self, items, rng=None):
+        mask = np.zeros(len(items), dtype=bool)
+        if len(items):
+            mask[self.position] = True
+        return mask
+
+
+class RandomSelector(Selector):
+    """Selects a number of random items, or a random number of them"""
+    def __init__(self, sample_size: Optional[int] = None):
+        self.sample_size = sample_size
+
+    def mask(self, items, rng=None):
+        rng = rng or random
+        sample_size = self.sample_size
+        if sample_size is None:
+            # Fallback to a random sample size
+            sample_size = rng.randint(1, len(items))
+        if sample_size > len(items):
+            logger.warning(
+                "Could not select %s as it is more than the number "
+                "of items, %s. Returning all items",
+                sample_size, len(items))
+            return np.ones(len(items), dtype=bool)
+        mask = np.zeros(len(items), dtype=bool)
+        # Sampling the positions picks the same items as sampling the items
+        mask[rng.sample(range(len(items)), sample_size)] = True
+        return mask
+
+
+class EverySelector(Selector):
+    """Selects item x in each batch of y items"""
+    def __init__(self, selection: int, batch_size: int, criteria: str):
+        self.selection = selection
+        self.batch_size = batch_size
+        self.criteria = criteria
+
+    def mask(self, items, rng=None):
+        mask = np.zeros(len(items), dtype=bool)
+        batch_starts = np.arange(0, len(items), self.batch_size)
+        batch_lengths = np.minimum(self.batch_size, len(items) - batch_starts)
+        # A negative selection counts from the end of each batch
+        in_batch = (self.selection if self.selection >= 0
+                    else batch_lengths + self.selection)
+        if np.any((in_batch < 0) | (in_batch >= batch_lengths)):
+            logger.error(
+                "Failed to select every %s of %s. criterium: %s",
+                self.selection, self.batch_size, self.criteria)
+            return mask
+        mask[batch_starts + in_batch] = True
+        return mask
+
+
+class NumberSelector(Selector):
+    """Selects items by number, and by ranges of numbers.
+    ranges are inclusive (first, last) pairs. leading are the N of '-N'
+    selections, which select 1-N if there are N items or more, or else
+    just N."""
+    def __init__(self, numbers: list[int],
+                 ranges: Optional[list[tuple[int, int | float]]] = None,
+                 leading: Optional[list[int]] = None,
+                 positive_only: bool = False):
+        self.numbers = np.array(numbers, dtype=np.int64)
+        self.ranges = ranges or []
+        self.leading = leading or []
+        self.positive_only = positive_only
+
+    def mask(self, items, rng=None):
+        mask = np.isin(items, self.numbers)
+        if self.positive_only:
+            mask &= items > 0
+        for first, last in self.ranges:
+            mask |= (items >= first) & (items <= last)
+        if len(items):
+            largest = items.max()
+            for last in self.leading:
+                if last <= largest:
+                    mask |= (items >= 1) & (items <= last)
+                else:
+                    mask |= items == last
+        return mask
+
+
+def compile_selector(criteria) -> Selector:
+    """Get the compiled selector of a selection criterium.
+    Selectors are cached, unless the criterium can not be hashed."""
+    # Make sure that strings are lower for easier comparison
+    if isinstance(criteria, str):
+        criteria = criteria.lower()
+        if criteria.isnumeric():
+            criteria = int(criteria)
+
+    # Make sure that criteria is iterable
+    if isinstance(criteria, (int, range)):
+        criteria = (criteria,)
+
+    # Lists are selected like tuples, and only ints and ranges in them count
+    if isinstance(criteria, (list, tuple)):
+        criteria = tuple(
+            int(criterium) if isinstance(criterium, int) else criterium
+            for criterium in criteria
+            if isinstance(criterium, (int, range)))
+    try:
+        return _compile_cached(criteria)
+    except TypeError:
+        # Not hashable
+        return _compile(criteria)
+
+
+@functools.lru_cache(maxsize=SELECTOR_CACHE_SIZE, typed=True)
+def _compile_cached(criteria) -> Selector:
+    return _compile(criteria)
+
+
+def _compile(criteria) -> Selector:
+    """Compile a criterium, as cleaned up by compile_selector"""
+    if not criteria or criteria == 'none':
+        # Catch: None, 0, [], '', False, 'none'
+        # Select no items
+        return Selector()
+
+    if criteria in ['all', True] and not isinstance(criteria, int):
+        # Catch 'all' and True (and not 1!)
+        return AllSelector()
+
+    if criteria == 'even':
+        return ParitySelector(0)
+
+    if criteria == 'odd':
+        return ParitySelector(1)
+
+    if criteria == 'first':
+        return PositionSelector(0)
+
+    if criteria == 'last':
+        return PositionSelector(-1)
+
+    # This handles complex string based selections
+    if isinstance(criteria, str):
+        # Get one or more random items
+        if criteria.startswith('random'):
+            sample_size = criteria.split()[-1]
+            if sample_size and sample_size.isdigit():
+                return RandomSelector(int(sample_size))
+            return RandomSelector()
+
+        # Get "every x of y" selections
+        if criteria.startswith('every'):
+            return _compile_every(criteria)
+
+        if '-' in criteria or ',' in criteria:
+            return _compile_numbers(criteria)
+
+    if isinstance(criteria, tuple):
+        # Select specific items. Ranges are turned into individual
+        # integers, and include their stop value.
+        # Any int less than 1 is not selected.
+        numbers = [x for x in criteria if not isinstance(x, range)]
+        ranges = [(x.start, x.stop) for x in criteria if isinstance(x, range)]
+        return NumberSelector(
+            numbers, ranges=[(max(first, 1), last) for first, last in ranges],
+            positive_only=True)
+    logger.warning('No valid criteria found')
+    return Selector()
+
+
+def _compile_every(criteria: str) -> Selector:
+    """Compile an "every x of y" selection: Divide items into batches
+    of y, and select item x in each."""
+    parts = criteria.split()
+    assert len(parts) == 4 and parts[2] == 'of'
+    try:
+        batch_size = int(parts[3])
+        selection = int(parts[1]) - 1
+        if selection > batch_size:
+            logger.warning(
+                "Too large sample size: every %s of %s. "
+                "Original criterium: %s",
+                selection, batch_size, criteria)
+            selection = batch_size
+    except ValueError:
+        logger.error("Invalid criterium: %s", criteria)
+        return Selector()
+    if batch_size < 1:
+        logger.error("Invalid batch size: %s. Original criterium: %s",
+                     batch_size, criteria)
+        return Selector()
+    return EverySelector(selection, batch_size, criteria)
+
+
+def _compile_numbers(criteria: str) -> Selector:
+    """Compile at least one number or range,
+    defined as "1-8" or "1-8, 17-32"."""
+    numbers, ranges, leading = [], [], []
+    # If multiple comma-separated selections made, process them
+    # one at a time. Otherwise, just process the one.
+    for criterium in [x.strip() for x in criteria.split(',')]:
+        # Split at - in case the criterium is a range
+        first, _, last = criterium.partition('-')
+        if criterium.isnumeric():
+            # A single bar
+            numbers.append(int(criterium))
+        elif first.isnumeric() and not last and 0 < int(first):
+            # Eg. 5-
+            # Select the rest of the song, from this number
+            ranges.append((int(first), float('inf')))
+        elif last.isnumeric() and not first and 0 < int(last):
+            # Eg. -5
+            # Selects the beginning of the song, up to this number
+            leading.append(int(last))
+        elif first.isnumeric() and last.isnumeric():
+            # It consists of two numbers: It is a range.
+            if int(first) < int(last):
+                ranges.append((int(first), int(last)))
+        else:
+            logger.error(
+                "Invalid selection: %s. Original criteria: %s",
+                criterium, criteria)
+    return NumberSelector(numbers, ranges=ranges, leading=leading)
@@ -0,0 +1,72 @@
+"""Share decoded audio between processes.
+
+The audio is copied once into a multiprocessing.shared_memory block, and
+worker processes attach to it by name, instead of decoding the file again
+or receiving the audio pickled with every task. The workers read the samples
+straight from the block, so there is one copy of the song in memory however
+many workers there are.
+"""
+from multiprocessing import shared_memory
+from typing import Optional
+import logging
+
+from audiosegment_patch import PatchedAudioSegment as AudioSegment
+
+logger = logging.getLogger("songtwister.shared_audio")
+
+
+
+class AttachedMemory(shared_memory.SharedMemory):
+    """A shared memory block that audio has been attached to. The block is
+    closed when it is garbage collected, at the latest when the process
+    exits. The attached audio may still be around then, in which case the
+    operating system unmaps the block."""
+    def __del__(self):
+        try:
+            self.close()
+        except (BufferError, OSError):
+            pass
+
+
+# The blocks this process is attached to, by name. They are not closed, as
+# the attached audio reads from them.
+_attached: dict[str, AttachedMemory] = {}
+
+
+def share_audio(audio: AudioSegment) -> tuple[shared_memory.SharedMemory, dict]:
+    """Copy the audio into a new shared memory block.
+    Returns the block, which the caller must close and unlink when the
+    workers are done, and the info the workers need to attach to it."""
+    data = audio.raw_data
+    block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    block.buf[:len(data)] = data
+    info = {
+        'name': block.name,
+        'bytes': len(data),
+        'channels': audio.channels,
+        'sample_width': audio.sample_width,
+        'frame_rate': audio.frame_rate,
+    }
+    logger.debug("Shared %s bytes of audio as %s", len(data), block.name)
+    return block, info
+
+
+def attach_audio(info: dict) -> AudioSegment:
+    """Make an AudioSegment of audio shared by share_audio, without copying
+    it. The segment reads the samples straight from the shared memory
+    block, which is kept open for the life of the process."""
+    name = info.get('name')
+    block = _attached.get(name)
+    if block is None:
+        block = _attached[name] = AttachedMemory(name=name)
+    return AudioSegment.from_buffer(
+        block.buf[:info.get('bytes')], sample_width=info.get('sample_width'),
+        frame_rate=info.get('frame_rate'), channels=info.get('channels'))
+
+
+def release_audio(block: Optional[shared_memory.SharedMemory]) -> None:
+    """Close and remove a shared memory block made by share_audio"""
+    if block is None:
+        return
+    block.close()
+    block.unlink()
@@ -1,24 +1,53 @@
 import random
-from typing import Optional, Union, Self
+from typing import Iterable, Iterator, Optional, Union, Self
 from pathlib import Path
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import weakref
+
+import numpy as np
 
 # from pydub import AudioSegment
 from audiosegment_patch import PatchedAudioSegment as AudioSegment
-from pydub import effects as pd_effects
 from pydub import silence as pd_silence
 from pydub.utils import mediainfo
 
+from audio_view import AudioView
+from bar_table import BarTable
+from beat_cache import BeatCache
+from selection import compile_selector
+from crossfade import CURVES as CROSSFADE_CURVES
+from decode_cache import DecodeCache
+from peaks import get_peaks, peaks_file_path, scale_peaks, write_peaks_file
+import panning
+import render_engine
+import resample
+import tempo
+import time_stretch
+from render_engine import Cut, RenderSlot
+from render_plan import RenderPlan, OP_BEAT, OP_COPY, OP_SILENCE
+
 logger = logging.getLogger("songtwister")
 
-ExportResult = namedtuple("ExportResult", ["filename", "peaks"])
+ExportResult = namedtuple("ExportResult", ["filename", "peaks", "filenames"],
+                          defaults=((),))
+# One file to write in save_audio. Without a path, the file is named after
+# the song and version name.
+OutputTarget = namedtuple("OutputTarget", ["format", "codec", "bitrate", "path"],
+                          defaults=(None, None, None))
 ProcessingResult = namedtuple("ProcessingResult", ["audio", "bpm"])
 
 class SongTwister:
+    # Set to a DecodeCache to keep decoded audio on disk between runs
+    decode_cache: Optional[DecodeCache] = None
+    # Set to a BeatCache to render each treated beat once across presets
+    beat_cache: Optional[BeatCache] = None
+
     def __init__(self,
                  filename: str,
-                 bpm: int | float,
+                 bpm: Optional[int | float] = None,  # Detected from the audio, if not defined
                  title: Optional[str] = None,  # The filename without extension, if not defined
                  format: Optional[str] = None,  # file format, taken from the file extension
                  stem_filepath: Optional[str] = None,  # path of file, without extension
@@ -27,7 +56,7 @@ class SongTwister:
                  suffix_length_ms: int = 0,  # Number of ms after the last bar of the song (to be manipulated)
                  audio: Optional[AudioSegment] = None,
                  load_audio: bool = True,
-                 bar_sequence: Optional[list] = None,
+                 bar_sequence: Optional[list | BarTable] = None,
                  peaks=None,
                  waveform_resolution: int = 400,
                  beats_per_bar: int = 4,
@@ -39,6 +68,10 @@ class SongTwister:
                  bitrate: Optional[int] = None,
                  fade_out: Optional[int | float] = None,
                  prefix_silence_threshold: float = -30.0,
+                 render_engine: str = 'numpy',  # 'numpy' or 'pydub', see apply_effects
+                 crossfade_curve: str = 'stepped',  # See crossfade.CURVES
+                 resample_quality: str = 'medium',  # See resample.QUALITIES
+                 seed: Optional[int] = None,  # Makes random selections reproducible
                  **kwargs):
         """Most of the values will rarely be supplied manually when instantiating.
         The mostly exist to be able to export the object state to json and the create
@@ -56,16 +89,24 @@ class SongTwister:
         self.audio_length_ms = audio_length_ms
         self.waveform_resolution = waveform_resolution
         self.audio = audio
+        self.bitrate = bitrate
         if not self.audio and load_audio:
             self.load_audio()
 
-        self.bitrate = bitrate or mediainfo(self.filename).get('bit_rate')
+        self.bitrate = self.bitrate or self._get_bitrate()
         self.prefix_silence_threshold = prefix_silence_threshold
 
+        # The tempo candidates of the last detect_bpm, best first
+        self.bpm_candidates: list[tempo.TempoCandidate] = []
+        if not self.bpm:
+            self.bpm = self._detected_bpm()
+
         self.fade_out = fade_out
         self.prefix_length_ms = prefix_length_ms
         self.suffix_length_ms = suffix_length_ms
-        self.bar_sequence = bar_sequence or []
+        if not isinstance(bar_sequence, BarTable):
+            bar_sequence = BarTable.from_list(bar_sequence or [])
+        self.bar_sequence: BarTable = bar_sequence
 
         self.beat_length_ms = beat_length_ms or self._get_beat_length()
         self.bar_length_ms = bar_length_ms or self._get_bar_length()
@@ -73,6 +114,17 @@ class SongTwister:
         self.set_crossfade(crossfade)
         self.crossfade_before = crossfade_before
         self.crossfade_after = crossfade_after
+        self.render_engine = render_engine
+        self.crossfade_curve = crossfade_curve
+        self.resample_quality = resample_quality
+        self.seed = seed
+        # Without a seed, the selections use the random module
+        self.rng = random.Random(seed) if seed is not None else None
+        # The last render of the numpy engine, see _render_incremental
+        self._last_render = RenderSlot()
+        # Beats pitch shifted in batches before a render, see
+        # _shift_pitch_in_batches
+        self._pitched_beats: dict[tuple, AudioSegment] = {}
 
     def __repr__(self) -> str:
         return (f"SongTwister: {self.title if self.title else self.filename} "
@@ -89,6 +141,15 @@ class SongTwister:
         if not self.title:
             self.title = self.stem_filepath.split('/')[-1]
 
+    def _get_bitrate(self) -> Optional[str]:
+        """Get the bitrate of the audio file, from the decode cache if
+        it has been stored there, to avoid running ffprobe."""
+        if self.decode_cache:
+            info = self.decode_cache.lookup(self.filename)
+            if info and info.get('bit_rate'):
+                return info.get('bit_rate')
+        return mediainfo(self.filename).get('bit_rate')
+
     def set_crossfade(self, crossfade: Union[int, str, float]) -> None:
         if isinstance(crossfade, (int, float)):
             self.crossfade = crossfade
@@ -127,16 +188,9 @@ class SongTwister:
             audio = self.audio
         if not waveform_resolution:
             waveform_resolution = self.waveform_resolution
-        chunk_length = len(audio) / waveform_resolution
-
-        loudness_of_chunks = [
-            audio[i * chunk_length: (i + 1) * chunk_length].rms
-            for i in range(waveform_resolution)]
-
-        max_rms = max(loudness_of_chunks) * 1.00
-
-        return [int((loudness / max_rms) * db_ceiling)
-                for loudness in loudness_of_chunks]
+        # The peaks come from a pyramid of chunk levels, built once per audio
+        loudness_of_chunks = get_peaks(audio, waveform_resolution).rms
+        return scale_peaks(loudness_of_chunks, db_ceiling)
 
     @staticmethod
     def _is_int(value: Union[int, str]) -> bool:
@@ -144,7 +198,8 @@ class SongTwister:
             isinstance(value, str) and value.isnumeric())
 
     @staticmethod
-    def perform_selection(items: list[int], criteria) -> list[int]:
+    def perform_selection(items: list[int], criteria,
+                          rng: Optional[random.Random] = None) -> list[int]:
         """Select certain items from a list of ints.
 
         criteria:
@@ -157,159 +212,22 @@ class SongTwister:
         'all' or True selects all items.
         'random X' selects X random items. No number results in a random number of random items.
         'every X of Y' selects item X in each batch of Y, for as many batches as can be made.
+        'X-Y', 'X-', '-Y' or a comma-separated list of them and numbers,
+        eg. '1-8, 17-32', selects those ranges or items.
 
-        """
-        # First some cleanup
+        The criteria are compiled once, see selection.compile_selector.
+        Random selections are made with rng, or the random module.
 
+        """
         # Make sure that items is an iterable, and not a single int
         if isinstance(items, int):
             items = [items]
-
-        # Make sure that strings are lower for easier comparison
-        if isinstance(criteria, str):
-            criteria = criteria.lower()
-            if criteria.isnumeric():
-                criteria = int(criteria)
-
-        # Make sure that criteria is iterable
-        if isinstance(criteria, (int, range)):
-            criteria = (criteria,)
-
-        if not criteria or criteria == 'none':
-            # Catch: None, 0, [], '', False, 'none'
-            # Return no items
-            return []
-
-        if criteria in ['all', True] and not isinstance(criteria, int):
-            # Catch 'all' and True (and not 1!)
-            # Return all items
-            return items
-
-        if criteria == 'even':
-            # Return even numbered bars
-            return [item for item in items if not item % 2]
-
-        if criteria == 'odd':
-            # Return odd numbered bars
-            return [item for item in items if item % 2]
-
-        if criteria == 'first':
-            # return a list containing the first item, if any
-            return [items[0]] if items else []
-
-        if criteria == 'last':
-            # return a list containing the last item, if any
-            return [items[-1]] if items else []
-
-        # This handles complex string based selections
-        if isinstance(criteria, str):
-            # Get one or more random items
-            if criteria.startswith('random'):
-                sample_size = criteria.split()[-1]
-                if sample_size and sample_size.isdigit():
-                    sample_size = int(sample_size)
-                else:
-                    # Fallback to a random sample size
-                    sample_size = random.randint(1, len(items))
-                if sample_size > len(items):
-                    logger.warning(
-                        "Could not select %s as it is more than the number "
-                        "of items, %s. Returning all items",
-                        sample_size, len(items))
-                    return items
-                return sorted(random.sample(items, sample_size))
-
-            # Get "every x of y" selections
-            if criteria.startswith('every'):
-                parts = criteria.split()
-                assert len(parts) == 4 and parts[2] == 'of'
-                try:
-                    batch_size = int(parts[3])
-                    selection = int(parts[1]) - 1
-                    if selection > batch_size:
-                        logger.warning(
-                            "Too large sample size: every %s of %s. "
-                            "Original criterium: %s",
-                            selection, batch_size, criteria)
-                        selection = batch_size
-                except ValueError:
-                    logger.error("Invalid criterium: %s", criteria)
-                    return []
-                try:
-                    # Select "every x of y":
-                    # Divide items into batches of y,
-                    # and select item x in each.
-                    return [batch[selection] for batch in (
-                        items[i:i + batch_size]
-                        for i in range(0, len(items), batch_size))]
-                except IndexError:
-                    logger.error(
-                        "Failed to select every %s of %s. criterium: %s",
-                        selection, batch_size, criteria)
-                    return []
-
-            if '-' in criteria or ',' in criteria:
-                # Iterate through at least one range
-                # Defined as "1-8" or "1-8, 17-32"
-                selection = []
-                # If multiple comma-separated selections made, process them
-                # one at a time. Otherwise, just process the one.
-                for criterium in [x.strip() for x in criteria.split(',')]:
-                    # Split at - in case the criterium is a range
-                    criterium_parts = criterium.split('-')
-                    if len(criterium_parts) == 1 and criterium_parts[0].isnumeric():
-                        # It is not a range
-                        selected_item = int(criterium_parts[0])
-                        if criterium.endswith('-') and 0 < selected_item <= max(items):
-                            # Eg. 5-
-                            # Select the rest of the song, if the number is
-                            # less than or equal to the total number of items
-                            selection.extend(list(range(
-                                selected_item, max(items) + 1)))
-                        elif criterium.startswith('-') and 0 < selected_item <= max(items):
-                            # Eg. -5
-                            # Selects the beginning of the song, if the number
-                            # is less than or equal to the total number of items
-                            selection.extend(list(range(1, selected_item + 1)))
-                            # FIXME Test me
-                        else:
-                            # A single bar
-                            selection.append(selected_item)
-                    elif len(criterium_parts) == 2 and [x.isnumeric() for x in criterium_parts]:
-                        # It consists of two number: It is a range.
-                        first, last = criterium_parts
-                        if first < last:
-                            selection.extend(list(
-                                range(int(first), int(last) + 1)))
-                    else:
-                        logger.error(
-                            "Invalid selection: %s. Original criteria: %s",
-                            criterium, criteria)
-                return [item for item in items if item in selection]
-
-        if isinstance(criteria, (list, tuple)):
-            # Return specific items from the list.
-            # May be a list of ints or ranges or a single one
-            # (converted to a list above).
-            # Ranges are turned into individual integers.
-            selection = []
-            for criterium_parts in criteria:
-                if isinstance(criterium_parts, int):
-                    selection.append(criterium_parts)
-                if isinstance(criterium_parts, range):
-                    selection.extend(list(range(
-                        criterium_parts.start, criterium_parts.stop + 1)))
-            # Any int less than 1 is removed.
-            # Anything larger than the largest item is removed.
-            selection = [i for i in selection if 0 < i <= max(items)]
-            # The remaining item numbers are selected from the list of items.
-            return [item for item in items if item in selection]
-        logger.warning('No valid criteria found')
-        return []
+        return compile_selector(criteria).select(items, rng)
 
     @staticmethod
     def perform_single_selection(selector: str, current: int, first: int,
-                                 last: int) -> Optional[int]:
+                                 last: int,
+                                 rng: Optional[random.Random] = None) -> Optional[int]:
         """Select an int.
             - 'this' selects the current beat or bar number
             - 'next' and 'previous' selects the one before or after
@@ -323,7 +241,7 @@ class SongTwister:
         if selector == 'this':
             selected = current
         elif selector == 'random':
-            selected = random.randint(first, last)
+            selected = (rng or random).randint(first, last)
         elif selector.isnumeric():
             selector = int(selector)
             if first <= selector <= last:
@@ -348,9 +266,21 @@ class SongTwister:
 
     # PUBLIC METHODS
     def load_audio(self) -> None:
-        """Make AudioSegment from the audio file and set the audio length in ms."""
-        self.audio: AudioSegment = AudioSegment.from_file(
-            file=self.filename, format=self.format)
+        """Make AudioSegment from the audio file and set the audio length in ms.
+        If a decode cache is set, the decoded audio is read from there,
+        or stored there after decoding."""
+        audio = None
+        if self.decode_cache:
+            audio = self.decode_cache.load(self.filename)
+        if audio is None:
+            audio = AudioSegment.from_file(
+                file=self.filename, format=self.format)
+            if self.decode_cache:
+                self.decode_cache.store(
+                    self.filename, audio,
+                    bit_rate=self.bitrate or mediainfo(
+                        self.filename).get('bit_rate'))
+        self.audio: AudioSegment = audio
         self.audio_length_ms = len(self.audio)
 
     def save_audio(self, audio: Optional[AudioSegment] = None,
@@ -359,43 +289,100 @@ class SongTwister:
                    overwrite: bool = False,
                    version_name: Optional[str] = None,
                    waveform_resolution: Optional[int] = None,
-                   extra_parameters: Optional[list] = None) -> ExportResult:
+                   extra_parameters: Optional[list] = None,
+                   outputs: Optional[list[OutputTarget | dict]] = None,
+                   peaks_file: bool = False) -> ExportResult:
         """Write an AudioSegment to a file. To prevent overwriting the original,
-        if no version_name is passed, a random one is generated."""
+        if no version_name is passed, a random one is generated.
+
+        If outputs are passed, every output target is written by a single
+        ffmpeg process, instead of just one file in output_format. Targets
+        without a bitrate use the bitrate of the song if they have its
+        format. The filename of the result is the first target, and
+        filenames holds all of them.
+
+        With peaks_file, a binary .peaks file with the waveform at several
+        zoom levels is written next to each file (see peaks.py)."""
         if not version_name:
             version_name = self._get_random_id()
         if not output_format:
             output_format = self.format
         if output_dir:
-            if not output_dir(isinstance, Path):
+            if not isinstance(output_dir, Path):
                 output_dir = Path(output_dir)
             if not output_dir.exists():
                 raise FileNotFoundError(
                     f'Selected output path {output_dir} does not exist.')
-            original_name = Path(self.stem_filepath).name
-            filename = f"{original_name}_{version_name}.{output_format}"
-            file_path = output_dir / filename
+        targets = [OutputTarget(**target) if isinstance(target, dict) else target
+                   for target in outputs or []]
+        if targets:
+            file_paths = [self._output_path(
+                target.format, version_name, output_dir,
+                target.bitrate if len(targets) > 1 else None,
+                target.path) for target in targets]
         else:
-            file_path = Path(
-                f"{self.stem_filepath}_{version_name}.{output_format}")
-        if not overwrite and file_path.exists():
-            raise FileExistsError(f"Cannot write {file_path}, as it already "
-                                  "exists and overwriting is not enabled.")
+            file_paths = [self._output_path(output_format, version_name, output_dir)]
+        for file_path in file_paths:
+            if not overwrite and file_path.exists():
+                raise FileExistsError(f"Cannot write {file_path}, as it already "
+                                      "exists and overwriting is not enabled.")
+        if len(set(file_paths)) < len(file_paths):
+            raise ValueError(f"The output targets share a path: {file_paths}")
         if not audio:
             audio = self.audio
         if self.fade_out:
             audio = audio.fade_out(self.fade_out * 1000)
-        logger.info("Writing file: %s", file_path)
+        # Write to temporary files and move them in place, so a failed export
+        # leaves no half written files, and a file hard-linked from the
+        # output cache is replaced instead of written through
+        temp_paths = [file_path.with_name(f"{file_path.name}.{os.getpid()}.tmp")
+                      for file_path in file_paths]
         try:
-            audio.export(
-                out_f=file_path, format=output_format,
-                bitrate=self.bitrate, parameters=extra_parameters)
+            if targets:
+                logger.info("Writing files: %s",
+                            ", ".join(str(path) for path in file_paths))
+                audio.export_many([{
+                    'out_f': temp_path,
+                    'format': target.format,
+                    'codec': target.codec,
+                    'bitrate': target.bitrate or (
+                        self.bitrate if target.format == self.format else None),
+                    'parameters': extra_parameters,
+                } for target, temp_path in zip(targets, temp_paths)])
+            else:
+                logger.info("Writing file: %s", file_paths[0])
+                audio.export(
+                    out_f=temp_paths[0], format=output_format,
+                    bitrate=self.bitrate, parameters=extra_parameters).close()
+            for temp_path, file_path in zip(temp_paths, file_paths):
+                os.replace(temp_path, file_path)
         except PermissionError as e:
-            logger.error('Failed to write %s: %s', file_path, e)
+            logger.error('Failed to write %s: %s', file_paths[0], e)
             return
+        finally:
+            for temp_path in temp_paths:
+                temp_path.unlink(missing_ok=True)
+        if peaks_file:
+            for file_path in file_paths:
+                write_peaks_file(audio, peaks_file_path(file_path))
         peaks = self._calculate_peaks(audio, waveform_resolution)
         logger.info("Finished writing file")
-        return ExportResult(file_path, peaks)
+        return ExportResult(file_paths[0], peaks, tuple(file_paths))
+
+    def _output_path(self, output_format: str, version_name: str,
+                     output_dir: Optional[Path] = None,
+                     bitrate: Optional[str] = None,
+                     path: Optional[str | Path] = None) -> Path:
+        """Get the path to write a version of the song to. The bitrate is
+        added to the name to tell apart files of the same format."""
+        if path:
+            return Path(path)
+        if bitrate:
+            version_name = f"{version_name}_{bitrate}"
+        if output_dir:
+            original_name = Path(self.stem_filepath).name
+            return output_dir / f"{original_name}_{version_name}.{output_format}"
+        return Path(f"{self.stem_filepath}_{version_name}.{output_format}")
 
     def _samples_to_ms(self, samples: int, framerate: Optional[int] = None) -> float:
         if not framerate:
@@ -410,13 +397,15 @@ class SongTwister:
 
     def slice(self, start: Union[float, int, None] = None,
               end: Union[float, int, None] = None,
-              audio: Optional[AudioSegment] = None) -> AudioSegment:
+              audio: Optional[AudioSegment] = None,
+              view: bool = False) -> AudioSegment | AudioView:
         """Using the standard slice notation a[1:5], an AudioSegment
         rounds off to whole milliseconds. In many cases this is fine.
         But when dealing with rhythms in music and you are making many
         cuts, loosing the sub-millisecond resolution can add up and
         create offsets in rhythm.
-        So this implements a finegrained slicing on sample level instead."""
+        So this implements a finegrained slicing on sample level instead.
+        With view, an AudioView of the samples is returned instead of a copy."""
         if start is not None:
             start_sample = self._ms_to_samples(max(start, 0))
         else:
@@ -428,6 +417,8 @@ class SongTwister:
             end_sample = None
         if not audio:
             audio = self.audio
+        if view:
+            return AudioView(audio, start_sample, end_sample)
         # NOTE: This does not seem to change anything, so it isn't needed after all.
         # return audio[start:end]
         mine = audio.get_sample_slice(
@@ -464,6 +455,11 @@ class SongTwister:
         """Return a dict of all self vars, except the AudioSegment."""
         # If we just do vars(self), we modify self in the following lines
         all_vars = dict(vars(self))
+        all_vars['bar_sequence'] = self.bar_sequence.to_list()
+        all_vars.pop('rng')
+        all_vars.pop('_last_render')
+        all_vars.pop('_pitched_beats')
+        all_vars.pop('bpm_candidates')
         if not keep_audio:
             all_vars.pop('audio')
         additional_data = all_vars.pop('additional_data')
@@ -480,44 +476,20 @@ class SongTwister:
         self.build_bar_sequence()
 
     def build_bar_sequence(self) -> None:
-        """Create a list of dicts, representing each bar in the song.
+        """Create a table of the bars in the song.
         This is used to add effects to, without touching the actual audio,
-        and finally used to cut up the audio and apply effects."""
-        # Take full length int
-        # Take prefix length int
-        # Take bar length int
-        # Start at prefix point
-        # Create items at a bar's length and update the remaining length
-        # When the remaining length is less than a bar or equals the suffix length, stop
-        # If the suffix length is not set, set it to the remainder
-        # Set bars in self.bar_sequence
-
-        remainder: int | float = self.audio_length_ms - self.prefix_length_ms
-        bar_sequence = []
-        bar_number = 1
-        current_position = self.prefix_length_ms
-        while True:
-            if self.suffix_length_ms and remainder <= self.suffix_length_ms:
-                break
-            if remainder < self.bar_length_ms:
-                break
-            end = current_position + self.bar_length_ms
-            bar_sequence.append({
-                'number': bar_number,
-                'start': current_position,
-                'end': end
-            })
-            current_position = end
-            remainder = remainder - self.bar_length_ms
-            bar_number += 1
-
-        self.suffix_length_ms = remainder
-        self.bar_sequence = bar_sequence
-        # TODO: Make a test: This should generate a list of dicts.
-        # Each dict should be like this:
-        # {'number': int, 'start': int | float, 'end': int | float}
-
-    def get_bars(self, selection, bars: Optional[list] = None) -> list[dict]:
+        and finally used to cut up the audio and apply effects.
+        Bars are laid out from the end of the prefix, until the remaining
+        audio is less than a bar or the suffix. If the suffix length is not
+        set, it is set to the remainder."""
+        self.bar_sequence, self.suffix_length_ms = BarTable.build(
+            prefix_length_ms=self.prefix_length_ms,
+            bar_length_ms=self.bar_length_ms,
+            audio_length_ms=self.audio_length_ms,
+            suffix_length_ms=self.suffix_length_ms)
+
+    def get_bars(self, selection,
+                 bars: Optional[list | BarTable] = None) -> list[dict]:
         """Extract a selection of bars from a list, or from
         the main bar sequence.
         See the general documentation on making selections to
@@ -527,31 +499,83 @@ class SongTwister:
                 self.build_bar_sequence()
             bars = self.bar_sequence
         # We perform the selection using a list of bar numbers as ints
-        bar_numbers = [bar.get('number') for bar in bars]
-        selected_bars = self.perform_selection(bar_numbers, selection)
+        if isinstance(bars, BarTable):
+            bar_numbers = bars.numbers
+        else:
+            bar_numbers = [bar.get('number') for bar in bars]
+        selected_bars = self.perform_selection(bar_numbers, selection, self.rng)
         # Then we get the full bar dict for each selected bar
-        bars = [bar for bar in bars if bar.get('number') in selected_bars]
+        if isinstance(bars, BarTable):
+            bars = bars.select(selected_bars)
+        else:
+            selected_bars = set(selected_bars)
+            bars = [bar for bar in bars if bar.get('number') in selected_bars]
         if not bars:
             logger.warning(
                 "Could not find any bars matching '%s' out of a total %s bars",
-                selection, len(bars))
+                selection, len(bar_numbers))
         return bars
 
     def get_single_bar(self, number: int) -> dict:
         """Get a bar dict by its bar number"""
+        if self._is_int(number) and not isinstance(number, bool):
+            if not self.bar_sequence:
+                self.build_bar_sequence()
+            return self.bar_sequence.bar(int(number))
         bars = self.get_bars(number)
         if not bars:
             raise KeyError
         return bars[0]
 
-    def detect_prefix(self) -> int:
-        """Guess the length of the prefix, before the song proper starts,
-        based on the leading silence."""
+    def fit_beat_grid(self, bpm: Optional[float] = None
+                      ) -> Optional[tempo.GridFit]:
+        """Find the prefix, and the bpm near bpm (by default the bpm of the
+        song), of the beat grid that lines up best with the onsets in the
+        audio. See tempo.fit_grid."""
         if not self.audio:
             self.load_audio()
+        envelope = tempo.onset_envelope(
+            render_engine.audio_to_array(self.audio), self.audio.frame_rate)
+        return tempo.fit_grid(envelope, bpm or self.bpm)
+
+    def detect_prefix(self) -> int:
+        """Guess the length of the prefix, before the song proper starts,
+        from the beat grid that fits the audio best. If no grid can be
+        fitted, the leading silence is used."""
+        fit = self.fit_beat_grid()
+        if fit is not None:
+            return fit.prefix_length_ms
         return pd_silence.detect_leading_silence(
             self.audio, silence_threshold=self.prefix_silence_threshold)
 
+    def detect_bpm(self, min_bpm: float = tempo.MIN_BPM,
+                   max_bpm: float = tempo.MAX_BPM,
+                   count: int = tempo.CANDIDATES) -> list[tempo.TempoCandidate]:
+        """Estimate the tempo of the song from the onsets in the audio.
+        Returns up to count candidates with their confidence, best first,
+        and keeps them in bpm_candidates. See tempo.py."""
+        if not self.audio:
+            self.load_audio()
+        self.bpm_candidates = tempo.detect_bpm(
+            render_engine.audio_to_array(self.audio), self.audio.frame_rate,
+            min_bpm=min_bpm, max_bpm=max_bpm, count=count)
+        logger.debug("Tempo candidates of '%s': %s", self.title,
+                     self.bpm_candidates)
+        return self.bpm_candidates
+
+    def _detected_bpm(self) -> float:
+        """Get the most likely bpm of the audio, when none is defined"""
+        if not self.audio:
+            raise ValueError(
+                f"No bpm is defined for '{self.title}', and the audio is not "
+                "loaded to detect it from")
+        candidates = self.detect_bpm()
+        if not candidates:
+            raise ValueError(f"Could not detect the bpm of '{self.title}'")
+        logger.info("Detected a bpm of %s for '%s' (confidence %s)",
+                    candidates[0].bpm, self.title, candidates[0].confidence)
+        return candidates[0].bpm
+
     def set_prefix_and_suffix(
             self, prefix_length_ms: Optional[int | float] = None,
             suffix_length_ms: Optional[int | float] = None) -> None:
@@ -632,7 +656,11 @@ class SongTwister:
         else:
             state = self.export_state(keep_audio=True)
         state.update(**kwargs)
-        return self.__class__(**state)
+        spawned = self.__class__(**state)
+        if spawned.audio is self.audio and not kwargs:
+            # Renders of the same audio can be spliced into each other
+            spawned._last_render = self._last_render
+        return spawned
 
     # PROCESSING
     def edit(self, edit_list: list) -> Self:
@@ -767,59 +795,62 @@ class SongTwister:
         return self.spawn_new_instance(edited)
 
     @staticmethod
-    def process_audio(audio: AudioSegment, ffmpeg_parameters: Optional[list] = None, **kwargs) -> ProcessingResult:
-        if not ffmpeg_parameters:
-            ffmpeg_parameters = []
+    def _interpret_processing(arg: str, bpm=None, note_key=None):
+        if arg is None:
+            return None
+        if not arg:
+            return 1.0
+        if isinstance(arg, (float, int)):
+            return float(arg)
+        suffix = None
+        arg = arg.lower()
+        if arg == 'follow':
+            return arg
+        for char in ('x', '%', 'bpm'):
+            if arg.endswith(char):
+                suffix = char
+                arg = arg.removesuffix(char)
+        notes = "abcdefg".split()
+        if arg[0] in notes and note_key:
+            note = arg[0]
+            if len(arg) == 2 and arg[1] in "#b":
+                accidental = -1 if arg[1] == 'b' else 1
+            # TODO
+            logger.warning("The fancy note calculation has not been built yet.")
+            return 1.0
+        try:
+            arg = float(arg)
+        except ValueError:
+            logger.error("'%s' could not be converted to float. "
+                        "Falling back to 1.0", arg)
+            arg = 1.0
+        if suffix == 'x':
+            return arg
+        if suffix == '%':
+            print(arg, (arg / 100))
+            return (arg / 100)
+        if suffix == 'bpm' and bpm:
+            return arg / bpm
+        return arg
+
+    @classmethod
+    def _processing_filters(cls, ffmpeg_parameters: Optional[list] = None,
+                            **kwargs) -> tuple[Optional[list], Optional[float]]:
+        """Get the ffmpeg filters of a processing and the new bpm. The filters
+        are None when there is nothing to process."""
+        ffmpeg_parameters = list(ffmpeg_parameters or [])
 
         bpm = kwargs.pop('bpm', None)
         note_key = kwargs.pop('bpm', None)
 
-        def _interpret(arg: str, bpm=bpm, note_key=note_key):
-            if arg is None:
-                return None
-            if not arg:
-                return 1.0
-            if isinstance(arg, (float, int)):
-                return float(arg)
-            suffix = None
-            arg = arg.lower()
-            if arg == 'follow':
-                return arg
-            for char in ('x', '%', 'bpm'):
-                if arg.endswith(char):
-                    suffix = char
-                    arg = arg.removesuffix(char)
-            notes = "abcdefg".split()
-            if arg[0] in notes and note_key:
-                note = arg[0]
-                if len(arg) == 2 and arg[1] in "#b":
-                    accidental = -1 if arg[1] == 'b' else 1
-                # TODO
-                logger.warning("The fancy note calculation has not been built yet.")
-                return 1.0
-            try:
-                arg = float(arg)
-            except ValueError:
-                logger.error("'%s' could not be converted to float. "
-                            "Falling back to 1.0", arg)
-                arg = 1.0
-            if suffix == 'x':
-                return arg
-            if suffix == '%':
-                print(arg, (arg / 100))
-                return (arg / 100)
-            if suffix == 'bpm' and bpm:
-                return arg / bpm
-            return arg
-
-        pitch = _interpret(kwargs.pop('pitch', None), None, note_key)
-        tempo = _interpret(kwargs.pop('tempo', None), bpm, None)
+        pitch = cls._interpret_processing(kwargs.pop('pitch', None), None, note_key)
+        tempo = cls._interpret_processing(kwargs.pop('tempo', None), bpm, None)
         follow = 'follow'
 
         if tempo == follow and pitch == follow:
             logger.warning(
                 "No processing applied. Pitch: '%s', tempo: '%s'", pitch, tempo)
-            return ProcessingResult(audio, bpm)
+            return None, bpm
         if tempo == follow and pitch:
             tempo = pitch
         elif pitch == follow and tempo:
@@ -831,17 +862,86 @@ class SongTwister:
             ffmpeg_parameters.append(f'rubberband=tempo={tempo}')
         if pitch:
             ffmpeg_parameters.append(f'rubberband=pitch={pitch}')
+        return ffmpeg_parameters, new_bpm
+
+    @classmethod
+    def process_audio(cls, audio: AudioSegment, ffmpeg_parameters: Optional[list] = None, **kwargs) -> ProcessingResult:
+        filters, new_bpm = cls._processing_filters(ffmpeg_parameters, **kwargs)
+        if filters is None:
+            return ProcessingResult(audio, new_bpm)
         return ProcessingResult(audio.process_with_ffmpeg(parameters=[
-            f'-af \"{",".join(ffmpeg_parameters)}\"'
+            '-af', ",".join(filters)
             ]),
             new_bpm)
 
+    @classmethod
+    def process_audio_variants(
+            cls, audio: AudioSegment, variants: list[dict],
+            ffmpeg_parameters: Optional[list] = None, bpm: Optional[float] = None,
+            jobs: int = 1, variants_per_process: Optional[int] = None
+            ) -> list[ProcessingResult]:
+        """Process audio in several variants, eg. a sweep of tempos. Each
+        variant is a dict of the keyword arguments of process_audio, like
+        {'tempo': 0.9}. The variants are split between ffmpeg processes, of
+        up to variants_per_process variants each (by default an even share
+        of jobs processes), and each process renders all of its variants
+        from one input. Up to jobs processes run at the same time."""
+        results: list[Optional[ProcessingResult]] = [None] * len(variants)
+        pending = []
+        for index, variant in enumerate(variants):
+            variant = dict(variant)
+            variant.setdefault('bpm', bpm)
+            variant_parameters = list(ffmpeg_parameters or []) + list(
+                variant.pop('ffmpeg_parameters', None) or [])
+            filters, new_bpm = cls._processing_filters(
+                variant_parameters, **variant)
+            if filters is None:
+                results[index] = ProcessingResult(audio, new_bpm)
+            else:
+                pending.append((index, ",".join(filters), new_bpm))
+        if not pending:
+            return results
+
+        jobs = max(jobs, 1)
+        if not variants_per_process:
+            variants_per_process = -(-len(pending) // jobs)
+        groups = [pending[first:first + variants_per_process]
+                  for first in range(0, len(pending), variants_per_process)]
+        logger.info("Processing %s variants in %s ffmpeg processes",
+                    len(pending), len(groups))
+
+        def _process(group):
+            return audio.process_many_with_ffmpeg(
+                [chain for _, chain, _ in group])
+
+        if jobs > 1 and len(groups) > 1:
+            with ThreadPoolExecutor(max_workers=min(jobs, len(groups))) as pool:
+                processed_groups = list(pool.map(_process, groups))
+        else:
+            processed_groups = [_process(group) for group in groups]
+        for group, processed in zip(groups, processed_groups):
+            for (index, _, new_bpm), processed_audio in zip(group, processed):
+                results[index] = ProcessingResult(processed_audio, new_bpm)
+        return results
+
     def apply_processing(
             self, ffmpeg_parameters: Optional[list] = None, **kwargs) -> Self:
         processed = self.process_audio(
                 audio=self.audio, ffmpeg_parameters=ffmpeg_parameters, bpm=self.bpm, **kwargs)
         return self.spawn_new_instance(new_audio=processed.audio, bpm=processed.bpm)
 
+    def apply_processing_variants(
+            self, variants: list[dict], ffmpeg_parameters: Optional[list] = None,
+            jobs: int = 1, variants_per_process: Optional[int] = None) -> list[Self]:
+        """Get a new instance of the song per variant of processing. See
+        process_audio_variants."""
+        processed = self.process_audio_variants(
+            audio=self.audio, variants=variants,
+            ffmpeg_parameters=ffmpeg_parameters, bpm=self.bpm, jobs=jobs,
+            variants_per_process=variants_per_process)
+        return [self.spawn_new_instance(new_audio=result.audio, bpm=result.bpm)
+                for result in processed]
+
 
     def create_section(self, name: str, start_bar: int, end_bar: int) -> None:
         """TODO: This has not been used yet, and may not work properly.
@@ -859,19 +959,19 @@ class SongTwister:
                 'Bad section. Start bar: %s. End bar: %s. Sequence length: %s',
                 start_bar, end_bar, len(self.bar_sequence))
             return
-        for index, bar in enumerate(self.bar_sequence):
-            if bar.get('number') in range(start_bar, end_bar + 1):
-                bar['section'] = name
-                self.bar_sequence[index] = bar
+        for number in range(start_bar, end_bar + 1):
+            if number in self.bar_sequence:
+                self.bar_sequence.sections[number] = name
 
     def get_section(self, name: str, joined: bool = False) -> dict:
         """TODO: This has not been used yet, and may not work properly."""
         if not self.bar_sequence:
             self.build_bar_sequence()
         name = name.lower()
+        sections = self.bar_sequence.sections
         section = [
-            bar for bar in self.bar_sequence
-            if bar.get('section', '').lower() == name]
+            self.bar_sequence.bar(number) for number in sorted(sections)
+            if sections[number].lower() == name]
         if joined:
             return {
                 'section': name,
@@ -899,28 +999,18 @@ class SongTwister:
             selected_bars = self.get_section(section)
         selected_bars = self.get_bars(selection=bars, bars=selected_bars)
         all_beats = list(range(1, beats_per_bar + 1))
-        selected_beats = self.perform_selection(all_beats, beats)
+        selected_beats = self.perform_selection(all_beats, beats, self.rng)
         if kwargs:
             logger.info("These properties were supplied, but not used: %s", kwargs)
 
         # Divide each bar into beats_per_bar chunks, and add effect on selected_beats
         for bar in selected_bars:
-            bar_number = bar.get('number')
-            if 'effects' not in bar:
-                bar['effects'] = []
             for beat in selected_beats:
-                effect_item = {
+                self.bar_sequence.add_effect(bar.get('number'), {
                     'number': beat,
                     'resolution': beats_per_bar,
                     'effect': effect
-                }
-                if effect_item not in bar['effects']:  # prevent duplicates
-                    bar['effects'].append(effect_item)
-            # Replace the bar in the main sequence with the new one with effect added
-            for original_bar in self.bar_sequence:
-                if original_bar.get('number') == bar_number:
-                    self.bar_sequence[self.bar_sequence.index(original_bar)] = bar
-                    break
+                })
 
     def add_effects(self, effects: list[dict]) -> None:
         """Add multiple effects in one go."""
@@ -932,15 +1022,15 @@ class SongTwister:
             # if the sequence has not been generated, there are no effects to apply
             return
         sequence = {}
-        for bar in self.bar_sequence:
+        # We only need to process bars with effects added.
+        for bar in self.bar_sequence.bars_with_effects():
             bar_effects = bar.get('effects')
-            if not bar_effects:
-                # We only need to process bars with effects added.
-                continue
             new_effects = []
             # Get largest number of bar subdivisions, and adjust all others to match
             new_number_of_beats = max([x.get('resolution', 0) for x in bar_effects])
             for effect in bar_effects:
+                # Copy, so the bar sequence can be prepared again
+                effect = dict(effect)
                 resolution = effect.get('resolution', self.beats_per_bar)
                 # Number of new beats to get an old beat
                 beat_length = int(new_number_of_beats / resolution)
@@ -985,47 +1075,88 @@ class SongTwister:
             # Other effects are all applied
         return sequence
 
-    def _effect_speedup(self, audio: AudioSegment, speed: float | int = 2,
-                        crossfade: int = 150, chunk_size: int = 150,
-                        chop_to_length: Optional[str | bool] = None) -> AudioSegment:
+    def _effect_speedup(self, audio: AudioSegment,
+                        speed: float | int = 2) -> AudioSegment:
+        """Speed up audio, preserving its pitch. The result is the length
+        of the audio divided by speed, to the frame."""
         if float(speed) == 1.0:
             return audio
-        if len(audio) < 1000:
-            chunk_size = 50
-            crossfade = min(crossfade, 10)
-        elif len(audio) < 1500:
-            chunk_size = 100
-            crossfade = min(crossfade, 25)
-        sped_up_audio: AudioSegment = pd_effects.speedup(
-            seg=audio, playback_speed=speed,
-            chunk_size=chunk_size, crossfade=crossfade)
-        if chop_to_length:
-            # The speedup method tends to return a longer AudioSegment than asked for.
-            # Here we brutally chop it down to the desired length, sacrificing
-            # audio content for the overall timing of the song
-            desired_length = len(audio) / speed
-            if len(sped_up_audio) > desired_length:
-                if chop_to_length == 'end':
-                    sped_up_audio = sped_up_audio[:desired_length]
-                elif chop_to_length == 'start':
-                    sped_up_audio = sped_up_audio[int(len(sped_up_audio) - desired_length):]
-                else:
-                    padding = int((len(sped_up_audio) - desired_length) / 2)
-                    sped_up_audio = sped_up_audio[padding:-padding]
-                    # NOTE: This is not entirely precise, but only off at
-                    # about 1-2 ms, so we accept it for now.
-        return sped_up_audio
+        samples = time_stretch.speedup(
+            render_engine.audio_to_array(audio), float(speed), audio.frame_rate)
+        return render_engine.array_to_audio(samples, audio)
+
+    def _effect_pitch_shift(self, audio: AudioSegment,
+                            semitones: float | int) -> AudioSegment:
+        """Shift the pitch of audio a number of semitones, up if positive
+        and down if negative, keeping its length to the frame."""
+        samples = time_stretch.pitch_shift(
+            render_engine.audio_to_array(audio), semitones, audio.frame_rate,
+            quality=self.resample_quality)
+        return render_engine.array_to_audio(samples, audio)
+
+    @staticmethod
+    def _pitch_semitones(pitch: tuple) -> int:
+        """Get the semitones of a pitch effect from _get_effect, negative
+        for pitchdown. 0 if it is not a known pitch effect."""
+        pitch_change, pitch_semitones = pitch
+        if pitch_change == 'pitchup':
+            return pitch_semitones
+        if pitch_change == 'pitchdown':
+            return -pitch_semitones
+        logger.error('Unknown pitch effect: %s', pitch_change)
+        return 0
+
+    def _shift_pitch_in_batches(self, beats: Iterable[tuple[int, dict]]) -> None:
+        """Pitch shift the beats that will be rendered with a pitch effect,
+        all the beats with the same shift in one batch, eg. every odd beat
+        of the song. Beats that get audio from elsewhere or change speed
+        first are left to _render_beat, as are beats in the beat cache.
+        _render_beat takes the shifted beats from _pitched_beats."""
+        self._pitched_beats = {}
+        batches: dict[int, dict[tuple, None]] = {}
+        for _, cut in beats:
+            beat_effects = cut.get('effects')
+            pitch = self._get_effect('pitch', beat_effects)
+            if not pitch or 'silence' in beat_effects or any(
+                    x.startswith(('insert', 'replace', 'speed'))
+                    for x in beat_effects):
+                continue
+            key = (cut.get('start'), cut.get('end'), tuple(beat_effects))
+            if self.beat_cache is not None and self.beat_cache.contains(
+                    self.audio, key + (self.resample_quality,)):
+                continue
+            semitones = self._pitch_semitones(pitch)
+            if semitones:
+                batches.setdefault(semitones, {})[key] = None
+        for semitones, keys in batches.items():
+            keys = list(keys)
+            views = [self.slice(start, end, view=True) for start, end, _ in keys]
+            shifted = time_stretch.pitch_shift_batch(
+                [render_engine.audio_to_array(view) for view in views],
+                semitones, self.audio.frame_rate, quality=self.resample_quality)
+            for key, view, samples in zip(keys, views, shifted):
+                self._pitched_beats[key] = render_engine.array_to_audio(
+                    samples, view)
+
+    def _effect_pan(self, audio: AudioSegment,
+                    envelope: np.ndarray) -> AudioSegment:
+        """Apply a (frames, 2) envelope of left and right gains to audio,
+        see panning.py. The result is stereo."""
+        samples = panning.apply_envelope(
+            render_engine.audio_to_array(audio), envelope)
+        return audio._spawn(samples.tobytes(), overrides={
+            'channels': 2, 'frame_width': 2 * audio.sample_width})
 
     def _effect_speed_change(self, audio: AudioSegment,
                              speed: float | int = 1.0) -> AudioSegment:
+        """Change the speed of audio, with the pitch following along, as if
+        it was played at a frame rate of speed times its own."""
         if float(speed) == 1.0:
             return audio
-        # Manually override the frame_rate.
-        audio_with_altered_frame_rate = audio._spawn(
-            audio.raw_data, overrides={
-                "frame_rate": int(audio.frame_rate * speed)})
-        # Convert the sound with altered frame rate to a standard frame rate
-        return audio_with_altered_frame_rate.set_frame_rate(audio.frame_rate)
+        samples = resample.change_speed(
+            render_engine.audio_to_array(audio), float(speed),
+            audio.frame_rate, quality=self.resample_quality)
+        return render_engine.array_to_audio(samples, audio)
 
     def _get_effect(self, name: str, effects: list, fallback: int = 1,
                     get_float: bool = False) -> Optional[tuple]:
@@ -1044,19 +1175,213 @@ class SongTwister:
             logger.error('Not a number: %s', key)
         return key, value
 
-    def apply_effects(self) -> Self:
-        """Effects are first added to a mapping, allowing them to be
-        added one at a time. This generates a new SongTwister instance with the
-        effects applied."""
-        logger.info("Applying effects")
-        if not self.audio:
-            self.load_audio()
-        effect_map = self._prepare_effects()
-        if not effect_map:
-            logger.warning("No effects to apply - returning original audio.")
-            return self.audio
-
-        joined_audio = AudioSegment.empty()
+    def _render_beat(self, current_bar_number: int,
+                     cut: dict) -> Optional[AudioSegment]:
+        """Get the audio of a beat with its effects applied, or None if
+        the beat should be left out. Remove is handled by _iter_cuts."""
+        start_time = cut.get('start')
+        end_time = cut.get('end')
+        cut_duration = end_time - start_time
+        beat_effects: dict = cut.get('effects')
+        if 'silence' in beat_effects:
+            # Create a silent audiosegment with the duration of this beat
+            beat_audio = AudioSegment.silent(duration=cut_duration)
+        else:
+            # NOTE: Consider get_sample_slice() !!
+            # beat_audio = self.audio[start_time:end_time]
+            # A view, which is only copied if an effect changes the audio
+            beat_audio = self.slice(start_time, end_time, view=True)
+            beat_length = len(beat_audio)
+
+            # if 'insert' or 'replace' are in effects we need to find and extract a piece of audio from the full song audio.
+            # 'insert' appends it to the current beat audio. 'replace' removes the beat audio and puts this in instead.
+            # Syntax: insert/replace <bar> <beat>
+            # bar selectors may be: this, next, previous, next_n, previous_n, first, last, or a specific number (int).
+            # If there are invalid values or the selection is out of range, we just move on.
+            # So:
+            # - get the effect and split it out
+            # - if it is valid, parse the bar selection
+            # - parse the beat selection
+            # - determine the sample indices of the requested audio
+            # - either replace beat_audio or join it with the crossfade
+            insert_effect = [x for x in beat_effects
+                             if x.startswith('insert')
+                             or x.startswith('replace')]
+            if insert_effect:
+                # Parse selectors
+                insert_parts = insert_effect[0].split()
+                insert_type: str = insert_parts[0]
+                if len(insert_parts) not in (2, 3):
+                    logger.error("Could not parse effect: %s", insert_effect)
+                    return
+                if len(insert_parts) == 2:
+                    insert_bar = 'this'
+                    insert_beat: str = insert_parts[1]
+                else:
+                    insert_bar: str = insert_parts[1]
+                    insert_beat: str = insert_parts[2]
+                # Set bar boundaries
+                first_bar = 1
+                last_bar = self.bar_sequence.last_number
+                # Select bar
+                selected_insert_bar = self.perform_single_selection(
+                    selector=insert_bar, current=current_bar_number,
+                    first=first_bar, last=last_bar, rng=self.rng)
+                if not selected_insert_bar:
+                    return
+                # Select beat
+                beat_count = cut.get('resolution')
+                first_beat = 1
+                last_beat = beat_count
+                current_beat_number = cut.get('number')
+                selected_insert_beat = self.perform_single_selection(
+                    selector=insert_beat, current=current_beat_number,
+                    first=first_beat, last=last_beat, rng=self.rng
+                )
+                if not selected_insert_beat:
+                    return
+                logger.debug("in bar %s at beat %s I will %s beat %s from bar %s. Beat count: %s",
+                             current_bar_number, current_beat_number, insert_type,
+                             selected_insert_beat, selected_insert_bar, beat_count)
+                # Fetch bar from sequence and determine beat position
+                target_bar = self.get_single_bar(selected_insert_bar)
+                target_bar_start = target_bar.get('start')
+                target_bar_end = target_bar.get('end')
+                bar_length = target_bar_end - target_bar_start
+                target_beat_length = bar_length / beat_count
+                target_start_time = target_bar_start + (target_beat_length * (selected_insert_beat - 1))
+                target_end_time = target_start_time + target_beat_length
+                # Cut out the audio
+                # !!target_audio = self.audio[target_start_time:target_end_time]
+                target_audio = self.slice(
+                    target_start_time, target_end_time, view=True)
+                # Extend or replace beat audio
+                if insert_type == 'replace':
+                    beat_audio = target_audio
+                else:
+                    # FIXME support crossfade?
+                    beat_audio = beat_audio.append(
+                        target_audio, crossfade=0)
+                beat_length = len(beat_audio)
+
+            speed = self._get_effect(
+                'speed', beat_effects, get_float=True)
+            if speed:
+                # We will only apply one speed change effect at a time.
+                # Take the last applied
+                speed_change_type, speed_rate = speed
+
+                # In 'fill' mode, we extend the selected audio by that amount.
+                # So that when we speed it up, it retains the overall duration,
+                # it just covers more audio content
+                if 'fill' in speed_change_type and speed_rate >= 1:
+                    new_length = beat_length * speed_rate
+                    end_time = start_time + new_length
+                    # !!beat_audio = self.audio[start_time:end_time]
+                    beat_audio = self.slice(start_time, end_time, view=True)
+
+                if 'speedup' in speed_change_type and speed_rate >= 1:
+                    beat_audio = self._effect_speedup(
+                        audio=beat_audio, speed=speed_rate)
+                else:
+                    beat_audio = self._effect_speed_change(
+                        audio=beat_audio, speed=speed_rate)
+
+            pitch = self._get_effect('pitch', beat_effects)
+            if pitch:
+                # We will only apply one pitch change effect at a time.
+                # Take the last applied
+                pitched = self._pitched_beats.pop(
+                    (cut.get('start'), cut.get('end'), tuple(beat_effects)),
+                    None)
+                if pitched is not None:
+                    beat_audio = pitched
+                else:
+                    semitones = self._pitch_semitones(pitch)
+                    if semitones:
+                        beat_audio = self._effect_pitch_shift(
+                            audio=beat_audio, semitones=semitones)
+
+            # The pan effects are gain envelopes, applied together at the end
+            envelope = None
+            if 'reverse' in beat_effects:
+                beat_audio = beat_audio.reverse()
+            elif 'repeat' in beat_effects:
+                beat_audio = beat_audio.append(
+                    beat_audio, crossfade=0)
+            elif 'repeatreverse' in beat_effects:
+                beat_audio = beat_audio.append(
+                    beat_audio.reverse(), crossfade=0)
+            elif 'reverserepeat' in beat_effects:
+                beat_audio = beat_audio.reverse().append(
+                    beat_audio, crossfade=0)
+            # FIXME These two should be reworked
+            elif 'reverseping' in beat_effects:
+                beat_audio = beat_audio.pan(-1).append(
+                    beat_audio.pan(1), crossfade=0)
+            elif 'reversepong' in beat_effects:
+                beat_audio = beat_audio.pan(1).append(
+                    beat_audio.pan(-1), crossfade=0)
+            elif 'across left' in beat_effects:
+                envelope = panning.across(
+                    int(beat_audio.frame_count()), to_left=True)
+            elif 'across right' in beat_effects or 'across' in beat_effects:
+                envelope = panning.across(int(beat_audio.frame_count()))
+            elif 'bounceback' in beat_effects:
+                beat_audio = beat_audio.append(
+                    beat_audio.reverse(), crossfade=beat_length)
+
+            frames = int(beat_audio.frame_count())
+            pingpong = self._get_effect(
+                'pingpong', beat_effects, fallback=2)
+            pan = None
+            if pingpong:
+                _, pong_count = pingpong
+                # Split into pingpong_count segments,
+                # and do alternating hard pans on them.
+                pan = panning.pingpong(
+                    frames, pong_count, int(beat_audio.frame_count(
+                        ms=panning.PINGPONG_FADE_MS)))
+            elif 'left' in beat_effects:
+                pan = panning.hard_pan(frames, -1)
+            elif 'right' in beat_effects:
+                pan = panning.hard_pan(frames, 1)
+            if pan is not None:
+                envelope = pan if envelope is None else envelope * pan
+            if envelope is not None:
+                beat_audio = self._effect_pan(beat_audio, envelope)
+        return beat_audio
+
+    def _render_beat_cached(self, current_bar_number: int,
+                            cut: dict) -> Optional[AudioSegment]:
+        """Get a rendered beat from the beat cache, or render it there.
+        Insert and replace take audio from other beats, possibly chosen at
+        random, and silence is cheap, so those beats are always rendered."""
+        beat_effects = cut.get('effects')
+        if 'silence' in beat_effects or any(
+                x.startswith(('insert', 'replace')) for x in beat_effects):
+            return self._render_beat(current_bar_number, cut)
+        # The rendering only depends on the span, the effects and the
+        # resample quality, not on the crossfades, which are made when the
+        # beat is joined
+        key = (cut.get('start'), cut.get('end'), tuple(beat_effects),
+               self.resample_quality)
+        return self.beat_cache.get_or_render(
+            self.audio, key, lambda: self._render_beat(current_bar_number, cut))
+
+    def _get_frame_rate(self) -> int:
+        """Get the frame rate of the audio, without loading it if possible"""
+        if self.audio:
+            return self.audio.frame_rate
+        return int(mediainfo(self.filename).get('sample_rate'))
+
+    def compile_plan(self, frame_rate: Optional[int] = None) -> RenderPlan:
+        """Compile the effects added to the bar sequence into a render plan:
+        a flat list of the cuts to make and the beats to treat.
+        This does not touch the audio, and the plan can be saved, cached
+        and rendered later with apply_effects(plan=...)."""
+        effect_map = self._prepare_effects() or {}
+        steps = []
         end_of_last_cut = 0  # ms index in audio where last cut point ended
         # We don't just take values(), so we can sort by the key
         for current_bar_number, bar in sorted(effect_map.items()):
@@ -1081,36 +1406,11 @@ class SongTwister:
                 # the in-between section that we skip, because it doesn't need effects.
                 # !!audio_since_last_cut = self.audio[
                 #     end_of_last_cut - before_fade_length:start_time + after_fade_length]
-                audio_since_last_cut = self.slice(
-                    end_of_last_cut - before_fade_length, start_time + after_fade_length)
-                # We append the section since the last cut was made to the overall rejoined
-                # song. If this is the first iteration, we append to an empty AS.
-                # We use the crossfade to smoothen the transition, if the last cut made a
-                # big change, like 'remove'. Otherwise, we might get a nasty click or pop.
-                # Therefore we extend the audio_since_last_cut section at the beginning with
-                # the length of the crossfade, so we have a piece "too much" of the audio
-                # before. When we append the audio to the joined_audio, we do a crossfade of
-                # the same length. This should make the newly joined audio have the right
-                # length.
-                joined_audio = joined_audio.append(
-                    seg=audio_since_last_cut,
-                    crossfade=min(before_fade_length, len(joined_audio)))
-                # Right now, it seems that we only do a crossfade when we append "since last cut"
-                # to the latest joined audio. That is, the end of a section with effects applied
-                # to it, crossfades with the next section of untreated audio.
-                # But when we append treated audio to the main joined_audio, it is done without
-                # crossfading, resulting in a potentially harsh cut with pops and clicks.
-                # This is because the treatments may change the length of the treated section -
-                # so it is hard to just add an additional chunk at the start. And we can't just add
-                # an untreated pre-section to the start of the treated section after effects,
-                # cause that will just cause more pops.
-                # It seems like regular crossfading slides section B into the tail of section A
-                # by n milliseconds, with a fade out and in at the same time.
-                # Could we push that, so section A slides into the start of section B instead?
-                # Could we just append a piece of audio from the beginning of section B with
-                # the length of the crossfade to the end of section A (the joined_audio),
-                # without crossfade, and then do a crossfade between A and B?
-
+                steps.append((
+                    OP_COPY, current_bar_number, cut.get('number'),
+                    cut.get('resolution'), end_of_last_cut - before_fade_length,
+                    start_time + after_fade_length, before_fade_length,
+                    after_fade_length, None))
                 end_of_last_cut = end_time
                 if 'remove' in beat_effects:
                     # When removing, we skip the rest of the effects processing, including
@@ -1118,212 +1418,183 @@ class SongTwister:
                     # The crossfading setting will then smoothen the cut between before and
                     # after this beat.
                     continue
+                steps.append((
+                    OP_SILENCE if 'silence' in beat_effects else OP_BEAT,
+                    current_bar_number, cut.get('number'),
+                    cut.get('resolution'), start_time, end_time,
+                    fade_length, 0, beat_effects))
+        return RenderPlan.build(
+            steps, frame_rate=frame_rate or self._get_frame_rate(),
+            crossfade_after=self.crossfade_after)
+
+    def _iter_cuts(self, plan: RenderPlan) -> Iterator[Cut]:
+        """Get the cuts to join from a render plan, with the beats rendered:
+        the untreated audio since the last cut, and the treated beat."""
+        self._shift_pitch_in_batches(plan.beats())
+        if self.beat_cache is not None:
+            return plan.cuts(self._render_beat_cached)
+        return plan.cuts(self._render_beat)
+
+    def _render_incremental(self, plan: RenderPlan) -> AudioSegment:
+        """The numpy render engine, reusing the last render of this song,
+        or of the song it was spawned from.
+        Only the beats that are not in the last render are rendered, and
+        only the cuts that changed since then are laid out and joined
+        again, and patched into it. Editing the effects of one bar costs
+        about as much as rendering that bar, whatever the length of the
+        song."""
+        keys = plan.cut_keys()
+        random_chains = {chain for chain in plan.effects
+                         if self._effects_draw_random(chain.split('\n'))}
+        # Without a seed, the random beats are drawn again on every render,
+        # as the pydub engine does, so their cuts never match the last render
+        redraw = bool(random_chains) and self.seed is None
+        if redraw:
+            keys = [key + (object(),) if random_chains.intersection(key[1::2])
+                    else key for key in keys]
+        slot = self._last_render
+        previous = slot.state
+        if previous is not None and not previous.matches(
+                self.audio, self.crossfade_curve, plan.crossfade_after):
+            previous = None
+        if (previous is not None and slot.owner is not None
+                and slot.owner() is not self and random_chains):
+            # Another song drew its random beats with its own rng
+            previous = None
+        if previous is not None and previous.keys == keys:
+            return previous.output
+        beats = previous.beats if previous is not None else {}
+        render_beat = (self._render_beat_cached
+                       if self.beat_cache is not None else self._render_beat)
+
+        def _beat_key(current_bar_number: int, cut: dict) -> tuple:
+            return (current_bar_number, cut.get('number'), cut.get('start'),
+                    cut.get('end'), cut.get('resolution'),
+                    tuple(cut.get('effects')), self.resample_quality)
+
+        def _reuse_beat(current_bar_number: int, cut: dict):
+            if redraw and self._effects_draw_random(cut.get('effects')):
+                return render_beat(current_bar_number, cut)
+            key = _beat_key(current_bar_number, cut)
+            if key not in beats:
+                beats[key] = render_beat(current_bar_number, cut)
+            return beats[key]
+
+        if previous is not None:
+            prefix, suffix = render_engine.unchanged_cuts(previous.keys, keys)
+        else:
+            prefix, suffix = 0, 0
+        self._shift_pitch_in_batches(
+            beat for beat in plan.beats(prefix, len(keys) - suffix)
+            if _beat_key(*beat) not in beats)
+        slot.state = render_engine.render_incremental(
+            lambda start: plan.cuts(_reuse_beat, start), keys, beats,
+            source=self.audio, previous=previous,
+            crossfade_after=plan.crossfade_after, curve=self.crossfade_curve,
+            unchanged=(prefix, suffix))
+        slot.owner = weakref.ref(self)
+        if len(beats) > 2 * len(keys):
+            # Keep only the beats of this render
+            used = {_beat_key(*beat) for beat in plan.beats()}
+            for key in [key for key in beats if key not in used]:
+                del beats[key]
+        return slot.state.output
 
-                if 'silence' in beat_effects:
-                    # Create a silent audiosegment with the duration of this beat
-                    beat_audio = AudioSegment.silent(duration=cut_duration)
-                else:
-                    # NOTE: Consider get_sample_slice() !!
-                    # beat_audio = self.audio[start_time:end_time]
-                    beat_audio = self.slice(start_time, end_time)
-                    beat_length = len(beat_audio)
-
-                    # if 'insert' or 'replace' are in effects we need to find and extract a piece of audio from the full song audio.
-                    # 'insert' appends it to the current beat audio. 'replace' removes the beat audio and puts this in instead.
-                    # Syntax: insert/replace <bar> <beat>
-                    # bar selectors may be: this, next, previous, next_n, previous_n, first, last, or a specific number (int).
-                    # If there are invalid values or the selection is out of range, we just move on.
-                    # So:
-                    # - get the effect and split it out
-                    # - if it is valid, parse the bar selection
-                    # - parse the beat selection
-                    # - determine the sample indices of the requested audio
-                    # - either replace beat_audio or join it with the crossfade
-                    insert_effect = [x for x in beat_effects
-                                     if x.startswith('insert')
-                                     or x.startswith('replace')]
-                    if insert_effect:
-                        # Parse selectors
-                        insert_parts = insert_effect[0].split()
-                        insert_type: str = insert_parts[0]
-                        if len(insert_parts) not in (2, 3):
-                            logger.error("Could not parse effect: %s", insert_effect)
-                            continue
-                        if len(insert_parts) == 2:
-                            insert_bar = 'this'
-                            insert_beat: str = insert_parts[1]
-                        else:
-                            insert_bar: str = insert_parts[1]
-                            insert_beat: str = insert_parts[2]
-                        # Set bar boundaries
-                        first_bar = 1
-                        last_bar = max([x.get('number') for x in self.bar_sequence])
-                        # Select bar
-                        selected_insert_bar = self.perform_single_selection(
-                            selector=insert_bar, current=current_bar_number,
-                            first=first_bar, last=last_bar)
-                        if not selected_insert_bar:
-                            continue
-                        # Select beat
-                        beat_count = cut.get('resolution')
-                        first_beat = 1
-                        last_beat = beat_count
-                        current_beat_number = cut.get('number')
-                        selected_insert_beat = self.perform_single_selection(
-                            selector=insert_beat, current=current_beat_number,
-                            first=first_beat, last=last_beat
-                        )
-                        if not selected_insert_beat:
-                            continue
-                        logger.debug("in bar %s at beat %s I will %s beat %s from bar %s. Beat count: %s",
-                                     current_bar_number, current_beat_number, insert_type,
-                                     selected_insert_beat, selected_insert_bar, beat_count)
-                        # Fetch bar from sequence and determine beat position
-                        target_bar = self.get_single_bar(selected_insert_bar)
-                        target_bar_start = target_bar.get('start')
-                        target_bar_end = target_bar.get('end')
-                        bar_length = target_bar_end - target_bar_start
-                        target_beat_length = bar_length / beat_count
-                        target_start_time = target_bar_start + (target_beat_length * (selected_insert_beat - 1))
-                        target_end_time = target_start_time + target_beat_length
-                        # Cut out the audio
-                        # !!target_audio = self.audio[target_start_time:target_end_time]
-                        target_audio = self.slice(target_start_time, target_end_time)
-                        # Extend or replace beat audio
-                        if insert_type == 'replace':
-                            beat_audio = target_audio
-                        else:
-                            # FIXME support crossfade?
-                            beat_audio = beat_audio.append(
-                                target_audio, crossfade=0)
-                        beat_length = len(beat_audio)
-
-                    speed = self._get_effect(
-                        'speed', beat_effects, get_float=True)
-                    if speed:
-                        # We will only apply one speed change effect at a time.
-                        # Take the last applied
-                        speed_change_type, speed_rate = speed
-
-                        # In 'fill' mode, we extend the selected audio by that amount.
-                        # So that when we speed it up, it retains the overall duration,
-                        # it just covers more audio content
-                        if 'fill' in speed_change_type and speed_rate >= 1:
-                            new_length = beat_length * speed_rate
-                            end_time = start_time + new_length
-                            # !!beat_audio = self.audio[start_time:end_time]
-                            beat_audio = self.slice(start_time, end_time)
-
-                        if 'speedup' in speed_change_type and speed_rate >= 1:
-                            beat_audio = self._effect_speedup(
-                                audio=beat_audio,
-                                speed=speed_rate,
-                                chop_to_length='x')
-                        else:
-                            beat_audio = self._effect_speed_change(
-                                audio=beat_audio, speed=speed_rate)
-
-                    pitch = self._get_effect('pitch', beat_effects)
-                    if pitch:
-                        # We will only apply one speed change effect at a time.
-                        # Take the last applied
-                        pitch_change, pitch_semitones = pitch
-
-                        # NOTE: we only support downpitching currently, and barely that
-                        if pitch_change == 'pitchdown':
-                            step = (1/12) * pitch_semitones
-                            downwards = 1 - ((step) / 2)
-
-                            # First we slow down, with pitch following along
-                            # Then we speed back up, preserving the altered pitch
-                            crossfade = 50
-                            chunk = 150
-                            if step > 10:
-                                chunk = 20
-                                crossfade = 5
-                            elif step > 6:
-                                chunk = 40
-                                crossfade = 20
-                            elif step > 5:
-                                chunk = 80
-                                crossfade = 35
-                            elif step > 3:
-                                chunk = 100
-                            # This is some wonky handheld math with magic numbers.
-                            # Could probably be a log scale thing?
-                            old_len = beat_length
-                            beat_audio = self._effect_speed_change(
-                                audio=beat_audio, speed=downwards)
-                            down_len = len(beat_audio)
-                            beat_audio = self._effect_speedup(
-                                audio=beat_audio, speed=down_len / old_len,
-                                crossfade=crossfade, chunk_size=chunk)
-                            # the speedup result ends up longer
-                            # (probably because of chunking and crossfading)
-                            # To keep the rythm, we chop down the new
-                            # version to retain the timing
-                            speed_change_type = len(beat_audio) - old_len
-                            if speed_change_type and speed_change_type > 10:
-                                half_change = speed_change_type / 2
-                                beat_audio = beat_audio[half_change:-half_change]
-
-                    if 'reverse' in beat_effects:
-                        beat_audio = beat_audio.reverse()
-                    elif 'repeat' in beat_effects:
-                        beat_audio = beat_audio.append(
-                            beat_audio, crossfade=0)
-                    elif 'repeatreverse' in beat_effects:
-                        beat_audio = beat_audio.append(
-                            beat_audio.reverse(), crossfade=0)
-                    elif 'reverserepeat' in beat_effects:
-                        beat_audio = beat_audio.reverse().append(
-                            beat_audio, crossfade=0)
-                    # FIXME These two should be reworked
-                    elif 'reverseping' in beat_effects:
-                        beat_audio = beat_audio.pan(-1).append(
-                            beat_audio.pan(1), crossfade=0)
-                    elif 'reversepong' in beat_effects:
-                        beat_audio = beat_audio.pan(1).append(
-                            beat_audio.pan(-1), crossfade=0)
-                    elif 'across left' in beat_effects:
-                        beat_audio = beat_audio.pan(1).append(
-                            beat_audio.pan(-1), crossfade=beat_length)
-                    elif 'across right' in beat_effects or 'across' in beat_effects:
-                        beat_audio = beat_audio.pan(-1).append(
-                            beat_audio.pan(1), crossfade=beat_length)
-                    elif 'bounceback' in beat_effects:
-                        beat_audio = beat_audio.append(
-                            beat_audio.reverse(), crossfade=beat_length)
-
-                    pingpong = self._get_effect(
-                        'pingpong', beat_effects, fallback=2)
-                    if pingpong:
-                        _, pong_count = pingpong
-                        # split here into pingpong_count segments,
-                        # and do alternating hard pans on them.
-                        segment_length = beat_length / pong_count
-                        pong_audio = AudioSegment.empty()
-                        for pong_number in range(pong_count):
-                            pong_start = segment_length * pong_number
-                            pong_end = segment_length * (pong_number + 1)
-                            pan = 1 if pong_number % 2 else -1
-                            segment = beat_audio[pong_start:pong_end].pan(pan)
-                            pong_crossfade = 5 if len(pong_audio) else 0
-                            pong_audio = pong_audio.append(
-                                segment, crossfade=pong_crossfade)
-                        beat_audio = pong_audio
-                    elif 'left' in beat_effects:
-                        beat_audio = beat_audio.pan(-1)
-                    elif 'right' in beat_effects:
-                        beat_audio = beat_audio.pan(1)
-
-                if not self.crossfade_after:
-                    fade_length = 0
-                elif fade_length >= len(joined_audio):
-                    fade_length = len(joined_audio)
+    @staticmethod
+    def _effects_draw_random(effects: Iterable[str]) -> bool:
+        """Whether rendering a beat with these effects draws from the rng"""
+        for effect in effects:
+            parts = effect.split()
+            if parts[:1] in (['insert'], ['replace']) and 'random' in parts:
+                return True
+        return False
 
-                joined_audio = joined_audio.append(
-                    beat_audio,
-                    crossfade=min(fade_length, len(beat_audio)))
+    def _join_cuts(self, cuts: Iterable[Cut],
+                   crossfade_after: bool = True) -> AudioSegment:
+        """The pydub render engine: append the cuts to an AudioSegment
+        one at a time."""
+        joined_audio = AudioSegment.empty()
+        for cut in cuts:
+            audio_since_last_cut = self.slice(
+                cut.since_start, cut.since_end, view=True)
+            # We append the section since the last cut was made to the overall rejoined
+            # song. If this is the first iteration, we append to an empty AS.
+            # We use the crossfade to smoothen the transition, if the last cut made a
+            # big change, like 'remove'. Otherwise, we might get a nasty click or pop.
+            # Therefore we extend the audio_since_last_cut section at the beginning with
+            # the length of the crossfade, so we have a piece "too much" of the audio
+            # before. When we append the audio to the joined_audio, we do a crossfade of
+            # the same length. This should make the newly joined audio have the right
+            # length.
+            # Right now, it seems that we only do a crossfade when we append "since last cut"
+            # to the latest joined audio. That is, the end of a section with effects applied
+            # to it, crossfades with the next section of untreated audio.
+            # But when we append treated audio to the main joined_audio, it is done without
+            # crossfading, resulting in a potentially harsh cut with pops and clicks.
+            # This is because the treatments may change the length of the treated section -
+            # so it is hard to just add an additional chunk at the start. And we can't just add
+            # an untreated pre-section to the start of the treated section after effects,
+            # cause that will just cause more pops.
+            # It seems like regular crossfading slides section B into the tail of section A
+            # by n milliseconds, with a fade out and in at the same time.
+            # Could we push that, so section A slides into the start of section B instead?
+            # Could we just append a piece of audio from the beginning of section B with
+            # the length of the crossfade to the end of section A (the joined_audio),
+            # without crossfade, and then do a crossfade between A and B?
+            joined_audio = joined_audio.append(
+                seg=audio_since_last_cut,
+                crossfade=min(cut.before_fade, len(joined_audio)),
+                curve=self.crossfade_curve)
+            if cut.beat is None:
+                continue
+            fade_length = cut.beat_fade
+            if not crossfade_after:
+                fade_length = 0
+            elif fade_length >= len(joined_audio):
+                fade_length = len(joined_audio)
+
+            joined_audio = joined_audio.append(
+                cut.beat,
+                crossfade=min(fade_length, len(cut.beat)),
+                curve=self.crossfade_curve)
+        return joined_audio
+
+    def apply_effects(self, engine: Optional[str] = None,
+                      plan: Optional[RenderPlan] = None) -> Self:
+        """Effects are first added to a mapping, allowing them to be
+        added one at a time. This generates a new SongTwister instance with the
+        effects applied.
+        The effects are compiled to a render plan, unless a plan is passed.
+        The engine ('numpy' or 'pydub') defaults to self.render_engine.
+        Both give the same audio, but the numpy engine writes every cut into
+        one preallocated buffer instead of appending them one at a time.
+        The numpy engine keeps its render, so when more effects are added
+        and applied again, only the changed bars are rendered."""
+        logger.info("Applying effects")
+        if not self.audio:
+            self.load_audio()
+        if plan is None:
+            plan = self.compile_plan()
+        if not len(plan):
+            logger.warning("No effects to apply - returning original audio.")
+            return self.audio
+        engine = engine or self.render_engine
+        if engine not in render_engine.ENGINES:
+            raise ValueError(f"Unknown render engine: {engine}")
+        if self.crossfade_curve not in CROSSFADE_CURVES:
+            raise ValueError(f"Unknown crossfade curve: {self.crossfade_curve}")
+        if self.resample_quality not in resample.QUALITIES:
+            raise ValueError(
+                f"Unknown resample quality: {self.resample_quality}")
+
+        joined_audio = None
+        if engine == 'numpy':
+            try:
+                joined_audio = self._render_incremental(plan)
+            except render_engine.EngineFallback as e:
+                logger.info("Falling back to the pydub engine: %s", e)
+        if joined_audio is None:
+            joined_audio = self._join_cuts(
+                self._iter_cuts(plan), crossfade_after=plan.crossfade_after)
         logger.info("Finished applying effects")
         return self.spawn_new_instance(joined_audio)
@@ -0,0 +1,247 @@
+"""Tempo estimation from the onsets of audio, in NumPy.
+
+The audio is mixed to mono, decimated to about ANALYSIS_RATE, and cut into
+overlapping windows with a strided view, so the spectra of all the windows
+are taken with one FFT. The onset strength of each window is the spectral
+flux: how much the log-compressed magnitudes rise from the window before.
+
+The autocorrelation of the onset strength, again by FFT, peaks at the
+periods the onsets repeat at. Each tempo of a fine grid is scored with a
+comb: the mean autocorrelation at the first COMB_BEATS multiples of its beat
+period. A tempo at half or double the true one also lines up with most of
+the onsets, so the scores are weighted by a prior around PRIOR_BPM, which
+favours the more common tempos. The best tempos are then refined with a
+longer comb, of REFINE_BEATS multiples, where a small error in the period
+adds up to a larger miss.
+
+A beat grid, of a bpm and the time of the first beat, is fitted by
+cross-correlating the onsets with an impulse train on the beats of each of
+a batch of tempos. One FFT per tempo scores every phase of the grid at once.
+The prefix is the beat of the best grid where the music starts. The onsets
+say little about which beat starts a bar, as a snare on the second beat is
+often stronger than the kick on the first, so that is left to where the
+music starts.
+"""
+from collections import namedtuple
+from typing import Optional
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("songtwister.tempo")
+
+ANALYSIS_RATE = 11025  # The audio is decimated to about this frame rate
+WINDOW_FRAMES = 256  # Frames per analysis window, at the analysis rate
+HOP_FRAMES = 128  # Frames between the starts of the windows
+COMPRESSION = 1000.0  # Magnitudes are compressed as log(1 + COMPRESSION * x)
+MIN_BPM = 60
+MAX_BPM = 200
+BPM_STEP = 0.05  # The resolution of the tempo grid, before refinement
+COMB_BEATS = 8  # Multiples of the beat period each tempo is scored at
+REFINE_BEATS = 32  # Multiples of the beat period a candidate is refined with
+REFINE_SPAN = 0.01  # How far a candidate may move when refined, as a ratio
+REFINE_STEPS = 201
+PRIOR_BPM = 120  # The centre of the prior over tempos
+PRIOR_OCTAVES = 1.0  # The width of the prior, in octaves
+CANDIDATES = 5
+FIT_BPM_SPAN = 0.01  # How far a fitted bpm may be from the given one, as a ratio
+FIT_BPM_STEPS = 41  # Tempos tried in the first pass, and again in the second
+# The music starts at the first onset at least this strong, relative to
+# the 99th percentile of the onsets
+START_THRESHOLD = 0.1
+
+# The onset strength of each analysis window. rate is the number of values
+# per second, and offset_ms the time of the first value, at the centre of
+# its window.
+OnsetEnvelope = namedtuple("OnsetEnvelope", ["strength", "rate", "offset_ms"])
+# confidence is the prior-weighted mean autocorrelation of the onsets at the
+# beats of the tempo, from 0 to 1
+TempoCandidate = namedtuple("TempoCandidate", ["bpm", "confidence"])
+# score is the mean onset strength on the beats of the grid, relative to
+# the mean of all the onsets. 1 is no better than chance.
+GridFit = namedtuple("GridFit", ["prefix_length_ms", "bpm", "score"])
+
+
+def onset_envelope(samples: np.ndarray, frame_rate: int) -> OnsetEnvelope:
+    """Get the onset strength of a (frames, channels) sample array, as the
+    spectral flux of short windows"""
+    factor = max(frame_rate // ANALYSIS_RATE, 1)
+    rate = frame_rate / factor
+    scale = 1.0
+    if np.issubdtype(samples.dtype, np.integer):
+        scale = 1.0 / np.iinfo(samples.dtype).max
+    # Mix to mono and average each run of factor frames, which also filters
+    # out most of what would alias, in one matrix product
+    runs = samples[:len(samples) - len(samples) % factor].reshape(
+        -1, factor * samples.shape[1])
+    mono = runs.astype(np.float32) @ np.full(
+        runs.shape[1], scale / runs.shape[1], dtype=np.float32)
+    offset_ms = 1000 * WINDOW_FRAMES / 2 / rate
+    if len(mono) < WINDOW_FRAMES + HOP_FRAMES:
+        return OnsetEnvelope(np.zeros(0, dtype=np.float32), rate / HOP_FRAMES,
+                             offset_ms)
+    windows = np.lib.stride_tricks.sliding_window_view(
+        mono, WINDOW_FRAMES)[::HOP_FRAMES]
+    hann = np.hanning(WINDOW_FRAMES).astype(np.float32)
+    magnitudes = np.abs(np.fft.rfft(windows * hann, axis=1))
+    compressed = np.log1p(COMPRESSION * magnitudes.astype(np.float32))
+    flux = np.maximum(np.diff(compressed, axis=0), 0).sum(axis=1)
+    return OnsetEnvelope(np.concatenate(([0], flux)).astype(np.float32),
+                         rate / HOP_FRAMES, offset_ms)
+
+
+def autocorrelation(values: np.ndarray) -> np.ndarray:
+    """Get the autocorrelation of values around their mean, by FFT,
+    normalized to 1 at lag 0"""
+    centered = values - values.mean()
+    size = 1 << int(np.ceil(np.log2(max(2 * len(values), 1))))
+    spectrum = np.fft.rfft(centered, size)
+    correlation = np.fft.irfft(spectrum * np.conj(spectrum), size)[:len(values)]
+    if not len(values) or correlation[0] <= 0:
+        return np.zeros(len(values))
+    return correlation / correlation[0]
+
+
+def _comb(correlation: np.ndarray, periods: np.ndarray,
+          beats: int) -> np.ndarray:
+    """Get the mean autocorrelation at the first beats multiples of each
+    period, in frames of the envelope"""
+    lags = periods[:, None] * np.arange(1, beats + 1)
+    # Lags past the end of the envelope do not count
+    inside = lags < len(correlation) - 1
+    comb = np.where(inside, np.interp(
+        lags, np.arange(len(correlation)), correlation), 0)
+    return np.clip(comb.sum(axis=1) / np.maximum(inside.sum(axis=1), 1), 0, 1)
+
+
+def _peak(scores: np.ndarray, index: int) -> float:
+    """Get the offset of the top of a parabola through a score and the
+    scores next to it, from -0.5 to 0.5"""
+    if index == 0 or index == len(scores) - 1:
+        return 0.0
+    before, score, after = scores[index - 1:index + 2]
+    curvature = before - 2 * score + after
+    if curvature >= 0:
+        return 0.0
+    return float(0.5 * (before - after) / curvature)
+
+
+def _prior(bpms: np.ndarray) -> np.ndarray:
+    """The weight of each tempo, highest at PRIOR_BPM"""
+    return np.exp(-0.5 * (np.log2(bpms / PRIOR_BPM) / PRIOR_OCTAVES) ** 2)
+
+
+def _refine(correlation: np.ndarray, rate: float, bpm: float) -> float:
+    """Find the tempo within REFINE_SPAN of bpm that lines up best with the
+    onsets over REFINE_BEATS beats"""
+    bpms = bpm * (1 + np.linspace(-REFINE_SPAN, REFINE_SPAN, REFINE_STEPS))
+    scores = _comb(correlation, 60 * rate / bpms, REFINE_BEATS)
+    best = int(np.argmax(scores))
+    return float(bpms[best] + _peak(scores, best) * (bpms[1] - bpms[0]))
+
+
+def tempo_candidates(envelope: OnsetEnvelope, min_bpm: float = MIN_BPM,
+                     max_bpm: float = MAX_BPM,
+                     count: int = CANDIDATES) -> list[TempoCandidate]:
+    """Get the count most likely tempos of an onset envelope, best first.
+    Each is a peak of the prior-weighted comb scores over a grid of tempos,
+    refined with a longer comb."""
+    bpms = np.arange(min_bpm, max_bpm + BPM_STEP / 2, BPM_STEP)
+    if len(envelope.strength) < 2 or len(bpms) < 3:
+        return []
+    correlation = autocorrelation(envelope.strength)
+    scores = _comb(correlation, 60 * envelope.rate / bpms,
+                   COMB_BEATS) * _prior(bpms)
+    before, score, after = scores[:-2], scores[1:-1], scores[2:]
+    peaks = np.flatnonzero((score > before) & (score >= after) & (score > 0)) + 1
+    peaks = peaks[np.argsort(scores[peaks])[::-1]][:count]
+    return [TempoCandidate(
+                round(_refine(correlation, envelope.rate, float(bpms[peak])), 2),
+                round(float(scores[peak]), 3))
+            for peak in peaks]
+
+
+def detect_bpm(samples: np.ndarray, frame_rate: int,
+               min_bpm: float = MIN_BPM, max_bpm: float = MAX_BPM,
+               count: int = CANDIDATES) -> list[TempoCandidate]:
+    """Estimate the tempo of a (frames, channels) sample array. Returns up to
+    count candidates, best first."""
+    return tempo_candidates(onset_envelope(samples, frame_rate),
+                            min_bpm=min_bpm, max_bpm=max_bpm, count=count)
+
+
+def _comb_spectra(bpms: np.ndarray, rate: float, length: int,
+                  size: int) -> np.ndarray:
+    """Get the spectra of impulse trains on the beats of each tempo within
+    length frames. The weights of each train add up to 1. Beats between two
+    frames are split between them."""
+    periods = 60 * rate / bpms
+    beats = np.arange(int(length / periods.min()) + 1)
+    positions = periods[:, None] * beats
+    weights = (positions < length - 1).astype(np.float64)
+    weights /= weights.sum(axis=1, keepdims=True)
+    lower = np.minimum(positions.astype(np.int64), size - 2)
+    fraction = positions - lower
+    rows = np.broadcast_to(np.arange(len(bpms))[:, None], positions.shape)
+    combs = np.zeros((len(bpms), size))
+    np.add.at(combs, (rows, lower), weights * (1 - fraction))
+    np.add.at(combs, (rows, lower + 1), weights * fraction)
+    return np.fft.rfft(combs, axis=1)
+
+
+def _grid_scores(envelope: OnsetEnvelope,
+                 bpms: np.ndarray) -> Optional[np.ndarray]:
+    """Score every phase of the grid of each tempo, as a (bpms, phases)
+    array, where phase is the envelope frame of the first beat, up to a
+    beat of the slowest tempo. None if the envelope is too short."""
+    strength = envelope.strength
+    phases = int(np.ceil(60 * envelope.rate / bpms.min())) + 1
+    # Leave room to move the grid by a whole beat without running off the end
+    length = len(strength) - phases
+    if length < 2 * phases:
+        return None
+    size = 1 << int(np.ceil(np.log2(len(strength))))
+    spectrum = np.fft.rfft(strength, size)
+    combs = _comb_spectra(bpms, envelope.rate, length, size)
+    return np.fft.irfft(spectrum * np.conj(combs), size, axis=1)[:, :phases]
+
+
+def _music_start_ms(envelope: OnsetEnvelope) -> float:
+    """Get the time of the first strong onset"""
+    strength = envelope.strength
+    first = int(np.argmax(
+        strength >= START_THRESHOLD * np.percentile(strength, 99)))
+    return envelope.offset_ms + 1000 * first / envelope.rate
+
+
+def fit_grid(envelope: OnsetEnvelope, bpm: float,
+             bpm_span: float = FIT_BPM_SPAN) -> Optional[GridFit]:
+    """Find the beat grid that lines up best with the onsets, within
+    bpm_span of bpm. The tempos are tried in two passes, the second
+    between the neighbours of the best of the first. The prefix is the
+    first beat of the grid at most half a beat before the music starts.
+    None if the envelope is too short to fit a grid to."""
+    if not len(envelope.strength) or envelope.strength.mean() <= 0:
+        return None
+    bpms = bpm * (1 + np.linspace(-bpm_span, bpm_span, FIT_BPM_STEPS))
+    for _ in range(2):
+        scores = _grid_scores(envelope, bpms)
+        if scores is None:
+            return None
+        best_bpm, phase = np.unravel_index(np.argmax(scores), scores.shape)
+        step = bpms[1] - bpms[0]
+        fitted_bpm = float(bpms[best_bpm]
+                           + _peak(scores[:, phase], best_bpm) * step)
+        bpms = np.linspace(bpms[best_bpm] - step, bpms[best_bpm] + step,
+                           FIT_BPM_STEPS)
+    phase_ms = envelope.offset_ms + 1000 * (
+        phase + _peak(scores[best_bpm], phase)) / envelope.rate
+
+    beat_ms = 60000 / fitted_bpm
+    beats = np.ceil((_music_start_ms(envelope) - beat_ms / 2 - phase_ms) / beat_ms)
+    prefix_length_ms = max(phase_ms + beats * beat_ms, 0)
+    score = scores[best_bpm, phase] / envelope.strength.mean()
+    logger.debug("Fitted a grid of %.3f bpm, %.1f ms prefix, score %.2f",
+                 fitted_bpm, prefix_length_ms, score)
+    return GridFit(int(round(prefix_length_ms)), round(fitted_bpm, 3),
+                   round(float(score), 2))
@@ -0,0 +1,25 @@
+"""Songs for the tests: the click tracks of the benchmarks, made in memory."""
+import pytest
+
+from benchmarks.synthetic import click_track, synthetic_song
+from songtwister import SongTwister
+
+
+def click_song(bars: int = 8, bpm: float = 120.0, frame_rate: int = 22050,
+               prefix_ms: int | float = 0, **kwargs) -> SongTwister:
+    """Make a song of a click track. Other keyword arguments are passed on
+    to SongTwister."""
+    return synthetic_song(bars=bars, bpm=bpm, frame_rate=frame_rate,
+                          prefix_ms=prefix_ms, **kwargs)
+
+
+@pytest.fixture
+def make_click_track():
+    def _click_track(bars: int, frame_rate: int = 22050, **kwargs):
+        return click_track(bars, frame_rate=frame_rate, **kwargs)
+    return _click_track
+
+
+@pytest.fixture
+def make_song():
+    return click_song
@@ -0,0 +1,82 @@
+"""Tests of processing audio with ffmpeg."""
+import os
+import shutil
+import sys
+
+import pytest
+from pydub.exceptions import CouldntDecodeError
+
+from audiosegment_patch import PatchedAudioSegment as AudioSegment
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None,
+                                  reason="ffmpeg is not installed")
+CHAINS = ['', 'volume=0.5', 'atempo=1.25', 'areverse']
+
+
+@pytest.fixture
+def audio(make_click_track) -> AudioSegment:
+    # Longer than a pipe holds, so the outputs must be read as they come
+    return make_click_track(2)
+
+
+def _open_fds() -> int:
+    return len(os.listdir('/proc/self/fd'))
+
+
+@needs_ffmpeg
+def test_split_outputs_are_each_chain_alone(audio):
+    processed = audio.process_many_with_ffmpeg(CHAINS)
+    assert len(processed) == len(CHAINS)
+    for chain, segment in zip(CHAINS, processed):
+        alone = audio.process_with_ffmpeg(["-af", chain or 'anull'])
+        assert segment.raw_data == alone.raw_data
+        assert isinstance(segment.raw_data, memoryview)
+        assert (segment.frame_rate, segment.channels, segment.sample_width) \
+            == (audio.frame_rate, audio.channels, audio.sample_width)
+    assert processed[0].raw_data == audio.raw_data
+    assert len(processed[2]) == pytest.approx(len(audio) / 1.25, abs=30)
+
+
+@needs_ffmpeg
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'),
+                    reason="Needs /proc to count the open files")
+def test_split_outputs_close_their_pipes(audio):
+    open_fds = _open_fds()
+    audio.process_many_with_ffmpeg(CHAINS)
+    with pytest.raises(CouldntDecodeError):
+        audio.process_many_with_ffmpeg(['volume=0.5', 'nosuchfilter'])
+    assert _open_fds() == open_fds
+
+
+def test_split_outputs_without_pipes_run_each_chain(audio, monkeypatch):
+    monkeypatch.setattr(sys, 'platform', 'win32')
+    monkeypatch.setattr(os, 'pipe', None)
+    monkeypatch.setattr(AudioSegment, 'process_with_ffmpeg',
+                        lambda segment, parameters=None: parameters)
+    assert audio.process_many_with_ffmpeg(['volume=0.5', '']) == [
+        ["-af", 'volume=0.5'], ["-af", 'anull']]
+    assert audio.process_many_with_ffmpeg([]) == []
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize('sample_width', [1, 2, 4])
+def test_processed_samples_are_read_into_a_buffer(audio, sample_width):
+    audio = audio.set_sample_width(sample_width)
+    processed = audio.process_with_ffmpeg(["-af", "anull"])
+    assert isinstance(processed.raw_data, memoryview)
+    assert processed.raw_data == audio.raw_data
+    assert processed.sample_width == sample_width
+
+
+@needs_ffmpeg
+def test_processed_buffer_grows_with_the_output(audio):
+    processed = audio.process_with_ffmpeg(["-af", "atempo=0.5"])
+    # The buffer is sized after the input at first
+    assert len(processed.raw_data) > 1.9 * len(audio.raw_data)
+    assert len(processed.raw_data) % audio.frame_width == 0
+
+
+@needs_ffmpeg
+def test_processing_errors_are_raised(audio):
+    with pytest.raises(CouldntDecodeError, match="nosuchfilter"):
+        audio.process_with_ffmpeg(["-af", "nosuchfilter"])
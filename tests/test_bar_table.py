@@ -0,0 +1,90 @@
+"""Tests of the table of bars."""
+import pytest
+
+from bar_table import BarTable
+
+
+def _build_in_a_loop(prefix_length_ms, bar_length_ms, audio_length_ms,
+                     suffix_length_ms=0):
+    """The bars as SongTwister.build_bar_sequence laid them out in a loop,
+    before the table"""
+    remainder = audio_length_ms - prefix_length_ms
+    bars = []
+    number = 1
+    position = prefix_length_ms
+    while True:
+        if suffix_length_ms and remainder <= suffix_length_ms:
+            break
+        if remainder < bar_length_ms:
+            break
+        end = position + bar_length_ms
+        bars.append({'number': number, 'start': position, 'end': end})
+        position = end
+        remainder = remainder - bar_length_ms
+        number += 1
+    return bars, remainder
+
+
+@pytest.mark.parametrize(('prefix', 'bar', 'length', 'suffix'), [
+    (0, 2000, 16000, 0),
+    (250, 2000, 16100, 0),
+    (250, 2000, 16250, 0),
+    (250, 2000, 16100, 1000),
+    (250, 2000, 18250, 2000),
+    (0, 1875.0, 30000, 0),
+    (123.4, 1714.2857142857142, 200000, 0),
+    (123.4, 1714.2857142857142, 200000, 3000.5),
+    (0.0, 2000, 16000.0, 0),
+    (500, 2000, 1500, 0),
+    (0, 2000, 1999, 0),
+])
+def test_bars_are_laid_out_as_in_a_loop(prefix, bar, length, suffix):
+    table, remainder = BarTable.build(prefix, bar, length, suffix)
+    bars, loop_remainder = _build_in_a_loop(prefix, bar, length, suffix)
+    assert table.to_list() == bars
+    assert [type(x['start']) for x in table] == [
+        type(x['start']) for x in bars]
+    assert remainder == loop_remainder
+    assert type(remainder) is type(loop_remainder)
+    assert table.last_number == len(bars)
+
+
+def test_invalid_bar_length():
+    with pytest.raises(ValueError):
+        BarTable.build(0, 0, 16000)
+
+
+def test_effects_and_sections():
+    table, _ = BarTable.build(0, 2000, 16000)
+    effect = {'effect': 'reverse', 'beats': '2'}
+    table.add_effect(3, effect)
+    table.add_effect(3, dict(effect))
+    table.add_effect(5, {'effect': 'remove', 'beats': '1'})
+    table.sections[2] = 'verse'
+    assert table.bar(3)['effects'] == [effect]
+    assert [bar['number'] for bar in table.bars_with_effects()] == [3, 5]
+    assert [bar['number'] for bar in table.select([5, 2, 2, 99])] == [2, 5]
+    assert table.bar(2) == {'number': 2, 'start': 2000, 'end': 4000,
+                            'section': 'verse'}
+    assert 8 in table and 9 not in table
+    with pytest.raises(KeyError):
+        table.bar(9)
+
+    copied = BarTable.from_list(table.to_list())
+    assert copied.to_list() == table.to_list()
+    # The effects of the copy are its own
+    copied.add_effect(3, {'effect': 'repeat', 'beats': '1'})
+    assert table.bar(3)['effects'] == [effect]
+
+
+def test_songs_keep_their_bars_in_a_table(make_song):
+    song = make_song(bars=8, prefix_ms=250)
+    suffix_length_ms = song.suffix_length_ms
+    song.build_bar_sequence()
+    bars, remainder = _build_in_a_loop(
+        song.prefix_length_ms, song.bar_length_ms, song.audio_length_ms,
+        suffix_length_ms)
+    assert isinstance(song.bar_sequence, BarTable)
+    assert song.bar_sequence.to_list() == bars
+    assert len(bars) == 8
+    assert song.suffix_length_ms == remainder
@@ -0,0 +1,44 @@
+"""Tests of the manifest of batch runs."""
+import batch_manifest
+from batch_manifest import BatchManifest, job_id
+
+JOBS = [job_id('song', preset, crossfade='1/128')
+        for preset in ('swing', 'waltz', 'folk')]
+
+
+def test_resumes_the_jobs_that_were_not_done(tmp_path):
+    path = tmp_path / 'batch_manifest.json'
+    manifest = BatchManifest(path)
+    for job in JOBS:
+        manifest.add(job, song='song')
+    manifest.save()
+    manifest.mark(JOBS[0], batch_manifest.DONE)
+    manifest.mark(JOBS[1], batch_manifest.FAILED, error='boom')
+
+    # The batch is stopped, and run again
+    manifest = BatchManifest(path)
+    for job in JOBS:
+        manifest.add(job, song='song')
+    assert manifest.pending(JOBS) == JOBS[1:]
+    assert manifest.status(JOBS[1]) == batch_manifest.FAILED
+    assert manifest.counts() == {batch_manifest.DONE: 1,
+                                 batch_manifest.FAILED: 1,
+                                 batch_manifest.PENDING: 1}
+
+    manifest.mark(JOBS[1], batch_manifest.DONE)
+    assert 'error' not in manifest.jobs[JOBS[1]]
+    assert BatchManifest(path).pending(JOBS) == JOBS[2:]
+
+
+def test_job_ids():
+    assert job_id('song', 'swing') == 'song/swing'
+    assert job_id('song', 'swing', 'v2', 0) == 'song/swing/version-v2/fade-0'
+    assert job_id('song', 'swing', crossfade='1/128') != job_id(
+        'song', 'swing', crossfade='1/64')
+
+
+def test_unreadable_manifest_starts_over(tmp_path):
+    path = tmp_path / 'batch_manifest.json'
+    path.write_text('{not json')
+    manifest = BatchManifest(path)
+    assert manifest.pending(JOBS) == JOBS
@@ -0,0 +1,16 @@
+"""Tests of the benchmark cases."""
+from benchmarks import cases
+from benchmarks.synthetic import synthetic_song
+
+
+def test_subdivision_cases_keep_the_song_params():
+    params = {'bars': 96, 'frame_rate': 44100}
+    scaling = cases.scaling_cases(lambda: synthetic_song(bars=96), params,
+                                  bar_counts=(1000, 5000))
+    subdivisions = [case for case in scaling
+                    if '/subdivisions-' in case.name]
+    assert subdivisions
+    for case in subdivisions:
+        assert case.params == {**params, 'beats_per_bar': int(
+            case.name.rsplit('-', 1)[1])}
+    assert params == {'bars': 96, 'frame_rate': 44100}
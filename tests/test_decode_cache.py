@@ -0,0 +1,87 @@
+"""Tests of the on-disk cache of decoded audio."""
+import gc
+import os
+
+import pytest
+
+from audiosegment_patch import PatchedAudioSegment as AudioSegment
+from decode_cache import DecodeCache
+
+AUDIO_BYTES = 1000
+
+
+def _audio(value: int) -> AudioSegment:
+    return AudioSegment(bytes([value]) * AUDIO_BYTES, sample_width=2,
+                        frame_rate=8000, channels=1)
+
+
+@pytest.fixture
+def songs(tmp_path):
+    """Three input files with different content"""
+    files = []
+    for number in range(3):
+        file = tmp_path / f'song{number}.mp3'
+        file.write_bytes(b'encoded audio %d' % number)
+        files.append(file)
+    return files
+
+
+def test_same_content_is_a_hit(tmp_path, songs):
+    cache = DecodeCache(tmp_path / 'cache')
+    assert cache.load(songs[0]) is None
+    cache.store(songs[0], _audio(1), bitrate='128k')
+    copy = tmp_path / 'copy.mp3'
+    copy.write_bytes(songs[0].read_bytes())
+
+    # A new run reads the index from disk
+    cache = DecodeCache(tmp_path / 'cache')
+    for filename in (songs[0], copy):
+        assert cache.lookup(filename).get('bitrate') == '128k'
+        assert cache.load(filename).raw_data == _audio(1).raw_data
+
+
+def test_changed_files_are_decoded_again(tmp_path, songs):
+    cache = DecodeCache(tmp_path / 'cache')
+    cache.store(songs[0], _audio(1))
+    songs[0].write_bytes(b'other encoded audio')
+    assert cache.lookup(songs[0]) is None
+
+    cache.store(songs[1], _audio(2))
+    # The same size, but a new modification time and content
+    songs[1].write_bytes(b'encoded audio 9')
+    os.utime(songs[1], ns=(1, 1))
+    assert cache.lookup(songs[1]) is None
+
+
+def test_evicts_the_least_recently_used(tmp_path, songs):
+    # Room for two of the songs
+    cache = DecodeCache(tmp_path / 'cache',
+                        max_size_mb=2.5 * AUDIO_BYTES / 1024 / 1024)
+    cache.store(songs[0], _audio(1))
+    cache.store(songs[1], _audio(2))
+    cache.load(songs[0])
+    gc.collect()
+    cache.store(songs[2], _audio(3))
+    assert cache.lookup(songs[0]) is not None
+    assert cache.lookup(songs[1]) is None
+    assert cache.lookup(songs[2]) is not None
+    assert cache.size() <= cache.max_size
+    assert sorted(file.name for file in cache.path.glob('*.pcm')) == sorted(
+        f"{cache.key(song)}.pcm" for song in (songs[0], songs[2]))
+
+
+def test_audio_in_use_is_not_evicted(tmp_path, songs):
+    cache = DecodeCache(tmp_path / 'cache',
+                        max_size_mb=1.5 * AUDIO_BYTES / 1024 / 1024)
+    cache.store(songs[0], _audio(1))
+    audio = cache.load(songs[0])
+    cache.store(songs[1], _audio(2))
+    assert cache.lookup(songs[0]) is not None
+    assert audio.raw_data == _audio(1).raw_data
+
+    # Once the audio is gone, the entry can be evicted
+    del audio
+    gc.collect()
+    cache.store(songs[2], _audio(3))
+    assert cache.lookup(songs[0]) is None
+    assert cache.size() <= cache.max_size
@@ -0,0 +1,103 @@
+"""Tests of the cache of rendered outputs."""
+import os
+
+import pytest
+
+import run
+from output_cache import OutputCache
+from songtwister import ExportResult
+
+SONG = {'filename': 'song.wav', 'bpm': 120}
+PRESET = {'effects': [{'effect': 'reverse', 'beats': '2'}]}
+
+
+@pytest.fixture
+def render(tmp_path):
+    """An input file and the outputs of a render of it"""
+    input_file = tmp_path / 'song.wav'
+    input_file.write_bytes(b'input audio')
+    outputs = tmp_path / 'out'
+    outputs.mkdir()
+    files = [outputs / 'song_swing.mp3', outputs / 'song_swing.peaks.json']
+    for number, file in enumerate(files):
+        file.write_bytes(b'rendered %d' % number)
+    return input_file, files
+
+
+def test_restores_missing_outputs(tmp_path, render):
+    input_file, files = render
+    cache = OutputCache(tmp_path / 'cache')
+    key = cache.key(input_file, SONG, PRESET, crossfade='1/128')
+    assert cache.restore(key) is None
+    cache.store(key, files, filename='song_swing')
+    for file in files:
+        file.unlink()
+
+    # A new run reads the index from disk
+    cache = OutputCache(tmp_path / 'cache')
+    assert cache.restore(key) == {'filename': 'song_swing'}
+    assert [file.read_bytes() for file in files] == [b'rendered 0',
+                                                     b'rendered 1']
+    # Outputs that are still the stored files are left alone
+    assert cache.restore(key) == {'filename': 'song_swing'}
+
+
+def test_changed_outputs_are_kept_unless_overwriting(tmp_path, render):
+    input_file, files = render
+    cache = OutputCache(tmp_path / 'cache')
+    key = cache.key(input_file, SONG, PRESET)
+    cache.store(key, files)
+    files[0].unlink()
+    files[0].write_bytes(b'edited by hand')
+    assert cache.restore(key) is None
+    assert files[0].read_bytes() == b'edited by hand'
+    assert cache.restore(key, overwrite=True) == {}
+    assert files[0].read_bytes() == b'rendered 0'
+
+
+def test_key_follows_what_changes_the_audio(tmp_path, render):
+    input_file, _ = render
+    cache = OutputCache(tmp_path / 'cache')
+    key = cache.key(input_file, SONG, PRESET, crossfade=0)
+    assert cache.key(input_file, {**SONG, 'comment': 'new'}, PRESET,
+                     crossfade=0) == key
+    assert cache.key(input_file, SONG, PRESET, crossfade=10) != key
+    assert cache.key(input_file, SONG, {**PRESET, 'crossfade': 10},
+                     crossfade=0) != key
+    input_file.write_bytes(b'other input audio')
+    os.utime(input_file, ns=(1, 1))
+    assert cache.key(input_file, SONG, PRESET, crossfade=0) != key
+
+
+def test_evicts_the_least_recently_used(tmp_path, render):
+    input_file, files = render
+    # Room for one render of one file
+    cache = OutputCache(tmp_path / 'cache', max_size_mb=15 / 1024 / 1024)
+    first = cache.key(input_file, SONG, PRESET, crossfade=0)
+    second = cache.key(input_file, SONG, PRESET, crossfade=1)
+    cache.store(first, files[:1])
+    cache.store(second, files[1:])
+    assert cache.restore(first) is None
+    assert cache.restore(second) == {}
+    # The outputs themselves are kept
+    assert all(file.exists() for file in files)
+
+
+@pytest.mark.parametrize('seed', [None, 1])
+def test_unseeded_random_presets_are_rendered_again(tmp_path, render, seed):
+    input_file, files = render
+    cache = OutputCache(tmp_path / 'cache')
+    song_data = {**SONG, 'filename': str(input_file), 'seed': seed}
+    random_preset = {'effects': [{'effect': 'replace random random',
+                                  'beats': '2'}]}
+    jobs = [{'preset': 'swing', 'preset_data': PRESET},
+            {'preset': 'shuffle', 'preset_data': random_preset}]
+    keys, _ = run.restore_cached_outputs(cache, song_data, jobs)
+    assert keys[0] is not None
+    assert (keys[1] is None) == (seed is None)
+    for key, job in zip(keys, jobs):
+        run.store_outputs(cache, key, None, job,
+                          ExportResult(files[0], None, (files[0],)))
+    _, results = run.restore_cached_outputs(cache, song_data, jobs)
+    assert results[0] is not None
+    assert (results[1] is None) == (seed is None)
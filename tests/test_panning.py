@@ -0,0 +1,65 @@
+"""Tests of the panning envelopes."""
+import numpy as np
+import pytest
+from pydub import AudioSegment
+
+import panning
+
+GAIN = panning.HARD_PAN_GAIN
+
+
+def test_hard_pans_follow_the_pan_law_of_pydub():
+    assert GAIN == pytest.approx(np.sqrt(2), rel=1e-3)
+    samples = np.arange(-3000, 3000, 3, dtype=np.int16).reshape(-1, 2)
+    audio = AudioSegment(samples.tobytes(), sample_width=2, frame_rate=8000,
+                         channels=2)
+    for pan in (-1, 1):
+        envelope = panning.hard_pan(len(samples), pan)
+        silent = 1 if pan < 0 else 0
+        assert np.all(envelope[:, silent] == 0)
+        assert np.all(envelope[:, 1 - silent] == GAIN)
+        panned = panning.apply_envelope(samples, envelope)
+        expected = np.frombuffer(audio.pan(float(pan)).raw_data,
+                                 dtype=np.int16).reshape(-1, 2)
+        assert np.array_equal(panned, expected)
+
+
+@pytest.mark.parametrize('to_left', [False, True])
+def test_across_moves_from_one_side_to_the_other(to_left):
+    envelope = panning.across(1000, to_left=to_left)
+    left, right = envelope[:, 0], envelope[:, 1]
+    start, end = (right, left) if to_left else (left, right)
+    # The gains are taken at the middle of each frame
+    assert start[0] == pytest.approx(GAIN, rel=1e-3)
+    assert end[-1] == pytest.approx(GAIN, rel=1e-3)
+    assert np.all(np.diff(start) <= 0) and np.all(np.diff(end) >= 0)
+    assert np.allclose(left + right, GAIN)
+
+
+def test_pingpong_alternates_the_sides():
+    envelope = panning.pingpong(1000, 4, 0)
+    rightness = envelope[:, 1] / GAIN
+    assert np.array_equal(rightness, np.repeat([0.0, 1.0, 0.0, 1.0], 250))
+    assert np.allclose(envelope.sum(axis=1), GAIN)
+
+
+def test_pingpong_fades_between_the_sides():
+    envelope = panning.pingpong(1000, 4, 20)
+    rightness = envelope[:, 1] / GAIN
+    assert np.allclose(envelope.sum(axis=1), GAIN)
+    assert np.all(rightness[:240] == 0) and np.all(rightness[260:490] == 1)
+    # Over 20 frames around each boundary
+    assert np.all(np.diff(rightness[240:260]) > 0)
+    assert np.all(np.diff(rightness[490:510]) < 0)
+    # More segments than frames gives one segment per frame
+    assert len(panning.pingpong(3, 10, 5)) == 3
+
+
+def test_envelopes_make_mono_stereo_and_clip():
+    samples = np.array([[30000], [-30000], [100]], dtype=np.int16)
+    panned = panning.apply_envelope(samples, panning.hard_pan(3, 1))
+    assert panned.shape == (3, 2)
+    assert panned.tolist() == [[0, 32767], [0, -32768], [0, 141]]
+    with pytest.raises(ValueError):
+        panning.apply_envelope(np.zeros((3, 4), dtype=np.int16),
+                               panning.hard_pan(3, 1))
@@ -0,0 +1,104 @@
+"""Tests of binary peaks files."""
+import struct
+
+import numpy as np
+import pytest
+
+import peaks
+from audiosegment_patch import PatchedAudioSegment as AudioSegment
+
+FRAME_RATE = 8000
+FRAMES = 100000
+ZOOM_LEVELS = (256, 1024, 4096)
+
+
+@pytest.fixture
+def samples() -> np.ndarray:
+    rng = np.random.default_rng(1)
+    samples = rng.integers(-2000, 2000, (FRAMES, 2)).astype(np.int16)
+    # Louder in the second half, and full scale at one frame
+    samples[FRAMES // 2:] *= 10
+    samples[70000, 1] = -32768
+    return samples
+
+
+@pytest.fixture
+def peaks_file(tmp_path, samples):
+    audio = AudioSegment(samples.tobytes(), sample_width=2,
+                         frame_rate=FRAME_RATE, channels=2)
+    return peaks.write_peaks_file(audio, tmp_path / 'song.mp3.peaks',
+                                  zoom_levels=ZOOM_LEVELS)
+
+
+def _expected_pairs(samples: np.ndarray, zoom: int, first: int, last: int):
+    """The int8 (min, max) pairs of chunks first to last, from the samples"""
+    chunks = [samples[chunk * zoom:(chunk + 1) * zoom]
+              for chunk in range(first, last)]
+    minimum = np.array([chunk.min() for chunk in chunks], dtype=np.int64)
+    maximum = np.array([chunk.max() for chunk in chunks], dtype=np.int64)
+    return (np.clip(np.floor(minimum * 128 / 32768), -128, 127),
+            np.clip(np.ceil(maximum * 128 / 32768), -128, 127))
+
+
+def test_header_round_trip(peaks_file):
+    data = peaks_file.read_bytes()
+    assert peaks.PEAKS_FILE_HEADER.format == '<4sBBBxIQH'
+    assert struct.unpack_from('<4sBBBxIQH', data) == (
+        b'STPK', 1, 2, 2, FRAME_RATE, FRAMES, len(ZOOM_LEVELS))
+    header = peaks.read_peaks_header(peaks_file)
+    assert (header['sample_width'], header['channels'], header['frame_rate'],
+            header['frame_count']) == (2, 2, FRAME_RATE, FRAMES)
+    levels = header['levels']
+    assert [level['frames_per_chunk'] for level in levels] == list(ZOOM_LEVELS)
+    assert [level['chunks'] for level in levels] == [
+        -(-FRAMES // zoom) for zoom in ZOOM_LEVELS]
+    # The pairs of the levels follow the header, one level after the other
+    offset = peaks.PEAKS_FILE_HEADER.size + (
+        peaks.PEAKS_FILE_LEVEL.size * len(levels))
+    for level in levels:
+        assert level['offset'] == offset
+        offset += level['chunks'] * 2
+    assert offset == len(data)
+
+
+@pytest.mark.parametrize(('start_ms', 'end_ms', 'max_points', 'zoom'), [
+    (0, FRAMES * 1000 / FRAME_RATE, 1000, 256),
+    (0, FRAMES * 1000 / FRAME_RATE, 50, 4096),
+    (1000, 2000, 40, 256),
+    (5000, 9000, 10, 4096),
+    (12000, 99999, 1000, 256),
+])
+def test_windows_read_the_peaks_of_their_range(peaks_file, samples, start_ms,
+                                               end_ms, max_points, zoom):
+    window = peaks.read_peaks_window(peaks_file, start_ms, end_ms,
+                                     max_points=max_points)
+    assert window.frames_per_chunk == zoom
+    first = int(start_ms * FRAME_RATE / 1000) // zoom
+    last = min(-(-min(int(end_ms * FRAME_RATE / 1000), FRAMES) // zoom),
+               -(-FRAMES // zoom))
+    minimum, maximum = _expected_pairs(samples, zoom, first, last)
+    assert np.array_equal(window.minimum, minimum)
+    assert np.array_equal(window.maximum, maximum)
+    assert window.start_ms == first * zoom * 1000 / FRAME_RATE <= start_ms
+    assert window.end_ms == min(last * zoom, FRAMES) * 1000 / FRAME_RATE
+
+
+def test_full_scale_is_kept(peaks_file):
+    window = peaks.read_peaks_window(peaks_file, 0, 20000)
+    assert window.minimum.min() == -128
+    assert window.maximum.max() < 127
+
+
+def test_invalid_files(tmp_path, peaks_file):
+    data = bytearray(peaks_file.read_bytes())
+    invalid = tmp_path / 'invalid.peaks'
+    invalid.write_bytes(b'XXXX' + data[4:])
+    with pytest.raises(ValueError):
+        peaks.read_peaks_header(invalid)
+    data[4] = 2
+    invalid.write_bytes(data)
+    with pytest.raises(ValueError):
+        peaks.read_peaks_window(invalid, 0, 1000)
+    with pytest.raises(ValueError):
+        peaks.write_peaks_file(AudioSegment.silent(100), invalid,
+                               zoom_levels=(256, 1000))
@@ -0,0 +1,165 @@
+"""Tests of the numpy render engine and its incremental renders."""
+from pathlib import Path
+import copy
+import random
+import shutil
+import weakref
+
+import numpy as np
+import pytest
+import yaml
+
+import render_engine
+from songtwister import SongTwister
+
+BARS = 24
+
+PRESETS = {}
+for preset_file in sorted(
+        (Path(__file__).parent.parent / 'effect_presets').glob('*.yml')):
+    with open(preset_file, 'r') as reader:
+        PRESETS.update(yaml.safe_load(reader.read()) or {})
+
+
+def _full_render(song: SongTwister) -> bytes:
+    """Render the effects of a song from scratch"""
+    fresh = SongTwister(**song.export_state(keep_audio=True))
+    return fresh.apply_effects().audio.raw_data
+
+
+@pytest.fixture
+def laid_out_cuts(monkeypatch) -> list:
+    """Count the cuts that the numpy engine lays out"""
+    cuts = []
+    add_cut = render_engine.Joiner.add_cut
+
+    def _add_cut(joiner, cut, *args, **kwargs):
+        cuts.append(cut)
+        return add_cut(joiner, cut, *args, **kwargs)
+    monkeypatch.setattr(render_engine.Joiner, 'add_cut', _add_cut)
+    return cuts
+
+
+def _apply_preset(song, preset_data: dict):
+    """Apply a preset to a song, as run.py does"""
+    song.set_crossfade(preset_data.get('crossfade', '1/128'))
+    for setting in ('crossfade_curve', 'resample_quality'):
+        if preset_data.get(setting):
+            setattr(song, setting, preset_data.get(setting))
+    if 'edit' in preset_data:
+        song = song.edit(preset_data.get('edit'))
+    effect_chain = list(preset_data.get('effect_chain') or [])
+    if preset_data.get('effects'):
+        effect_chain.append(preset_data.get('effects'))
+    for effects in effect_chain:
+        song.add_effects(effects)
+        song = song.apply_effects()
+    return song
+
+
+def _processes(preset_data: dict) -> bool:
+    """Whether a preset processes the audio with ffmpeg"""
+    return any(edit.get('do') == 'process'
+               for edit in preset_data.get('edit') or [])
+
+
+@pytest.mark.parametrize('preset', [
+    pytest.param(preset, marks=pytest.mark.skipif(
+        _processes(preset_data) and shutil.which('ffmpeg') is None,
+        reason="The preset processes the audio with ffmpeg"))
+    for preset, preset_data in sorted(PRESETS.items()) if preset_data])
+def test_engines_render_presets_alike(preset, make_song):
+    outputs = []
+    for engine in render_engine.ENGINES:
+        song = make_song(bars=8, prefix_ms=250, render_engine=engine)
+        song = _apply_preset(song, copy.deepcopy(PRESETS[preset]))
+        outputs.append(bytes(song.audio.raw_data))
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize('curve', ['stepped', 'linear'])
+@pytest.mark.parametrize('crossfade', [0, '1/64'])
+def test_incremental_render_is_a_full_render(curve, crossfade, laid_out_cuts,
+                                             make_song):
+    song = make_song(bars=BARS, frame_rate=44100, crossfade_curve=curve)
+    song.set_crossfade(crossfade)
+    song.add_effect(effect='reverse', beats='every 4 of 4', bars='all')
+    song.add_effect(effect='pitchdown 12', beats='2', bars='odd')
+    first = song.apply_effects().audio
+    cut_count = len(laid_out_cuts)
+    assert first.raw_data == _full_render(song)
+
+    outputs = [(first, bytes(first.raw_data))]
+    for effect, bar in [('remove', 1), ('speedup 2', BARS // 2),
+                        ('repeat', BARS)]:
+        laid_out_cuts.clear()
+        song.add_effect(effect=effect, beats='3', bars=str(bar))
+        output = song.apply_effects().audio
+        # Only the cuts from the changed bar on are laid out again, up to
+        # where the rest of the last render can be reused
+        assert len(laid_out_cuts) < cut_count // 4
+        assert output.raw_data == _full_render(song)
+        outputs.append((output, bytes(output.raw_data)))
+
+    # Patching the render in place leaves the earlier outputs as they were
+    for output, samples in outputs:
+        assert output.raw_data == samples
+
+
+def test_renders_leave_the_earlier_samples_as_they_were(make_song):
+    song = make_song(bars=8)
+    song.add_effect(effect='reverse', beats='2', bars='all')
+    arrays = []
+    for bar in (None, 2, 5):
+        if bar is not None:
+            song.add_effect(effect='remove', beats='3', bars=str(bar))
+        output = song.apply_effects().audio
+        arrays.append(np.frombuffer(output.raw_data, dtype=np.int16))
+    expected = [samples.copy() for samples in arrays]
+    song.add_effect(effect='repeat', beats='1', bars='3')
+    song.apply_effects()
+    for samples, samples_before in zip(arrays, expected):
+        assert np.array_equal(samples, samples_before)
+
+    # Once nothing reads the buffer any more, it is patched in place
+    del output, arrays
+    buffer = weakref.ref(song._last_render.state.buffer)
+    song.add_effect(effect='remove', beats='1', bars='7')
+    song.apply_effects()
+    assert song._last_render.state.buffer is buffer()
+
+
+def test_presets_share_their_renders(make_song):
+    song = make_song(bars=8)
+    first = song.spawn_new_instance()
+    first.add_effect(effect='reverse', beats='2', bars='all')
+    first.apply_effects()
+    second = song.spawn_new_instance()
+    second.add_effect(effect='reverse', beats='2', bars='all')
+    second.add_effect(effect='remove', beats='4', bars='3')
+    assert second._last_render is first._last_render
+    assert second.apply_effects().audio.raw_data == _full_render(second)
+
+
+
+def test_unseeded_renders_draw_the_random_beats_again(make_song):
+    song = make_song(bars=8, seed=None)
+    song.add_effect(effect='replace random random', beats='2', bars='all')
+    song.apply_effects()
+    for seed in (1, 2, 2):
+        song.rng = random.Random(seed)
+        output = song.apply_effects().audio
+        fresh = SongTwister(**song.export_state(keep_audio=True))
+        fresh.rng = random.Random(seed)
+        assert output.raw_data == fresh.apply_effects().audio.raw_data
+
+@pytest.mark.parametrize(('old', 'new', 'unchanged'), [
+    ('abcde', 'abcde', (5, 0)),
+    ('abcde', 'abXde', (2, 2)),
+    ('abcde', 'abde', (2, 2)),
+    ('abcde', 'abcdeX', (5, 0)),
+    ('aaaa', 'aaaaa', (4, 0)),
+    ('', 'ab', (0, 0)),
+])
+def test_unchanged_cuts(old, new, unchanged):
+    assert render_engine.unchanged_cuts(list(old), list(new)) == unchanged
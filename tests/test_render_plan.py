@@ -0,0 +1,46 @@
+"""Tests of compiled render plans."""
+import pytest
+
+from render_plan import RenderPlan
+
+
+@pytest.fixture
+def song(make_song):
+    song = make_song(bars=8, prefix_ms=250)
+    song.set_crossfade('1/64')
+    song.add_effect(effect='reverse', beats='2', bars='odd')
+    song.add_effect(effect='remove', beats='4', bars='3')
+    song.add_effect(effect='silence', beats='every 2 of 8', bars='5-6',
+                    beats_per_bar=8)
+    return song
+
+
+def test_saved_plan_loads_the_same(song, tmp_path):
+    plan = song.compile_plan()
+    assert len(plan)
+    plan.save(tmp_path / 'plan.npz')
+    loaded = RenderPlan.load(tmp_path / 'plan.npz')
+    assert loaded == plan
+    assert loaded.cut_keys() == plan.cut_keys()
+    assert RenderPlan.from_bytes(plan.to_bytes()) == plan
+
+
+def test_loaded_plan_renders_the_same(song, tmp_path):
+    song.compile_plan().save(tmp_path / 'plan.npz')
+    loaded = RenderPlan.load(tmp_path / 'plan.npz')
+    rendered = song.apply_effects().audio
+    fresh = song.spawn_new_instance()
+    assert fresh.apply_effects(plan=loaded).audio.raw_data == rendered.raw_data
+
+
+def test_cuts_and_beats_from_a_cut(song):
+    plan = song.compile_plan()
+    cuts = list(plan.cuts(lambda bar, beat: None))
+    beats = list(plan.beats())
+    assert list(plan.cuts(lambda bar, beat: None, 3)) == cuts[3:]
+    assert list(plan.cuts(lambda bar, beat: None, len(cuts))) == []
+    rendered = []
+    list(plan.cuts(lambda bar, beat: rendered.append((bar, beat)), 2))
+    assert list(plan.beats(2)) == rendered
+    assert list(plan.beats(0, len(cuts))) == beats
+    assert list(plan.beats(2, 2)) == []
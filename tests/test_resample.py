@@ -0,0 +1,42 @@
+"""Tests of the polyphase resampler."""
+import numpy as np
+import pytest
+
+import resample
+
+RATIOS = [(2, 1), (1, 2), (3, 4), (160, 147), (147, 160)]
+
+
+@pytest.mark.parametrize(('up', 'down'), RATIOS)
+@pytest.mark.parametrize('frames', [1, 7, 1000, 4410])
+def test_output_length(up, down, frames):
+    samples = np.zeros((frames, 2), dtype=np.int16)
+    resampled = resample.resample(samples, up, down)
+    assert resampled.shape == (resample.output_frames(frames, up, down), 2)
+    assert resampled.dtype == np.int16
+
+
+@pytest.mark.parametrize(('up', 'down'), RATIOS)
+@pytest.mark.parametrize('quality', sorted(resample.QUALITIES))
+def test_dc_gain_is_one(up, down, quality):
+    level = 10000
+    samples = np.full((4000, 1), level, dtype=np.int16)
+    resampled = resample.resample(samples, up, down, quality)
+    # Away from the ends, which fade in from and out to silence
+    margin = len(resampled) // 4
+    assert np.abs(resampled[margin:-margin].astype(int) - level).max() <= 1
+
+
+def test_batch_is_each_beat_alone():
+    rng = np.random.default_rng(0)
+    beats = [rng.integers(-20000, 20000, (frames, 2)).astype(np.int16)
+             for frames in (500, 1234, 77)]
+    for batched, beat in zip(resample.resample_batch(beats, 3, 4), beats):
+        assert np.array_equal(batched, resample.resample(beat, 3, 4))
+
+
+def test_ratio():
+    assert resample.ratio(0.5) == (1, 2)
+    up, down = resample.ratio(44100 / 48000)
+    assert (up, down) == (147, 160)
+    assert max(resample.ratio(1 / 3001)) <= 3001
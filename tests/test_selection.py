@@ -0,0 +1,105 @@
+"""Tests of the compiled selections of bars and beats."""
+import random
+
+import pytest
+
+import selection
+from selection import compile_selector
+from songtwister import SongTwister
+
+ITEMS = list(range(1, 11))
+
+
+@pytest.mark.parametrize(('criteria', 'items', 'selected'), [
+    ('every 2 of 4', ITEMS, [2, 6, 10]),
+    ('every 4 of 4', ITEMS[:8], [4, 8]),
+    # The last batch is too short
+    ('every 4 of 4', ITEMS, []),
+    # 0 and negative numbers count from the end of each batch
+    ('every 0 of 4', ITEMS[:8], [4, 8]),
+    ('every -1 of 4', ITEMS[:8], [3, 7]),
+    ('every -4 of 4', ITEMS[:8], []),
+    ('every 5 of 4', ITEMS[:8], []),
+    ('every 9 of 4', ITEMS[:8], []),
+    ('every x of 4', ITEMS, []),
+    ('every 1 of 0', ITEMS, []),
+])
+def test_every_x_of_y(criteria, items, selected):
+    assert SongTwister.perform_selection(items, criteria) == selected
+
+
+@pytest.mark.parametrize(('criteria', 'selected'), [
+    ('3', [3]),
+    ('8-', [8, 9, 10]),
+    ('-3', [1, 2, 3]),
+    # More than there are items selects just that one
+    ('-12', []),
+    ('-10', ITEMS),
+    ('1-3, 8-10', [1, 2, 3, 8, 9, 10]),
+    ('2, 5-6', [2, 5, 6]),
+    # Ranges compare numbers, not strings
+    ('2-10', ITEMS[1:]),
+    ('5-2', []),
+])
+def test_numbers_and_ranges(criteria, selected):
+    assert SongTwister.perform_selection(ITEMS, criteria) == selected
+
+
+def test_ranges_of_a_long_song():
+    items = list(range(1, 41))
+    assert SongTwister.perform_selection(items, '1-8, 17-32') == (
+        list(range(1, 9)) + list(range(17, 33)))
+
+
+@pytest.mark.parametrize(('criteria', 'selected'), [
+    (4, [4]),
+    ([2, 4], [2, 4]),
+    ((1, range(3, 5)), [1, 3, 4, 5]),
+    (range(0, 3), [1, 2, 3]),
+    ((0, -1, 2), [2]),
+    ([2, 'x', range(9, 12)], [2, 9, 10]),
+    ('all', ITEMS),
+    ('none', []),
+    ('even', [2, 4, 6, 8, 10]),
+    ('odd', [1, 3, 5, 7, 9]),
+    ('first', [1]),
+    ('last', [10]),
+    ('Last', [10]),
+])
+def test_numbers_and_keywords(criteria, selected):
+    assert SongTwister.perform_selection(ITEMS, criteria) == selected
+
+
+def test_random_selections_follow_the_rng():
+    selected = SongTwister.perform_selection(ITEMS, 'random 3',
+                                             random.Random(7))
+    assert len(selected) == 3
+    assert selected == sorted(set(selected))
+    assert set(selected) <= set(ITEMS)
+    assert selected == SongTwister.perform_selection(ITEMS, 'random 3',
+                                                     random.Random(7))
+    assert 1 <= len(SongTwister.perform_selection(
+        ITEMS, 'random', random.Random(7))) <= len(ITEMS)
+    # More than there are items selects all of them
+    assert SongTwister.perform_selection(
+        ITEMS, 'random 20', random.Random(7)) == ITEMS
+
+
+def test_unseeded_selections_use_the_random_module(make_song):
+    song = make_song(bars=2, seed=None)
+    assert song.rng is None
+    random.seed(3)
+    selected = song.perform_selection(ITEMS, 'random 4', song.rng)
+    random.seed(3)
+    assert song.perform_selection(ITEMS, 'random 4') == selected
+
+
+def test_selectors_are_cached():
+    selection._compile_cached.cache_clear()
+    selector = compile_selector('Every 2 of 4')
+    assert compile_selector('every 2 of 4') is selector
+    assert compile_selector([1, range(3, 5)]) is compile_selector(
+        (1, range(3, 5)))
+    assert selection._compile_cached.cache_info().hits == 2
+    # Criteria that can not be hashed are compiled every time
+    assert compile_selector({'bars': 1}).select(ITEMS) == []
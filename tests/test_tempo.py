@@ -0,0 +1,27 @@
+"""Tests of tempo detection on click tracks."""
+import pytest
+
+import tempo
+from render_engine import audio_to_array
+
+
+@pytest.mark.parametrize('bpm', [90, 120, 128, 150])
+def test_detects_the_tempo_of_a_click_track(bpm, make_click_track):
+    audio = make_click_track(16, bpm=bpm)
+    candidates = tempo.detect_bpm(audio_to_array(audio), audio.frame_rate)
+    assert candidates
+    assert candidates[0].bpm == pytest.approx(bpm, abs=0.5)
+
+
+@pytest.mark.parametrize('prefix_ms', [0, 100, 1234])
+def test_fits_the_grid_of_a_click_track(prefix_ms, make_click_track):
+    audio = make_click_track(16, bpm=110, prefix_ms=prefix_ms)
+    envelope = tempo.onset_envelope(audio_to_array(audio), audio.frame_rate)
+    fit = tempo.fit_grid(envelope, 110)
+    assert fit.bpm == pytest.approx(110, abs=0.2)
+    assert fit.score > 1
+    # The noise before the clicks counts as music, so the grid starts at
+    # the first beat of it, whole beats before the clicks
+    beat_ms = 60000 / 110
+    offset = (prefix_ms - fit.prefix_length_ms) % beat_ms
+    assert min(offset, beat_ms - offset) < 15
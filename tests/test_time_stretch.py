@@ -0,0 +1,71 @@
+"""Tests of time stretching and pitch shifting."""
+import numpy as np
+import pytest
+
+import time_stretch
+
+FRAME_RATE = 22050
+
+
+def _sine(frequency: float, frames: int, channels: int = 2) -> np.ndarray:
+    times = np.arange(frames) / FRAME_RATE
+    wave = 8000 * np.sin(2 * np.pi * frequency * times)
+    return np.repeat(wave[:, None], channels, axis=1).astype(np.int16)
+
+
+def _frequency(samples: np.ndarray) -> float:
+    """The strongest frequency of the middle half of a sample array"""
+    middle = samples[len(samples) // 4:3 * len(samples) // 4, 0]
+    spectrum = np.abs(np.fft.rfft(middle * np.hanning(len(middle))))
+    return np.argmax(spectrum) * FRAME_RATE / len(middle)
+
+
+@pytest.mark.parametrize('speed', [1.0, 1.25, 2.0, 3.0, 0.75])
+@pytest.mark.parametrize('frames', [1, 10, 1000, 11025])
+def test_speedup_length(speed, frames):
+    samples = _sine(440, frames)
+    stretched = time_stretch.speedup(samples, speed, FRAME_RATE)
+    assert stretched.shape == (max(round(frames / speed), 1), 2)
+    assert stretched.dtype == np.int16
+
+
+def test_speedup_of_nothing_is_nothing():
+    stretched = time_stretch.speedup(np.zeros((0, 2), dtype=np.int16), 2.0,
+                                     FRAME_RATE)
+    assert stretched.shape == (0, 2)
+
+
+@pytest.mark.parametrize('speed', [1.5, 2.0, 0.8])
+def test_speedup_keeps_the_pitch(speed):
+    samples = _sine(440, FRAME_RATE)
+    stretched = time_stretch.speedup(samples, speed, FRAME_RATE)
+    assert _frequency(stretched) == pytest.approx(440, abs=5)
+
+
+def test_batch_is_each_beat_alone():
+    beats = [_sine(440, frames) for frames in (5000, 5000, 7000, 3)]
+    out_frames = [2500, 6000, 3500, 2]
+    batch = time_stretch.wsola_batch(beats, out_frames, FRAME_RATE)
+    for beat, out, stretched in zip(beats, out_frames, batch):
+        assert np.array_equal(stretched,
+                              time_stretch.wsola(beat, out, FRAME_RATE))
+
+
+@pytest.mark.parametrize(('semitones', 'frequency'), [
+    (12, 880), (-12, 220), (7, 440 * 2 ** (7 / 12)),
+    (-5, 440 * 2 ** (-5 / 12))])
+def test_pitch_shift_moves_the_pitch(semitones, frequency):
+    samples = _sine(440, FRAME_RATE)
+    shifted = time_stretch.pitch_shift(samples, semitones, FRAME_RATE)
+    assert _frequency(shifted) == pytest.approx(frequency, rel=0.02)
+
+
+@pytest.mark.parametrize('semitones', [12, -12, 3])
+def test_pitch_shift_keeps_the_length(semitones):
+    beats = [_sine(440, frames) for frames in (0, 1, 100, 5513, 11025)]
+    shifted = time_stretch.pitch_shift_batch(beats, semitones, FRAME_RATE)
+    for beat, samples in zip(beats, shifted):
+        assert samples.shape == beat.shape
+        assert samples.dtype == np.int16
+        assert np.array_equal(samples, time_stretch.pitch_shift(
+            beat, semitones, FRAME_RATE))
@@ -0,0 +1,211 @@
+"""Time-stretching and pitch-shifting of sample arrays, in NumPy.
+
+pydub.effects.speedup cuts the audio into chunks, drops some and appends
+the rest one at a time, with a crossfade, in Python. WSOLA (waveform
+similarity overlap-add) also overlaps windows of the input, but picks each
+window within a small tolerance of its ideal position, where it lines up
+best with the window before it. The windows of a batch of beats are gathered
+and weighed in a few array operations, the n-th windows of all the beats
+are placed together with a pair of FFTs, and they are overlap-added with two
+sums. The output has exactly the requested number of frames.
+
+A pitch shift stretches the beats to a new length, and resamples them back
+to their own length (see resample.py), which moves the pitch by the ratio
+of the two.
+"""
+import logging
+from typing import Optional
+
+import numpy as np
+
+import resample
+
+logger = logging.getLogger("songtwister.time_stretch")
+
+WINDOW_MS = 50  # The length of the overlapping windows
+MIN_WINDOW_FRAMES = 16  # Shorter audio is resampled by picking frames
+MAX_BATCH_SAMPLES = 1 << 23  # The most window samples gathered at once
+
+
+def _window_frames(frame_rate: int, in_frames: int, out_frames: int,
+                   window_ms: int | float) -> int:
+    """The even number of frames in a window, at most the input and the
+    output length"""
+    frames = min(int(window_ms * frame_rate / 1000), in_frames, out_frames)
+    return frames - frames % 2
+
+
+def _pick_frames(samples: np.ndarray, out_frames: int) -> np.ndarray:
+    """Stretch by picking the nearest input frame of each output frame"""
+    positions = np.arange(out_frames) * (len(samples) / max(out_frames, 1))
+    return samples[np.minimum(positions.astype(np.int64), len(samples) - 1)]
+
+
+def _to_dtype(samples: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """Round float samples to an integer sample type"""
+    info = np.iinfo(dtype)
+    return np.clip(np.rint(samples), info.min, info.max).astype(dtype)
+
+
+def _place_windows(mono: np.ndarray, starts: np.ndarray, frames: int,
+                   tolerance: int, first: np.ndarray,
+                   last: np.ndarray) -> np.ndarray:
+    """Move each window of each beat but the first by up to tolerance frames
+    from its ideal start, within first..last of its beat, to where the start
+    of the window is most like what would naturally follow the window before
+    it, by normalized cross-correlation. starts is (beats, windows).
+    The spectra and energies of the spans searched are computed for all
+    windows at once, so each step only takes the FFTs of what the n-th
+    windows of the beats should follow, and one inverse FFT."""
+    hop = frames // 2
+    span = hop + 2 * tolerance
+    regions = mono[(starts[:, 1:] - tolerance)[..., None] + np.arange(span)]
+    power = np.cumsum(np.pad(regions ** 2, ((0, 0), (0, 0), (1, 0))), axis=-1)
+    norms = np.sqrt(np.maximum(power[..., hop:] - power[..., :-hop], 1e-9))
+    size = 1 << int(np.ceil(np.log2(span + hop)))
+    spectra = np.fft.rfft(regions, size)
+    moved = starts[:, 1:, None] + np.arange(-tolerance, tolerance + 1)
+    outside = np.where((moved < first[:, None, None])
+                       | (moved > last[:, None, None]), -np.inf, 0.0)
+    placed = starts.copy()
+    for window in range(1, starts.shape[1]):
+        follow = placed[:, window - 1] + hop
+        templates = np.fft.rfft(mono[follow[:, None] + np.arange(hop)], size)
+        score = np.fft.irfft(spectra[:, window - 1] * np.conj(templates), size)
+        score = (score[:, :2 * tolerance + 1] / norms[:, window - 1]
+                 + outside[:, window - 1])
+        placed[:, window] += np.argmax(score, axis=1) - tolerance
+    return placed
+
+
+def _wsola_batch(beats: list[np.ndarray], out_frames: list[int], frames: int,
+                 tolerance: int) -> list[np.ndarray]:
+    """Stretch beats of at least frames frames with the same window"""
+    hop = frames // 2
+    channels = beats[0].shape[1]
+    in_frames = np.array([len(beat) for beat in beats])
+    outs = np.array(out_frames)
+
+    # The windows start every hop frames in the output, and at the same
+    # relative position in the input. The last one may run past the end.
+    counts = np.maximum(-(-outs // hop) - 1, 1)
+    count = int(counts.max())
+    rates = (in_frames - frames) / np.maximum(outs - frames, 1)
+    ideal = np.minimum(
+        np.rint(np.arange(count) * hop * rates[:, None]).astype(np.int64),
+        (in_frames - frames)[:, None])
+
+    # Lay the beats out in rows, padded with silence, so windows and
+    # searches may reach past both ends
+    pad = frames + 2 * tolerance
+    row_length = int(in_frames.max()) + 2 * pad
+    padded = np.zeros((len(beats), row_length, channels), dtype=np.float32)
+    for row, beat in enumerate(beats):
+        padded[row, pad:pad + len(beat)] = beat
+    padded = padded.reshape(-1, channels)
+    mono = padded @ np.full(channels, 1 / channels, dtype=np.float32)
+    bases = np.arange(len(beats)) * row_length + pad
+    starts = _place_windows(mono, ideal + bases[:, None], frames, tolerance,
+                            bases, bases + in_frames - frames)
+
+    windows = padded[starts[..., None] + np.arange(frames)]
+    # A periodic Hann window at half overlap adds up to exactly 1
+    fade_in = np.sin(np.pi * np.arange(hop) / frames) ** 2
+    rising = windows[:, :, :hop] * fade_in[:, None]
+    falling = windows[:, :, hop:] * (1.0 - fade_in)[:, None]
+    # The first window starts at full gain, and the last one ends at it.
+    # Beats with fewer windows than the others leave out the rest.
+    rising[:, 0] = windows[:, 0, :hop]
+    rows = np.arange(len(beats))
+    falling[rows, counts - 1] = windows[rows, counts - 1, hop:]
+    unused = np.arange(count) >= counts[:, None]
+    rising[unused] = 0
+    falling[unused] = 0
+    stretched = np.zeros((len(beats), (count + 1) * hop, channels),
+                         dtype=np.float32)
+    stretched[:, :count * hop] += rising.reshape(len(beats), -1, channels)
+    stretched[:, hop:] += falling.reshape(len(beats), -1, channels)
+    return [_to_dtype(stretched[row, :out], beat.dtype)
+            for row, (beat, out) in enumerate(zip(beats, out_frames))]
+
+
+def wsola_batch(beats: list[np.ndarray], out_frames: list[int],
+                frame_rate: int, window_ms: int | float = WINDOW_MS,
+                tolerance: Optional[int] = None) -> list[np.ndarray]:
+    """Stretch each (frames, channels) sample array of beats to its number
+    of out_frames, keeping its pitch. tolerance is how far, in frames, a
+    window may be moved from its ideal position, by default a quarter of a
+    window. Beats that share a window length are stretched together."""
+    stretched: list[Optional[np.ndarray]] = [None] * len(beats)
+    batches: dict[int, list[int]] = {}
+    for index, (beat, out) in enumerate(zip(beats, out_frames)):
+        if out == len(beat):
+            stretched[index] = beat.copy()
+        elif not len(beat) or out <= 0:
+            stretched[index] = np.zeros((max(out, 0), beat.shape[1]),
+                                        dtype=beat.dtype)
+        else:
+            frames = _window_frames(frame_rate, len(beat), out, window_ms)
+            if frames < MIN_WINDOW_FRAMES:
+                stretched[index] = _pick_frames(beat, out)
+            else:
+                batches.setdefault(frames, []).append(index)
+
+    for frames, indices in batches.items():
+        hop = frames // 2
+        batch_tolerance = hop // 2 if tolerance is None else tolerance
+        # Keep the gathered windows of a batch to a reasonable size
+        per_beat = max(max(out_frames[index] for index in indices) * 2, frames)
+        size = max(MAX_BATCH_SAMPLES // per_beat, 1)
+        for first in range(0, len(indices), size):
+            chunk = indices[first:first + size]
+            results = _wsola_batch([beats[index] for index in chunk],
+                                   [out_frames[index] for index in chunk],
+                                   frames, batch_tolerance)
+            for index, result in zip(chunk, results):
+                stretched[index] = result
+    return stretched
+
+
+def wsola(samples: np.ndarray, out_frames: int, frame_rate: int,
+          window_ms: int | float = WINDOW_MS,
+          tolerance: Optional[int] = None) -> np.ndarray:
+    """Stretch a (frames, channels) sample array to out_frames frames,
+    keeping its pitch"""
+    return wsola_batch([samples], [out_frames], frame_rate,
+                       window_ms=window_ms, tolerance=tolerance)[0]
+
+
+def speedup(samples: np.ndarray, speed: float, frame_rate: int,
+            window_ms: int | float = WINDOW_MS) -> np.ndarray:
+    """Play a sample array speed times as fast, keeping its pitch. Audio
+    that is not empty keeps at least one frame."""
+    out_frames = int(round(len(samples) / speed))
+    if len(samples):
+        out_frames = max(out_frames, 1)
+    return wsola(samples, out_frames, frame_rate, window_ms=window_ms)
+
+
+def pitch_shift_batch(beats: list[np.ndarray], semitones: float,
+                      frame_rate: int, window_ms: int | float = WINDOW_MS,
+                      quality: str = resample.DEFAULT_QUALITY
+                      ) -> list[np.ndarray]:
+    """Shift the pitch of each sample array of beats a number of semitones,
+    up if positive and down if negative, keeping its length to the frame.
+    quality is the quality of the resampling, see resample.QUALITIES."""
+    up, down = resample.ratio(2 ** (-semitones / 12))
+    lengths = [len(beat) for beat in beats]
+    # Stretch to just enough frames to resample to the same length
+    stretched = wsola_batch(
+        beats, [max(-(-length * down // up), 1) for length in lengths],
+        frame_rate, window_ms=window_ms)
+    resampled = resample.resample_batch(stretched, up, down, quality)
+    return [samples[:length] for samples, length in zip(resampled, lengths)]
+
+
+def pitch_shift(samples: np.ndarray, semitones: float, frame_rate: int,
+                window_ms: int | float = WINDOW_MS,
+                quality: str = resample.DEFAULT_QUALITY) -> np.ndarray:
+    """Shift the pitch of a sample array a number of semitones"""
+    return pitch_shift_batch([samples], semitones, frame_rate,
+                             window_ms=window_ms, quality=quality)[0]